@@ -0,0 +1,360 @@
+"""Load and latency benchmark of the editor HTTP API.
+
+Generates fixture trees in a temporary directory, starts an EditorThread on
+a loopback port and drives concurrent keep-alive clients through the static
+files and the API. The results are written as JSON:
+
+    python benchmarks/run.py --output result.json
+    python benchmarks/run.py --thresholds benchmarks/thresholds.json
+    python benchmarks/run.py --baseline result.json --tolerance 0.25
+
+The exit code is 1 when a threshold is exceeded or a scenario regressed
+compared to the baseline by more than the tolerance. The server runs in the
+benchmark process, so the peak RSS includes the (streaming) clients.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import quote, urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import editor  # noqa: E402
+
+SEED = 1
+READ_SIZE = 65536
+SAMPLE_INTERVAL = 0.05
+SCENARIOS = ('index', 'asset', 'listdir_small', 'listdir_large', 'listdir_deep', 'tree_deep',
+             'file', 'download', 'save', 'upload')
+
+
+def make_fixtures(root, files, binary_size, depth):
+    """Create the fixture trees below root, return their paths."""
+    rand = random.Random(SEED)
+    fixtures = {
+        'configs': os.path.join(root, 'configs'),
+        'large': os.path.join(root, 'large'),
+        'binary': os.path.join(root, 'binary.bin'),
+        'deep': os.path.join(root, 'deep'),
+        'uploads': os.path.join(root, 'uploads'),
+        'saves': os.path.join(root, 'saves'),
+    }
+    for name in ('configs', 'large', 'uploads', 'saves'):
+        os.makedirs(fixtures[name])
+    for index in range(20):
+        lines = ["---"]
+        for synapse in range(rand.randint(5, 40)):
+            lines.extend([
+                "- name: \"synapse-%d-%d\"" % (index, synapse),
+                "  signals:",
+                "    - order: \"%s\"" % " ".join(rand.choice(("say", "hello", "play", "music", "stop",
+                                                             "what", "time", "is", "it")) for _ in range(4)),
+                "  neurons:",
+                "    - say:",
+                "        message: \"%s\"" % uuid.UUID(int=rand.getrandbits(128)).hex,
+            ])
+        with open(os.path.join(fixtures['configs'], 'brain_%02d.yml' % index), 'w') as fptr:
+            fptr.write("\n".join(lines) + "\n")
+    for index in range(files):
+        with open(os.path.join(fixtures['large'], 'file_%05d.txt' % index), 'w') as fptr:
+            fptr.write("%d\n" % index)
+    block = bytes(rand.getrandbits(8) for _ in range(READ_SIZE))
+    with open(fixtures['binary'], 'wb') as fptr:
+        remaining = binary_size
+        while remaining > 0:
+            fptr.write(block[:remaining])
+            remaining -= len(block)
+    path = fixtures['deep']
+    for level in range(depth):
+        path = os.path.join(path, 'level_%02d' % level)
+        os.makedirs(path)
+        for index in range(3):
+            with open(os.path.join(path, 'file_%d.yml' % index), 'w') as fptr:
+                fptr.write("level: %d\n" % level)
+    fixtures['deepest'] = path
+    return fixtures
+
+
+def multipart(filename, data):
+    """Body and content type of an upload form as the browser sends it."""
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        b'--%s\r\nContent-Disposition: form-data; name="path"\r\n\r\n%s\r\n' % (
+            boundary.encode('ascii'), os.path.dirname(filename).encode('utf-8')),
+        b'--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n'
+        b'Content-Type: application/octet-stream\r\n\r\n' % (
+            boundary.encode('ascii'), os.path.basename(filename).encode('utf-8')),
+        data,
+        b'\r\n--%s--\r\n' % boundary.encode('ascii'),
+    ])
+    return body, 'multipart/form-data; boundary=%s' % boundary
+
+
+def make_scenarios(fixtures, asset):
+    """Request factories by scenario name, called with the client index."""
+    form = {'Content-Type': 'application/x-www-form-urlencoded'}
+    saved_text = open(os.path.join(fixtures['configs'], 'brain_00.yml')).read()
+    uploaded = bytes(random.Random(SEED).getrandbits(8) for _ in range(256 * 1024))
+    uploads = {}
+
+    def upload(client):
+        if client not in uploads:
+            uploads[client] = multipart(os.path.join(fixtures['uploads'], 'upload_%d.bin' % client), uploaded)
+        body, content_type = uploads[client]
+        return 'POST', '/api/upload', body, {'Content-Type': content_type}
+
+    return {
+        'index': lambda client: ('GET', '/', None, {}),
+        'asset': lambda client: ('GET', '/' + asset, None, {}),
+        'listdir_small': lambda client: ('GET', '/api/listdir?path=' + quote(fixtures['configs']), None, {}),
+        'listdir_large': lambda client: ('GET', '/api/listdir?path=' + quote(fixtures['large']), None, {}),
+        'listdir_deep': lambda client: ('GET', '/api/listdir?path=' + quote(fixtures['deepest']), None, {}),
+        'tree_deep': lambda client: ('GET', '/api/tree?depth=%d&path=%s' % (
+            editor.TREE_MAX_DEPTH, quote(fixtures['deep'])), None, {}),
+        'file': lambda client: ('GET', '/api/file?filename=' + quote(
+            os.path.join(fixtures['configs'], 'brain_%02d.yml' % (client % 20))), None, {}),
+        'download': lambda client: ('GET', '/api/download?filename=' + quote(fixtures['binary']), None, {}),
+        'save': lambda client: ('POST', '/api/save', urlencode({
+            'filename': os.path.join(fixtures['saves'], 'save_%d.yml' % client),
+            'text': saved_text}).encode('utf-8'), form),
+        'upload': upload,
+    }
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+def server_threads():
+    """Threads of the process that are not part of the benchmark."""
+    return sum(1 for thread in threading.enumerate()
+               if not thread.name.startswith('bench-') and thread is not threading.main_thread())
+
+
+class Client(threading.Thread):
+    """Sends the requests of a scenario over one keep-alive connection."""
+
+    def __init__(self, address, index, request, deadline):
+        super(Client, self).__init__(name='bench-client-%d' % index)
+        self.daemon = True
+        self.address = address
+        self.index = index
+        self.request = request
+        self.deadline = deadline
+        self.latencies = []
+        self.errors = 0
+        self.received = 0
+        self.conn = None
+
+    def run(self):
+        while time.perf_counter() < self.deadline:
+            method, path, body, headers = self.request(self.index)
+            started = time.perf_counter()
+            try:
+                if self.conn is None:
+                    self.conn = http.client.HTTPConnection(*self.address, timeout=60)
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                while True:
+                    chunk = response.read(READ_SIZE)
+                    if not chunk:
+                        break
+                    self.received += len(chunk)
+                if response.status >= 400:
+                    self.errors += 1
+                if response.will_close:
+                    self.conn.close()
+                    self.conn = None
+            except (OSError, http.client.HTTPException):
+                self.errors += 1
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+                continue
+            self.latencies.append(time.perf_counter() - started)
+        if self.conn is not None:
+            self.conn.close()
+
+
+class Sampler(threading.Thread):
+    """Records the peak number of server threads while a scenario runs."""
+
+    def __init__(self):
+        super(Sampler, self).__init__(name='bench-sampler')
+        self.daemon = True
+        self.running = threading.Event()
+        self.running.set()
+        self.peak = server_threads()
+
+    def run(self):
+        while self.running.is_set():
+            self.peak = max(self.peak, server_threads())
+            time.sleep(SAMPLE_INTERVAL)
+
+    def stop(self):
+        self.running.clear()
+        self.join()
+        return self.peak
+
+
+def run_scenario(address, request, concurrency, duration):
+    """Run one scenario, return its statistics."""
+    sampler = Sampler()
+    sampler.start()
+    started = time.perf_counter()
+    clients = [Client(address, index, request, started + duration) for index in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    received = sum(client.received for client in clients)
+
+    def milliseconds(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'requests': len(latencies),
+        'errors': sum(client.errors for client in clients),
+        'seconds': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 2),
+        'mb_per_second': round(received / elapsed / 1048576, 2),
+        'p50_ms': milliseconds(percentile(latencies, 0.5)),
+        'p99_ms': milliseconds(percentile(latencies, 0.99)),
+        'max_ms': milliseconds(latencies[-1] if latencies else None),
+        'threads_peak': sampler.stop(),
+        'rss_peak_mb': round(peak_rss() / 1048576, 1),
+    }
+
+
+def check(result, thresholds=None, baseline=None, tolerance=0.2):
+    """Failures of a result against absolute thresholds and a baseline result."""
+    failures = []
+    thresholds = thresholds or {}
+    if thresholds.get('rss_peak_mb') is not None and result['rss_peak_mb'] > thresholds['rss_peak_mb']:
+        failures.append("peak RSS %.1f MB above %.1f MB" % (result['rss_peak_mb'], thresholds['rss_peak_mb']))
+    if thresholds.get('threads_peak') is not None and result['threads_peak'] > thresholds['threads_peak']:
+        failures.append("%d server threads above %d" % (result['threads_peak'], thresholds['threads_peak']))
+    for name, stats in result['scenarios'].items():
+        limits = thresholds.get('scenarios', {}).get(name, {})
+        if stats['errors'] > limits.get('errors', 0):
+            failures.append("%s: %d failed requests" % (name, stats['errors']))
+        for key in ('p50_ms', 'p99_ms'):
+            if limits.get(key) is not None and stats[key] is not None and stats[key] > limits[key]:
+                failures.append("%s: %s %.3f above %.3f" % (name, key, stats[key], limits[key]))
+        if limits.get('rps') is not None and stats['rps'] < limits['rps']:
+            failures.append("%s: rps %.2f below %.2f" % (name, stats['rps'], limits['rps']))
+        previous = (baseline or {}).get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if previous[key] and stats[key] is not None and stats[key] > previous[key] * (1 + tolerance):
+                failures.append("%s: %s %.3f regressed from %.3f" % (name, key, stats[key], previous[key]))
+        if previous['rps'] and stats['rps'] < previous['rps'] * (1 - tolerance):
+            failures.append("%s: rps %.2f regressed from %.2f" % (name, stats['rps'], previous['rps']))
+    return failures
+
+
+def run(args):
+    """Run the benchmark described by the parsed arguments, return the result."""
+    scenarios = args.scenarios.split(',') if args.scenarios else list(SCENARIOS)
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise ValueError("Unknown scenarios: %s" % ", ".join(sorted(unknown)))
+    root = tempfile.mkdtemp(prefix='editor-bench-')
+    thread = None
+    try:
+        fixtures = make_fixtures(root, args.files, args.binary_size * 1024 * 1024, args.depth)
+        thread_class = editor.AsyncEditorThread if args.engine == 'asyncio' else editor.EditorThread
+        thread = thread_class('127.0.0.1', 0, workers=args.workers, queue_size=args.queue_size,
+                              search_refresh=None, events=args.events, metrics=args.metrics)
+        thread.daemon = True
+        thread.start()
+        address = thread.httpd.server_address[:2]
+        requests = make_scenarios(fixtures, args.asset)
+        result = {
+            'engine': args.engine,
+            'workers': args.workers,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'fixtures': {'files': args.files, 'binary_mb': args.binary_size, 'depth': args.depth},
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scenarios': {},
+        }
+        for name in scenarios:
+            # One request first, caches are warm when the clock starts.
+            Client(address, 0, requests[name], 0).run()
+            result['scenarios'][name] = run_scenario(address, requests[name], args.concurrency, args.duration)
+        result['threads_peak'] = max(stats['threads_peak'] for stats in result['scenarios'].values())
+        result['rss_peak_mb'] = round(peak_rss() / 1048576, 1)
+        return result
+    finally:
+        if thread is not None:
+            thread.shutdown_server()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def load_json(path):
+    if not path:
+        return None
+    with open(path) as fptr:
+        return json.load(fptr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the editor HTTP API.")
+    parser.add_argument('--engine', choices=editor.ENGINES, default='threading')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--queue-size', type=int, default=32)
+    parser.add_argument('--concurrency', type=int, default=8, help="parallel clients per scenario")
+    parser.add_argument('--duration', type=float, default=5, help="seconds per scenario")
+    parser.add_argument('--scenarios', help="comma separated, default: %s" % ",".join(SCENARIOS))
+    parser.add_argument('--files', type=int, default=10000, help="files in the large directory")
+    parser.add_argument('--binary-size', type=int, default=100, help="size of the downloaded file in MB")
+    parser.add_argument('--depth', type=int, default=64, help="levels of the nested directory")
+    parser.add_argument('--asset', default='extras/css/materialize.min.css', help="static file to request")
+    parser.add_argument('--no-events', dest='events', action='store_false', help="disable the change notifier")
+    parser.add_argument('--no-metrics', dest='metrics', action='store_false', help="disable /api/metrics")
+    parser.add_argument('--thresholds', help="JSON file with limits failing the run")
+    parser.add_argument('--baseline', help="result of an earlier run to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed regression against the baseline")
+    parser.add_argument('--output', help="write the result to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    result['failures'] = check(result, load_json(args.thresholds), load_json(args.baseline), args.tolerance)
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fptr:
+            fptr.write(output + "\n")
+    else:
+        print(output)
+    for failure in result['failures']:
+        print("FAIL %s" % failure, file=sys.stderr)
+    return 1 if result['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,26 +7,132 @@ from kalliope.core.Cortex import Cortex
 from kalliope import Utils
 
 import os
+import re
+import errno
+import asyncio
 import sys
-import cgi
+import ctypes
+import ctypes.util
+import select
+import selectors
+import struct
+import uuid
+import stat
+import socket
+import shutil
+import gzip
+import zlib
 import json
+import queue
+import yaml
 import time
 import fnmatch
+import bisect
+import hashlib
 import mimetypes
+import posixpath
+import tempfile
+import tarfile
+import zipfile
 import threading
 import socketserver
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from string import Template
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesHeaderParser
+from email.utils import formatdate, parsedate_to_datetime
 from http.server import BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs, unquote
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
 WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
 IGNORE_PATTERN = []
+IGNORE_MATCHER = None
 DIRSFIRST = False
 HIDEHIDDEN = False
 PAGE_TITLE = None
 BASEDIR = "."
 
+ASSET_DIR = "extras"
+ASSET_EXTENSIONS = ('.css', '.eot', '.ttf', '.woff', '.woff2', '.js')
+COMPRESS_EXTENSIONS = ('.css', '.eot', '.ttf', '.js', '.html')
+INDEX_KEY = "index.html"
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+SEARCH_INDEX_FILE = os.path.join(WORKING_DIR, ".search_index")
+SEARCH_MAX_FILE_SIZE = 1048576
+SEARCH_MAX_FILES = 20000
+SEARCH_INDEX_VERSION = 2
+ENGINES = ('threading', 'asyncio')
+CHUNK_SIZE = 65536
+COPY_CHUNK_SIZE = 8388608
+UPLOAD_EXPIRE = 86400
+JOB_EXPIRE = 3600
+JOB_WAIT = 0.5
+# ioctl cloning a whole file on copy-on-write file systems (btrfs, xfs).
+FICLONE = 0x40049409
+# copy_file_range and sendfile errors for files they cannot copy, the next method is tried.
+COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY,
+                        errno.ENOTSOCK)
+TREE_MAX_DEPTH = 16
+TREE_MAX_ENTRIES = 5000
+TREE_TIME_BUDGET = 0.5
+LINE_INDEX_STEP = 65536
+LINE_INDEX_FILES = 16
+FILE_WINDOW_MAX_LINES = 10000
+EVENT_DEBOUNCE = 0.2
+EVENT_MAX_DELAY = 1.0
+EVENT_KEEPALIVE = 15
+EVENT_POLL_INTERVAL = 2
+API_ROUTES = frozenset((
+    '/api/abspath', '/api/archive', '/api/batch', '/api/brain', '/api/brain/apply', '/api/copy', '/api/delete',
+    '/api/download', '/api/events', '/api/events/subscribe', '/api/file', '/api/job/cancel', '/api/job/status',
+    '/api/listdir', '/api/metrics', '/api/move', '/api/newfile', '/api/newfolder', '/api/parent', '/api/rename',
+    '/api/save', '/api/search', '/api/tree', '/api/upload', '/api/upload/cancel', '/api/upload/chunk',
+    '/api/upload/start', '/api/upload/status'))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_OPERATIONS = ('rename', 'move', 'copy', 'delete', 'rmtree', 'mkdir')
+ARCHIVE_FORMATS = {'zip': ('application/zip', '.zip'), 'tar.gz': ('application/gzip', '.tar.gz')}
+IO_TIMEOUT = 60
+DRAIN_TIMEOUT = 30
+SAVE_LOCK = threading.Lock()
+SETTINGS_LOCK = threading.Lock()
+SERVER_PARTS = ('assets', 'uploads', 'jobs', 'search_index', 'notifier', 'brain_reloader', 'metrics')
+
+
+def read_umask():
+    """The umask of the process, read without changing it.
+
+    os.umask can only read the mask by setting another one, which would
+    apply to the files other Kalliope threads create meanwhile.
+    """
+    try:
+        with open('/proc/self/status') as fptr:
+            for line in fptr:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0o022
+
+UMASK = read_umask()
+
 class Editor(NeuronModule):
     def __init__(self, **kwargs):
         super(Editor, self).__init__(**kwargs)
@@ -38,246 +144,3360 @@ class Editor(NeuronModule):
         hide_hidden = kwargs.get('hide_hidden', False)
         page_title = kwargs.get('page_title', "Kalliope Editor")
         stop_server = kwargs.get('stop_server', False)
+        asset_cache_size = kwargs.get('asset_cache_size', 16)
+        search = kwargs.get('search', True)
+        search_refresh = kwargs.get('search_refresh', 60)
+        workers = kwargs.get('workers', 8)
+        queue_size = kwargs.get('queue_size', 32)
+        idle_timeout = kwargs.get('idle_timeout', 5)
+        engine = kwargs.get('engine', 'threading')
+        max_upload_size = kwargs.get('max_upload_size', 100)
+        events = kwargs.get('events', True)
+        brain_reload = kwargs.get('brain_reload', False)
+        metrics = kwargs.get('metrics', True)
+        slow_request_log = kwargs.get('slow_request_log', None)
+
+        if engine not in ENGINES:
+            raise MissingParameterException("[ Editor ] engine must be one of: %s" % ", ".join(ENGINES))
 
         if stop_server:
             self.stop_http_server()
             Utils.print_info("[ Editor ] Editor stopped")
         else:
-            global IGNORE_PATTERN, DIRSFIRST, HIDEHIDDEN, PAGE_TITLE
-
-            IGNORE_PATTERN = ignore_pattern
-            DIRSFIRST = dir_first
-            HIDEHIDDEN = hide_hidden
-            PAGE_TITLE = page_title
-            
-            if self.stop_http_server():
-                server = EditorThread(listen_ip, int(port))
-                server.daemon = True
-                server.start()
-                Cortex.save('EditorServerThread', server)
+            changed = update_settings(ignore_pattern, dir_first, hide_hidden, page_title)
+            thread_class = AsyncEditorThread if engine == 'asyncio' else EditorThread
+            options = {
+                'asset_cache_size': int(asset_cache_size),
+                'search_refresh': int(search_refresh) if search else None,
+                'workers': int(workers),
+                'queue_size': int(queue_size),
+                'idle_timeout': float(idle_timeout),
+                'max_upload_size': int(max_upload_size),
+                'events': bool(events),
+                'brain_reload': bool(brain_reload),
+                'metrics': bool(metrics),
+                'slow_request_log': float(slow_request_log) if slow_request_log else None,
+            }
+            self.start_http_server(thread_class, listen_ip, int(port), options, changed)
+
+    def start_http_server(self, thread_class, listen_ip, port, options, changed):
+        """Apply the options to the running server, or start a new one.
+
+        A new server is only started for another address or engine, it takes
+        over the uploads, search index and metrics of the running one, which
+        finishes its open requests in the background.
+        """
+        running_server = Cortex.get_from_key("EditorServerThread")
+        if running_server is not None and running_server.is_down:
+            running_server = None
+        if running_server is not None and type(running_server) is thread_class and \
+                running_server.listen_address == (listen_ip, port):
+            running_server.reconfigure(**options)
+            running_server.settings_changed(changed)
+            Utils.print_info("[ Editor ] Editor settings updated")
+            return
+        if running_server is None:
+            server = thread_class(listen_ip, port, **options)
+        else:
+            Utils.print_info("[ Editor ] Editor is running, moving to the new address...")
+            try:
+                server = thread_class(listen_ip, port, previous=running_server, **options)
+            except OSError:
+                # The new address overlaps the old one, which has to be given up first.
+                running_server.stop_listening()
+                try:
+                    server = thread_class(listen_ip, port, previous=running_server, **options)
+                except OSError:
+                    running_server.shutdown_server()
+                    raise
+            server.settings_changed(changed)
+        server.daemon = True
+        server.start()
+        Cortex.save('EditorServerThread', server)
+        if running_server is not None:
+            drain = threading.Thread(target=running_server.shutdown_server, name="EditorDrain")
+            drain.daemon = True
+            drain.start()
 
     def stop_http_server(self):
         running_server = Cortex.get_from_key("EditorServerThread")
-        if running_server:
+        if running_server and not running_server.is_down:
             Utils.print_info("[ Editor ] Editor is running, stopping now...")
             running_server.shutdown_server()
-            while not running_server.is_down:
-                time.sleep(0.1)
+            running_server.join()
         return True
 
 class EditorThread(threading.Thread):
-    def __init__(self, listen_ip, port):
+    def __init__(self, listen_ip, port, asset_cache_size=16, search_refresh=60,
+                 workers=8, queue_size=32, idle_timeout=5, max_upload_size=100, events=True,
+                 brain_reload=False, metrics=True, slow_request_log=None, previous=None):
         super(EditorThread, self).__init__()
         self.is_down = False
-        server_address = (listen_ip, port)
-        self.httpd = SimpleServer(server_address, RequestHandler)
+        self.handed_over = False
+        self.listen_address = (listen_ip, port)
+        self.httpd = self.create_server(self.listen_address, workers, queue_size, idle_timeout)
+        if previous is not None:
+            for name in SERVER_PARTS:
+                setattr(self.httpd, name, getattr(previous.httpd, name))
+        self.reconfigure(asset_cache_size, search_refresh, workers, queue_size, idle_timeout,
+                         max_upload_size, events, brain_reload, metrics, slow_request_log)
+        if previous is not None:
+            previous.handed_over = True
         Utils.print_info(('[ Editor ] Listening on: http://%s:%s') % (self.httpd.server_address[0], self.httpd.server_address[1]))
-        
+
+    def create_server(self, server_address, workers, queue_size, idle_timeout):
+        return SimpleServer(server_address, RequestHandler, workers, queue_size, idle_timeout)
+
+    def reconfigure(self, asset_cache_size=16, search_refresh=60, workers=8, queue_size=32, idle_timeout=5,
+                    max_upload_size=100, events=True, brain_reload=False, metrics=True, slow_request_log=None):
+        """Apply the options to the server, starting and stopping the parts switched on or off."""
+        httpd = self.httpd
+        running = self.is_alive()
+        httpd.resize(workers, queue_size)
+        httpd.idle_timeout = idle_timeout
+        if httpd.assets is None or httpd.assets.max_size != asset_cache_size * 1024 * 1024:
+            # Until the new store is loaded the static files are read from disk.
+            httpd.assets = AssetStore(asset_cache_size * 1024 * 1024)
+            if running:
+                loader = threading.Thread(target=self.load_assets, name="EditorAssets")
+                loader.daemon = True
+                loader.start()
+        if httpd.jobs is None:
+            httpd.jobs = JobManager()
+        if httpd.uploads is None:
+            httpd.uploads = UploadManager(max_upload_size * 1024 * 1024)
+        else:
+            httpd.uploads.max_size = max_upload_size * 1024 * 1024
+        if search_refresh is None:
+            search_index, httpd.search_index = httpd.search_index, None
+            if search_index is not None:
+                search_index.stop()
+        elif httpd.search_index is None:
+            httpd.search_index = SearchIndex(BASEDIR, SEARCH_INDEX_FILE, search_refresh)
+        elif httpd.search_index.refresh != search_refresh:
+            httpd.search_index.refresh = search_refresh
+            httpd.search_index.rescan()
+        if not events:
+            notifier, httpd.notifier = httpd.notifier, None
+            if notifier is not None:
+                notifier.stop()
+        elif httpd.notifier is None:
+            httpd.notifier = ChangeNotifier()
+        if not brain_reload:
+            httpd.brain_reloader = None
+        elif httpd.brain_reloader is None:
+            httpd.brain_reloader = BrainReloader()
+        if not metrics and not slow_request_log:
+            httpd.metrics = None
+        elif httpd.metrics is None:
+            httpd.metrics = Metrics(slow_request_log)
+        else:
+            httpd.metrics.slow_threshold = slow_request_log
+        if running:
+            self.start_parts()
+
+    def settings_changed(self, names):
+        """Update what depends on the module settings listed in names."""
+        if 'PAGE_TITLE' in names:
+            self.httpd.assets.render(PAGE_TITLE)
+        if self.httpd.search_index is not None and names & {'IGNORE_PATTERN', 'HIDEHIDDEN'}:
+            self.httpd.search_index.rescan()
+
+    def load_assets(self):
+        try:
+            self.httpd.assets.load(PAGE_TITLE)
+        except Exception as err:
+            Utils.print_danger("[ Editor ] Could not cache the static files, serving them from disk: %s" % err)
+
+    def start_parts(self):
+        if self.httpd.search_index is not None:
+            self.httpd.search_index.start()
+        if self.httpd.notifier is not None:
+            self.httpd.notifier.start()
+
     def run(self):
+        # The socket is already bound, early connections wait in the backlog
+        # until the assets are loaded.
+        if not self.httpd.assets.loaded:
+            self.load_assets()
+        self.start_parts()
         self.httpd.serve_forever()
 
-    def shutdown_server(self):
+    def stop_listening(self):
+        """Give up the address, the open connections are still served."""
+        self.httpd.stop_listening()
+
+    def shutdown_server(self, timeout=DRAIN_TIMEOUT):
+        """Stop the server once the open connections finished their requests.
+
+        Connections still busy after timeout seconds are closed. The parts
+        handed over to a new server keep running.
+        """
+        if not self.httpd.drain(timeout):
+            Utils.print_warning("[ Editor ] Closing connections still busy after %is" % timeout)
+        if not self.handed_over:
+            if self.httpd.search_index is not None:
+                self.httpd.search_index.stop()
+            if self.httpd.notifier is not None:
+                self.httpd.notifier.stop()
+            if self.httpd.jobs is not None:
+                self.httpd.jobs.stop(timeout)
         self.httpd.shutdown()
         self.httpd.server_close()
         self.is_down = True
 
-def is_safe_path(basedir, path, follow_symlinks=True):
-    """Check path for malicious traversal."""
-    if basedir is None:
-        return True
-    if follow_symlinks:
-        return os.path.realpath(path).startswith(basedir.encode('utf-8'))
-    return os.path.abspath(path).startswith(basedir.encode('utf-8'))
 
-def get_dircontent(path):
-    """Get content of directory."""
-    dircontent = []
-    def sorted_file_list():
-        """Sort list of files / directories."""
-        dirlist = [x for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]
-        filelist = [x for x in os.listdir(path) if not os.path.isdir(os.path.join(path, x))]
-        if HIDEHIDDEN:
-            dirlist = [x for x in dirlist if not x.startswith('.')]
-            filelist = [x for x in filelist if not x.startswith('.')]
-        if DIRSFIRST:
-            return sorted(dirlist, key=lambda x: x.lower()) + \
-                sorted(filelist, key=lambda x: x.lower())
-        return sorted(dirlist + filelist, key=lambda x: x.lower())
-
-    for elem in sorted_file_list():
-        edata = {}
-        edata['name'] = elem
-        edata['dir'] = path
-        edata['fullpath'] = os.path.abspath(os.path.join(path, elem))
-        edata['type'] = 'dir' if os.path.isdir(edata['fullpath']) else 'file'
-        try:
-            stats = os.stat(os.path.join(path, elem))
-            edata['size'] = stats.st_size
-            edata['modified'] = stats.st_mtime
-            edata['created'] = stats.st_ctime
-        except Exception:
-            edata['size'] = 0
-            edata['modified'] = 0
-            edata['created'] = 0
-
-        hidden = False
-        if IGNORE_PATTERN is not None:
-            for file_pattern in IGNORE_PATTERN:
-                if fnmatch.fnmatch(edata['name'], file_pattern):
-                    hidden = True
-
-        if not hidden:
-            dircontent.append(edata)
-    return dircontent
+class AsyncEditorThread(EditorThread):
+    """EditorThread running the AsyncServer engine."""
+
+    def create_server(self, server_address, workers, queue_size, idle_timeout):
+        return AsyncServer(server_address, RequestHandler, workers, queue_size, idle_timeout)
+
+def is_safe_path(basedir, path, follow_symlinks=True):
+    """Check path for malicious traversal."""
+    if basedir is None:
+        return True
+    if follow_symlinks:
+        return os.path.realpath(path).startswith(basedir.encode('utf-8'))
+    return os.path.abspath(path).startswith(basedir.encode('utf-8'))
+
+def compile_ignore_pattern(patterns):
+    """Compile the ignore_pattern list into a single regular expression."""
+    if not patterns:
+        return None
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns))
+
+def update_settings(ignore_pattern, dir_first, hide_hidden, page_title):
+    """Replace the file browser settings, returns the names of those which changed.
+
+    The globals are swapped in a single dict update, which other threads can
+    not interleave with, and the listings made with the old settings are
+    dropped.
+    """
+    settings = {
+        'IGNORE_PATTERN': ignore_pattern,
+        'IGNORE_MATCHER': compile_ignore_pattern(ignore_pattern),
+        'DIRSFIRST': dir_first,
+        'HIDEHIDDEN': hide_hidden,
+        'PAGE_TITLE': page_title,
+    }
+    with SETTINGS_LOCK:
+        module = globals()
+        changed = set(name for name in settings if name != 'IGNORE_MATCHER' and module[name] != settings[name])
+        module.update(settings)
+        LISTING_CACHE.invalidate()
+    return changed
+
+def is_ignored(name):
+    """Whether a file name is hidden by hide_hidden or ignore_pattern."""
+    if HIDEHIDDEN and name.startswith('.'):
+        return True
+    return IGNORE_MATCHER is not None and IGNORE_MATCHER.match(name) is not None
+
+TEMP_FILE_MATCHER = re.compile(r'\.editor-.*\.(tmp|part)$|\.upload-.*\.part$')
+
+def is_temp_file(name):
+    """Whether a file name is one of the temporary files the editor writes through."""
+    return TEMP_FILE_MATCHER.match(name) is not None
+
+
+class ListingCache(object):
+    """Directory listings, valid as long as the mtime of the directory is unchanged.
+
+    The mtime of a directory only changes when entries are added, removed or
+    renamed, so the handlers writing files invalidate the listing of the
+    parent directory themselves to keep sizes and dates current.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, mtime):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != mtime:
+                return None
+            self.entries.move_to_end(path)
+            return entry[1]
+
+    def put(self, path, mtime, listing, generation=None):
+        """Store a listing, unless the cache was cleared since generation was read."""
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[path] = (mtime, listing)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path=None):
+        """Drop the listing of one directory, or all of them."""
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+                self.generation += 1
+                return
+            path = os.path.abspath(path)
+            for key in [x for x in self.entries if os.path.abspath(x) == path]:
+                del self.entries[key]
+
+LISTING_CACHE = ListingCache()
+
+def invalidate_listing(path):
+    """Invalidate the listing of the directory containing path."""
+    LISTING_CACHE.invalidate(os.path.dirname(os.path.abspath(path)))
+
+def get_dircontent(path):
+    """Get content of directory."""
+    mtime = os.stat(path).st_mtime_ns
+    dircontent = LISTING_CACHE.get(path, mtime)
+    if dircontent is not None:
+        return dircontent
+    generation = LISTING_CACHE.generation
+
+    abspath = os.path.abspath(path)
+    dirlist = []
+    filelist = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if is_ignored(entry.name):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            edata = {}
+            edata['name'] = entry.name
+            edata['dir'] = path
+            edata['fullpath'] = os.path.join(abspath, entry.name)
+            edata['type'] = 'dir' if is_dir else 'file'
+            try:
+                stats = entry.stat()
+                edata['size'] = stats.st_size
+                edata['modified'] = stats.st_mtime
+                edata['created'] = stats.st_ctime
+            except OSError:
+                edata['size'] = 0
+                edata['modified'] = 0
+                edata['created'] = 0
+            if is_dir:
+                dirlist.append(edata)
+            else:
+                filelist.append(edata)
+
+    sort_key = lambda x: x['name'].lower()
+    if DIRSFIRST:
+        dircontent = sorted(dirlist, key=sort_key) + sorted(filelist, key=sort_key)
+    else:
+        dircontent = sorted(dirlist + filelist, key=sort_key)
+    LISTING_CACHE.put(path, mtime, dircontent, generation)
+    return dircontent
+
+def get_tree(path, depth, max_entries=TREE_MAX_ENTRIES, budget=TREE_TIME_BUDGET, offset=0):
+    """Nested content of path down to depth levels.
+
+    Directories are walked breadth first using get_dircontent. Directories
+    below depth, or left over once max_entries or the time budget (in
+    seconds) are used up, are stubs with "children": None, as are those
+    with more entries than are left. Of path itself the children are the
+    page of at most max_entries from offset, its "total" is the number of
+    all its entries. Returns the tree and whether
+    it was cut short.
+    """
+    deadline = time.monotonic() + budget
+    abspath = os.path.abspath(path)
+    root = {'name': os.path.basename(abspath), 'children': None}
+    pending = deque([(root, abspath, 0)])
+    count = 0
+    truncated = False
+    while pending:
+        node, dirpath, level = pending.popleft()
+        if level >= depth:
+            continue
+        if count >= max_entries or time.monotonic() > deadline:
+            truncated = True
+            break
+        try:
+            dircontent = get_dircontent(dirpath)
+        except OSError:
+            continue
+        if node is root:
+            root['total'] = len(dircontent)
+            dircontent = dircontent[offset:offset + max_entries]
+            truncated = offset + len(dircontent) < root['total']
+        elif count + len(dircontent) > max_entries:
+            # Too big to come along, the client pages it on its own.
+            truncated = True
+            continue
+        children = []
+        for entry in dircontent:
+            child = {'name': entry['name'], 'modified': int(entry['modified'])}
+            if entry['type'] == 'dir':
+                child['children'] = None
+                pending.append((child, entry['fullpath'], level + 1))
+            else:
+                child['size'] = entry['size']
+            children.append(child)
+        count += len(children)
+        node['children'] = children
+    return root, truncated
+
+def is_raw_file(path):
+    """Files which /api/file sends as raw data instead of text."""
+    mimetype = mimetypes.guess_type(path)[0]
+    return mimetype is not None and mimetype.split('/')[0] == 'image'
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def required_literals(pattern, flags=0):
+    """Literal strings every match of a regular expression has to contain."""
+    literals = []
+    current = []
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error:
+        return literals
+    for opcode, argument in parsed:
+        if opcode == sre_parse.BRANCH:
+            return []
+        if opcode == sre_parse.LITERAL:
+            current.append(chr(argument))
+            continue
+        if current:
+            literals.append(''.join(current))
+            current = []
+    if current:
+        literals.append(''.join(current))
+    return literals
+
+
+class SearchIndex(object):
+    """Trigram index of the text files below BASEDIR.
+
+    Every file is stored with its mtime, size and the set of (lowercased)
+    trigrams it contains; a query only reads the files which contain all
+    trigrams of the searched literal. The index is persisted to disk, built
+    in a background thread, refreshed from the file mtimes every refresh
+    seconds and updated directly by the handlers which change files.
+    """
+
+    def __init__(self, basedir, index_file, refresh=60):
+        self.basedir = os.path.abspath(basedir)
+        self.index_file = index_file
+        self.refresh = refresh
+        self.files = {}
+        self.postings = {}
+        self.lock = threading.RLock()
+        self.ready = False
+        self.dirty = False
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="EditorSearchIndex")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def rescan(self):
+        """Scan now instead of after the refresh interval."""
+        self._wake.set()
+
+    def _run(self):
+        self.load()
+        while not self._stop.is_set():
+            try:
+                self.scan()
+                self.ready = True
+                self.save()
+            except Exception as err:
+                Utils.print_danger("[ Editor ] Search index update failed: %s" % err)
+            self._wake.wait(self.refresh)
+            self._wake.clear()
+
+    def load(self):
+        """Read the saved index, a file which does not parse is ignored and
+        the index is built again by the next scan.
+
+        The file is JSON: a header with the format version, the basedir and
+        the mtime it was saved at, and every file as [mtime_ns, size,
+        trigrams or null].
+        """
+        try:
+            with open(self.index_file, 'rb') as fptr:
+                data = json.loads(fptr.read().decode('utf-8'))
+            if data['version'] != SEARCH_INDEX_VERSION or data['basedir'] != self.basedir:
+                return
+            files = {}
+            for path, (mtime, size, grams) in data['files'].items():
+                if not isinstance(mtime, int) or not isinstance(size, int):
+                    raise ValueError("Invalid entry for %s" % path)
+                if grams is not None:
+                    if not all(isinstance(x, str) for x in grams):
+                        raise ValueError("Invalid trigrams for %s" % path)
+                    grams = frozenset(grams)
+                files[path] = (mtime, size, grams)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as err:
+            Utils.print_warning("[ Editor ] Rebuilding the search index, %s is unusable: %s" % (self.index_file, err))
+            return
+        with self.lock:
+            for path, entry in files.items():
+                self._add(path, entry)
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self.lock:
+            files = {x: [entry[0], entry[1], None if entry[2] is None else sorted(entry[2])]
+                     for x, entry in self.files.items()}
+            self.dirty = False
+        data = {'version': SEARCH_INDEX_VERSION, 'basedir': self.basedir, 'mtime': time.time(), 'files': files}
+        tmpfile = "%s.%i.tmp" % (self.index_file, os.getpid())
+        try:
+            with open(tmpfile, 'w') as fptr:
+                json.dump(data, fptr, separators=(',', ':'))
+            os.replace(tmpfile, self.index_file)
+        except OSError as err:
+            Utils.print_warning("[ Editor ] Could not save the search index: %s" % err)
+
+    def scan(self, top=None):
+        """Index new and changed files below top and drop the removed ones."""
+        top = os.path.abspath(top or self.basedir)
+        seen = set()
+        for root, dirs, files in os.walk(top):
+            dirs[:] = [x for x in dirs if not is_ignored(x)]
+            if self._stop.is_set():
+                return
+            for name in files:
+                if is_ignored(name):
+                    continue
+                path = os.path.join(root, name)
+                seen.add(path)
+                if len(seen) > SEARCH_MAX_FILES:
+                    Utils.print_warning("[ Editor ] More than %i files, search index incomplete" % SEARCH_MAX_FILES)
+                    return
+                self.update_file(path)
+        with self.lock:
+            prefix = top + os.sep
+            removed = [x for x in self.files if x.startswith(prefix) and x not in seen]
+            for path in removed:
+                self._remove(path)
+
+    def update(self, path):
+        """Bring the index up to date for a changed file or directory."""
+        path = os.path.abspath(path)
+        if not (path + os.sep).startswith(self.basedir + os.sep):
+            return
+        if os.path.isdir(path):
+            self.scan(path)
+        elif os.path.isfile(path):
+            self.update_file(path)
+        else:
+            self.remove(path)
+
+    def update_file(self, path):
+        try:
+            stats = os.stat(path)
+        except OSError:
+            self.remove(path)
+            return
+        entry = self.files.get(path)
+        if entry is not None and entry[0] == stats.st_mtime_ns and entry[1] == stats.st_size:
+            return
+        # Binaries and huge files are only recorded, not indexed.
+        grams = None
+        if stats.st_size <= SEARCH_MAX_FILE_SIZE and not is_raw_file(path):
+            try:
+                with open(path, 'rb') as fptr:
+                    grams = frozenset(trigrams(fptr.read().decode('utf-8').lower()))
+            except (OSError, UnicodeDecodeError):
+                pass
+        with self.lock:
+            self._remove(path)
+            self._add(path, (stats.st_mtime_ns, stats.st_size, grams))
+
+    def remove(self, path):
+        """Drop a file, or everything below a directory, from the index."""
+        path = os.path.abspath(path)
+        with self.lock:
+            prefix = path + os.sep
+            for key in [x for x in self.files if x == path or x.startswith(prefix)]:
+                self._remove(key)
+
+    def _add(self, path, entry):
+        self.files[path] = entry
+        self.dirty = True
+        for gram in entry[2] or ():
+            postings = self.postings.get(gram)
+            if postings is None:
+                postings = self.postings[gram] = set()
+            postings.add(path)
+
+    def _remove(self, path):
+        entry = self.files.pop(path, None)
+        if entry is None:
+            return
+        self.dirty = True
+        for gram in entry[2] or ():
+            postings = self.postings.get(gram)
+            if postings is not None:
+                postings.discard(path)
+                if not postings:
+                    del self.postings[gram]
+
+    def candidates(self, literals, path=None):
+        """Text files which may contain all given literals."""
+        grams = set()
+        for literal in literals:
+            grams.update(trigrams(literal.lower()))
+        with self.lock:
+            if grams:
+                sets = sorted((self.postings.get(x, set()) for x in grams), key=len)
+                result = set(sets[0]).intersection(*sets[1:])
+            else:
+                result = set(x for x, entry in self.files.items() if entry[2] is not None)
+        if path:
+            prefix = os.path.abspath(path) + os.sep
+            result = [x for x in result if x.startswith(prefix)]
+        return sorted(result)
+
+    def search(self, query, regex=False, case_sensitive=False, path=None, limit=200):
+        """Return the matching lines as list of dicts and whether the result was truncated."""
+        flags = 0 if case_sensitive else re.IGNORECASE
+        if regex:
+            matcher = re.compile(query, flags)
+            literals = required_literals(query, flags)
+        else:
+            matcher = re.compile(re.escape(query), flags)
+            literals = [query]
+        results = []
+        for filepath in self.candidates(literals, path):
+            try:
+                with open(filepath, 'rb') as fptr:
+                    text = fptr.read().decode('utf-8')
+            except (OSError, UnicodeDecodeError):
+                continue
+            for number, line in enumerate(text.splitlines(), 1):
+                if matcher.search(line):
+                    if len(results) >= limit:
+                        return results, True
+                    results.append({'path': filepath, 'line': number, 'text': line[:500]})
+        return results, False
+
+class LineIndex(object):
+    """Where the lines of a file start, to read a window of lines from it.
+
+    A checkpoint with the number and offset of a line is kept for the first
+    line starting after every LINE_INDEX_STEP bytes, a window is read from
+    the last checkpoint before it. A file which only grew since it was
+    indexed, checked by the bytes at the start and end of the indexed part,
+    has its index extended instead of built again.
+    """
+
+    def __init__(self, stats):
+        self.lock = threading.Lock()
+        self.reset(stats)
+
+    def reset(self, stats):
+        self.key = (stats.st_dev, stats.st_ino)
+        self.mtime = None
+        self.size = 0
+        self.newlines = 0
+        self.last_line = 0
+        self.lines = [0]
+        self.offsets = [0]
+        self.head = b''
+        self.tail = b''
+
+    @property
+    def total_lines(self):
+        return self.newlines + (1 if self.size > self.last_line else 0)
+
+    def update(self, fptr, stats):
+        """Index what was appended to the open file fptr, False if it has to be built again."""
+        if (stats.st_dev, stats.st_ino) != self.key or stats.st_size < self.size:
+            return False
+        if self.mtime is not None and stats.st_size == self.size:
+            return stats.st_mtime_ns == self.mtime
+        if self.size:
+            fptr.seek(0)
+            if fptr.read(len(self.head)) != self.head:
+                return False
+            fptr.seek(self.size - len(self.tail))
+            if fptr.read(len(self.tail)) != self.tail:
+                return False
+        fptr.seek(self.size)
+        self._scan(fptr, stats.st_size)
+        self.mtime = stats.st_mtime_ns
+        return True
+
+    def _scan(self, fptr, end):
+        position = self.size
+        target = self.offsets[-1] + LINE_INDEX_STEP
+        while position < end:
+            chunk = fptr.read(min(CHUNK_SIZE, end - position))
+            if not chunk:
+                break
+            if target < position + len(chunk):
+                index = chunk.find(b'\n', max(target - position, 0))
+                if index >= 0:
+                    self.lines.append(self.newlines + chunk.count(b'\n', 0, index) + 1)
+                    self.offsets.append(position + index + 1)
+                    target = position + index + 1 + LINE_INDEX_STEP
+            count = chunk.count(b'\n')
+            if count:
+                self.newlines += count
+                self.last_line = position + chunk.rindex(b'\n') + 1
+            position += len(chunk)
+        self.size = position
+        fptr.seek(0)
+        self.head = fptr.read(min(position, 64))
+        fptr.seek(max(position - 64, 0))
+        self.tail = fptr.read(position - max(position - 64, 0))
+
+    def read(self, fptr, start, count):
+        """Read count lines of the indexed part from line start (0-based) on."""
+        checkpoint = bisect.bisect_right(self.lines, start) - 1
+        fptr.seek(self.offsets[checkpoint])
+        for _ in range(start - self.lines[checkpoint]):
+            if not fptr.readline(max(self.size - fptr.tell(), 0)):
+                return []
+        lines = []
+        while len(lines) < count and fptr.tell() < self.size:
+            lines.append(fptr.readline(self.size - fptr.tell()))
+        return lines
+
+
+class LineIndexCache(object):
+    """Line indexes of the max_files files read last."""
+
+    def __init__(self, max_files=LINE_INDEX_FILES):
+        self.max_files = max_files
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def read(self, path, fptr, start, count):
+        """Read count lines of the open file fptr from line start (0-based) on.
+
+        A negative start counts from the end. Returns the lines, the start
+        and the number of lines of the file.
+        """
+        stats = os.fstat(fptr.fileno())
+        with self.lock:
+            index = self.entries.pop(path, None)
+            if index is None:
+                index = LineIndex(stats)
+            self.entries[path] = index
+            while len(self.entries) > self.max_files:
+                self.entries.popitem(last=False)
+        with index.lock:
+            if not index.update(fptr, stats):
+                index.reset(stats)
+                index.update(fptr, stats)
+            total = index.total_lines
+            if start < 0:
+                start = max(total + start, 0)
+            return index.read(fptr, start, count), start, total
+
+LINE_INDEXES = LineIndexCache()
+
+
+class MultipartError(Exception):
+    pass
+
+
+class MultipartReader(object):
+    """Streaming parser for multipart/form-data request bodies.
+
+    Never holds more than one chunk plus the boundary in memory; the data of
+    a part is handed out in chunks by read_part().
+    """
+
+    def __init__(self, fptr, boundary, length):
+        self.fptr = fptr
+        self.remaining = length
+        self.delimiter = b'\r\n--' + boundary
+        # The body starts with the boundary line without the leading CRLF.
+        self.buffer = b'\r\n'
+        self.finished = False
+        self._skip(self.delimiter)
+        self._after_delimiter()
+
+    def _fill(self):
+        if self.remaining <= 0:
+            return False
+        data = self.fptr.read(min(CHUNK_SIZE, self.remaining))
+        if not data:
+            raise MultipartError("Request body ended unexpectedly")
+        self.remaining -= len(data)
+        self.buffer += data
+        return True
+
+    def _skip(self, marker):
+        while True:
+            index = self.buffer.find(marker)
+            if index >= 0:
+                self.buffer = self.buffer[index + len(marker):]
+                return
+            self.buffer = self.buffer[-len(marker):]
+            if not self._fill():
+                raise MultipartError("Multipart boundary not found")
+
+    def _after_delimiter(self):
+        while len(self.buffer) < 2 and self._fill():
+            pass
+        if self.buffer.startswith(b'--'):
+            self.finished = True
+        elif self.buffer.startswith(b'\r\n'):
+            self.buffer = self.buffer[2:]
+        else:
+            raise MultipartError("Malformed multipart boundary")
+
+    def next_part(self):
+        """Return the headers of the next part, or None after the last one."""
+        if self.finished:
+            return None
+        while True:
+            index = self.buffer.find(b'\r\n\r\n')
+            if index >= 0:
+                break
+            if len(self.buffer) > 16384 or not self._fill():
+                raise MultipartError("Malformed multipart headers")
+        headers = BytesHeaderParser().parsebytes(self.buffer[:index + 2])
+        self.buffer = self.buffer[index + 4:]
+        return headers
+
+    def drain(self):
+        """Read the epilogue after the closing boundary."""
+        while self.remaining > 0:
+            self.buffer = b''
+            self._fill()
+
+    def read_part(self):
+        """Yield the data of the current part in chunks."""
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                data = self.buffer[:index]
+                self.buffer = self.buffer[index + len(self.delimiter):]
+                if data:
+                    yield data
+                self._after_delimiter()
+                return
+            if len(self.buffer) > keep:
+                data = self.buffer[:-keep]
+                self.buffer = self.buffer[-keep:]
+                yield data
+            if not self._fill():
+                raise MultipartError("Multipart body ended unexpectedly")
+
+
+def write_atomic(target, chunks):
+    """Write chunks to a temporary file next to target and move it in place.
+
+    An existing target keeps its permissions, a symlink is followed.
+    Returns the size and the sha256 checksum of the written data.
+    """
+    target = os.path.realpath(target)
+    checksum = hashlib.sha256()
+    size = 0
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.editor-', suffix='.tmp')
+    try:
+        try:
+            os.chmod(tmppath, stat.S_IMODE(os.stat(target).st_mode))
+        except FileNotFoundError:
+            os.chmod(tmppath, 0o666 & ~UMASK)
+        with os.fdopen(fd, 'wb') as fptr:
+            for chunk in chunks:
+                fptr.write(chunk)
+                checksum.update(chunk)
+                size += len(chunk)
+        os.replace(tmppath, target)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+    return size, checksum.hexdigest()
+
+def content_hash(data):
+    """Hash identifying a file version for /api/save."""
+    return hashlib.sha256(data).hexdigest()
+
+def apply_edits(text, edits):
+    """Apply line based edits to text.
+
+    Every edit replaces the lines [start, end) of text by its lines, all
+    positions refer to text before any edit. Raises ValueError for edits
+    which are out of range or overlap.
+    """
+    lines = text.split('\n')
+    limit = len(lines)
+    for edit in sorted(edits, key=lambda x: (x['start'], x['end']), reverse=True):
+        start, end = int(edit['start']), int(edit['end'])
+        if not 0 <= start <= end <= limit:
+            raise ValueError("Edit out of range: %i-%i" % (start, end))
+        if not all(isinstance(x, str) for x in edit['lines']):
+            raise ValueError("Invalid edit lines")
+        lines[start:end] = edit['lines']
+        limit = start
+    return '\n'.join(lines)
+
+def upload_target(directory, filename):
+    """Path an uploaded file is written to, None if the name is not usable."""
+    filename = os.path.basename((filename or '').replace('\\', '/'))
+    if filename in ('', '.', '..') or not os.path.isdir(directory):
+        return None
+    return os.path.join(directory, filename)
+
+
+class UploadSession(object):
+    """A resumable upload, written to a part file next to its target."""
+
+    def __init__(self, target, size):
+        self.id = uuid.uuid4().hex
+        self.target = target
+        self.size = size
+        self.partfile = os.path.join(os.path.dirname(target), '.upload-%s.part' % self.id)
+        self.checksum = hashlib.sha256()
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.partfile)
+        except OSError:
+            return 0
+
+
+class UploadManager(object):
+    """Resumable uploads: a session is started, then filled chunk by chunk
+    at increasing offsets and moved to its target once complete."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def start(self, target, size):
+        self.expire()
+        session = UploadSession(target, size)
+        open(session.partfile, 'wb').close()
+        with self.lock:
+            self.sessions[session.id] = session
+        return session
+
+    def get(self, upload_id):
+        with self.lock:
+            return self.sessions.get(upload_id)
+
+    def write(self, session, offset, fptr, length):
+        """Append length bytes of fptr at offset, finishing the upload when complete.
+
+        Bytes which arrived before the connection broke are kept, the client
+        asks for the offset and continues from there.
+        """
+        with session.lock:
+            if offset != session.offset:
+                raise ValueError("Offset mismatch, upload continues at %i" % session.offset)
+            if offset + length > session.size:
+                raise ValueError("Chunk exceeds the announced size")
+            with open(session.partfile, 'ab') as part:
+                while length > 0:
+                    data = fptr.read(min(CHUNK_SIZE, length))
+                    if not data:
+                        break
+                    part.write(data)
+                    session.checksum.update(data)
+                    length -= len(data)
+            session.updated = time.time()
+            if session.offset == session.size:
+                os.replace(session.partfile, session.target)
+                with self.lock:
+                    self.sessions.pop(session.id, None)
+                return True
+        return False
+
+    def cancel(self, session):
+        with self.lock:
+            self.sessions.pop(session.id, None)
+        try:
+            os.unlink(session.partfile)
+        except OSError:
+            pass
+
+    def expire(self):
+        """Drop sessions which did not receive data for UPLOAD_EXPIRE seconds."""
+        limit = time.time() - UPLOAD_EXPIRE
+        with self.lock:
+            expired = [x for x in self.sessions.values() if x.updated < limit]
+        for session in expired:
+            self.cancel(session)
+
+def remove_path(path):
+    """Remove a file, symlink or directory tree."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+class Batch(object):
+    """The file operations of one /api/batch request.
+
+    Every operation records how to undo it. When atomic, deleted paths are
+    moved to a trash directory next to them and only removed by commit(),
+    so that rollback() can restore everything done so far.
+    """
+
+    def __init__(self, atomic=False):
+        self.atomic = atomic
+        self.undo = []
+        self.trash = {}
+        self.changed = []
+
+    @staticmethod
+    def param(operation, key):
+        value = operation.get(key)
+        if not isinstance(value, str) or not value:
+            raise ValueError("Missing parameter: %s" % key)
+        return value
+
+    def run(self, operation):
+        name = operation.get('op')
+        if name not in BATCH_OPERATIONS:
+            raise ValueError("Unknown operation: %s" % name)
+        getattr(self, 'op_' + name)(operation)
+
+    def op_rename(self, operation):
+        src = self.param(operation, 'src')
+        name = self.param(operation, 'name')
+        if name in ('.', '..') or os.sep in name or (os.altsep and os.altsep in name):
+            raise ValueError("Invalid name: %s" % name)
+        self._move(src, os.path.join(os.path.dirname(src), name))
+
+    def op_move(self, operation):
+        src = self.param(operation, 'src')
+        self._move(src, self._destination(src, self.param(operation, 'dst')))
+
+    def op_copy(self, operation):
+        src = self.param(operation, 'src')
+        dst = self._destination(src, self.param(operation, 'dst'))
+        copy_path(src, dst)
+        self.undo.append(lambda: remove_path(dst))
+        self.changed.append(dst)
+
+    def op_delete(self, operation):
+        path = self.param(operation, 'path')
+        if os.path.isdir(path) and not os.path.islink(path) and os.listdir(path):
+            raise OSError("Directory not empty: %s" % path)
+        self._remove(path)
+
+    def op_rmtree(self, operation):
+        self._remove(self.param(operation, 'path'))
+
+    def op_mkdir(self, operation):
+        path = os.path.abspath(self.param(operation, 'path'))
+        top = path
+        while not os.path.exists(os.path.dirname(top)):
+            top = os.path.dirname(top)
+        os.makedirs(path)
+        self.undo.append(lambda: shutil.rmtree(top))
+        self.changed.append(top)
+
+    @staticmethod
+    def _destination(src, dst):
+        """Operations into an existing directory keep the name of src."""
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            dst = os.path.join(dst, os.path.basename(src.rstrip(os.sep)))
+        if os.path.lexists(dst):
+            raise FileExistsError("File exists: %s" % dst)
+        return dst
+
+    def _move(self, src, dst):
+        if not os.path.lexists(src):
+            raise FileNotFoundError("No such file or directory: %s" % src)
+        if os.path.lexists(dst):
+            raise FileExistsError("File exists: %s" % dst)
+        shutil.move(src, dst)
+        self.undo.append(lambda: shutil.move(dst, src))
+        self.changed.extend((src, dst))
+
+    def _remove(self, path):
+        if not os.path.lexists(path):
+            raise FileNotFoundError("No such file or directory: %s" % path)
+        if self.atomic:
+            parent = os.path.dirname(os.path.abspath(path))
+            if parent not in self.trash:
+                self.trash[parent] = tempfile.mkdtemp(dir=parent, prefix='.editor-trash-')
+            trashed = os.path.join(self.trash[parent], str(len(self.undo)))
+            os.rename(path, trashed)
+            self.undo.append(lambda: os.rename(trashed, path))
+        else:
+            remove_path(path)
+        self.changed.append(path)
+
+    def commit(self):
+        for trash in self.trash.values():
+            shutil.rmtree(trash, ignore_errors=True)
+
+    def rollback(self):
+        """Undo all operations, returns the errors of those which could not be undone."""
+        errors = []
+        for undo in reversed(self.undo):
+            try:
+                undo()
+            except (OSError, shutil.Error) as err:
+                errors.append(str(err))
+        self.undo = []
+        self.commit()
+        return errors
+
+def copy_file(src, dst, progress=None):
+    """Copy the content of the regular file src to the new file dst.
+
+    The data is copied by the kernel where possible: a reflink sharing the
+    blocks on copy-on-write file systems, else copy_file_range, which
+    copies within the file system, else sendfile. Reading and writing is
+    the last resort. progress is called with the number of bytes of every
+    step. Returns the name of the method which copied the data.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(infd).st_size
+        if fcntl is not None and size:
+            try:
+                fcntl.ioctl(outfd, FICLONE, infd)
+            except OSError:
+                pass
+            else:
+                if progress is not None:
+                    progress(size)
+                return 'reflink'
+        methods = []
+        if hasattr(os, 'copy_file_range'):
+            methods.append(('copy_file_range', lambda count: os.copy_file_range(infd, outfd, count)))
+        if hasattr(os, 'sendfile'):
+            methods.append(('sendfile', lambda count: os.sendfile(outfd, infd, None, count)))
+        methods.append(('read', lambda count: fdst.write(fsrc.read(count))))
+        for method, copy in methods:
+            copied = 0
+            while True:
+                try:
+                    count = copy(COPY_CHUNK_SIZE)
+                except OSError as err:
+                    if copied or err.errno not in COPY_FALLBACK_ERRORS:
+                        raise
+                    break
+                if not count:
+                    return method
+                copied += count
+                if progress is not None:
+                    progress(count)
+
+def copy_path(src, dst, progress=None):
+    """Copy the file, symlink or directory tree src to the new path dst.
+
+    Files are copied with copy_file and symlinks as links, permissions and
+    times are kept. Returns the set of methods which copied the files.
+    """
+    methods = set()
+    mode = os.lstat(src).st_mode
+    if stat.S_ISLNK(mode):
+        os.symlink(os.readlink(src), dst)
+    elif stat.S_ISDIR(mode):
+        os.mkdir(dst, 0o700)
+        for name in sorted(os.listdir(src)):
+            methods |= copy_path(os.path.join(src, name), os.path.join(dst, name), progress)
+        shutil.copystat(src, dst)
+    elif stat.S_ISREG(mode):
+        methods.add(copy_file(src, dst, progress))
+        shutil.copystat(src, dst)
+    else:
+        raise shutil.SpecialFileError("Not a regular file: %s" % src)
+    return methods
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class FileJob(object):
+    """A copy or move of a file or directory tree, run in a background thread.
+
+    The copy is made at a hidden path next to dst and renamed to dst once
+    complete, so dst never holds a partial copy and a failed or cancelled
+    job leaves nothing behind. A move is a rename when src and dst are on
+    the same file system, else a copy followed by the removal of src.
+    on_done is called with the job once it finished.
+    """
+
+    def __init__(self, operation, src, dst, on_done=None):
+        self.id = uuid.uuid4().hex
+        self.operation = operation
+        self.src = src
+        self.dst = dst
+        self.on_done = on_done
+        self.partpath = os.path.join(os.path.dirname(dst), '.editor-%s.part' % self.id)
+        self.state = 'running'
+        self.error = None
+        self.methods = set()
+        self.files = None
+        self.total_bytes = None
+        self.copied_bytes = 0
+        self.started = time.time()
+        self.finished = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    @property
+    def changed(self):
+        return (self.src, self.dst) if self.operation == 'move' else (self.dst,)
+
+    def status(self):
+        return {
+            'error': self.state == 'failed',
+            'message': self.error or "%s %s" % (self.operation.capitalize(), self.state),
+            'id': self.id,
+            'operation': self.operation,
+            'src': self.src,
+            'dst': self.dst,
+            'state': self.state,
+            'methods': sorted(self.methods),
+            'files': self.files,
+            'bytes': self.copied_bytes,
+            'total_bytes': self.total_bytes,
+            'elapsed': round((self.finished or time.time()) - self.started, 3),
+        }
+
+    def cancel(self):
+        self.cancelled = True
+
+    def progress(self, count):
+        if self.cancelled:
+            raise JobCancelled()
+        self.copied_bytes += count
+
+    def run(self):
+        try:
+            if self.operation == 'move' and self._rename():
+                self.methods.add('rename')
+            else:
+                self._measure()
+                self.methods = copy_path(self.src, self.partpath, self.progress)
+                if self.cancelled:
+                    raise JobCancelled()
+                if os.path.lexists(self.dst):
+                    raise FileExistsError(errno.EEXIST, "File exists", self.dst)
+                os.rename(self.partpath, self.dst)
+                if self.operation == 'move':
+                    remove_path(self.src)
+            self.state = 'done'
+        except JobCancelled:
+            self.state = 'cancelled'
+        except (OSError, shutil.Error) as err:
+            self.state = 'failed'
+            self.error = str(err)
+        finally:
+            if os.path.lexists(self.partpath):
+                try:
+                    remove_path(self.partpath)
+                except OSError as err:
+                    Utils.print_warning("[ Editor ] Could not remove %s: %s" % (self.partpath, err))
+            self.finished = time.time()
+            if self.on_done is not None:
+                self.on_done(self)
+            self.done.set()
+
+    def _rename(self):
+        """Move src by renaming it, False when dst is on another file system."""
+        if os.path.lexists(self.dst):
+            raise FileExistsError(errno.EEXIST, "File exists", self.dst)
+        try:
+            os.rename(self.src, self.dst)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            return False
+        return True
+
+    def _measure(self):
+        """Count the files and bytes to copy, for the progress."""
+        files = 0
+        size = 0
+        if os.path.isdir(self.src) and not os.path.islink(self.src):
+            paths = (os.path.join(root, name) for root, _, names in os.walk(self.src) for name in names)
+        else:
+            paths = (self.src,)
+        for path in paths:
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                files += 1
+                size += st.st_size
+        self.files = files
+        self.total_bytes = size
+
+
+class JobManager(object):
+    """The copy and move jobs, finished jobs are kept JOB_EXPIRE seconds
+    for their status."""
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def start(self, operation, src, dst, on_done=None):
+        self.expire()
+        job = FileJob(operation, src, dst, on_done)
+        with self.lock:
+            self.jobs[job.id] = job
+        thread = threading.Thread(target=job.run, name="EditorJob")
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def expire(self):
+        limit = time.time() - JOB_EXPIRE
+        with self.lock:
+            for job in [x for x in self.jobs.values() if x.finished is not None and x.finished < limit]:
+                del self.jobs[job.id]
+
+    def stop(self, timeout):
+        """Cancel the running jobs and wait up to timeout seconds for them."""
+        with self.lock:
+            running = [x for x in self.jobs.values() if not x.done.is_set()]
+        deadline = time.time() + timeout
+        for job in running:
+            job.cancel()
+        for job in running:
+            job.done.wait(max(0, deadline - time.time()))
+
+
+class ChunkedWriter(object):
+    """File object sending what is written in the chunked transfer coding.
+
+    Writes are collected to chunks of CHUNK_SIZE bytes, close sends the
+    last chunk. Without chunked, the data is written as it is, for clients
+    which read until the connection is closed.
+    """
+
+    def __init__(self, wfile, chunked=True):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.buffer = bytearray()
+        self.size = 0
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.chunked:
+            self.wfile.write(b'%x\r\n' % len(self.buffer) + self.buffer + b'\r\n')
+        else:
+            self.wfile.write(self.buffer)
+        self.size += len(self.buffer)
+        self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+
+class BodyReader(object):
+    """File object reading the length bytes of a request body."""
+
+    def __init__(self, fptr, length):
+        self.fptr = fptr
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fptr.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+
+def archive_entries(path):
+    """(name in the archive, path) of a directory and everything below it.
+
+    Names start with the name of the directory, entries hidden by
+    hide_hidden or ignore_pattern are left out and symlinked directories are
+    not followed.
+    """
+    path = os.path.abspath(path)
+    top = os.path.basename(path) or 'archive'
+    yield top, path
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(x for x in dirs if not is_ignored(x))
+        prefix = posixpath.join(top, os.path.relpath(root, path).replace(os.sep, '/')) if root != path else top
+        for name in dirs + sorted(x for x in files if not is_ignored(x)):
+            yield posixpath.join(prefix, name), os.path.join(root, name)
+
+class ArchiveWriter(object):
+    """File object passing what is written on to fptr until an error.
+
+    Used as a context manager around the writing of the entries: an
+    exception cuts the stream off, so closing the archive does not end a
+    broken entry with a valid looking index.
+    """
+
+    def __init__(self, fptr):
+        self.fptr = fptr
+        self.cut_off = False
+
+    def write(self, data):
+        if not self.cut_off:
+            self.fptr.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.cut_off = True
+
+
+def write_archive(path, archive_format, fptr):
+    """Write the directory path as zip or tar.gz to the unseekable file object fptr.
+
+    The archive is written as it is read. Files which can not be opened are
+    left out, an error once the header of a file is written stops the
+    archive where it is and is raised.
+    """
+    stream = ArchiveWriter(fptr)
+    if archive_format == 'zip':
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive, stream:
+            for name, filepath in archive_entries(path):
+                try:
+                    info = zipfile.ZipInfo.from_file(filepath, name)
+                    source = None if info.is_dir() else open(filepath, 'rb')
+                except OSError as err:
+                    Utils.print_warning("[ Editor ] Left out of the archive: %s" % err)
+                    continue
+                if source is None:
+                    archive.writestr(info, b'')
+                    continue
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with source, archive.open(info, 'w') as target:
+                    shutil.copyfileobj(source, target, CHUNK_SIZE)
+    else:
+        with tarfile.open(fileobj=stream, mode='w|gz') as archive, stream:
+            for name, filepath in archive_entries(path):
+                try:
+                    info = archive.gettarinfo(filepath, name)
+                    source = open(filepath, 'rb') if info is not None and info.isreg() else None
+                except OSError as err:
+                    Utils.print_warning("[ Editor ] Left out of the archive: %s" % err)
+                    continue
+                if info is None:
+                    # Sockets and other types tar has no room for
+                    continue
+                try:
+                    archive.addfile(info, source)
+                finally:
+                    if source is not None:
+                        source.close()
+
+def archive_target(directory, name):
+    """Path an archive member is extracted to, None if it would leave directory."""
+    name = name.replace('\\', '/')
+    parts = [x for x in name.split('/') if x not in ('', '.')]
+    if not parts or name.startswith('/') or '..' in parts or ':' in parts[0]:
+        return None
+    target = os.path.join(directory, *parts)
+    root = os.path.realpath(directory)
+    if not os.path.realpath(target).startswith(root + os.sep):
+        return None
+    return target
+
+def extract_archive(fptr, archive_format, directory, overwrite=False):
+    """Extract the zip or tar.gz archive read from fptr into directory.
+
+    Only directories and regular files are extracted, each file is written
+    to a temporary file and moved in place. A tar.gz is extracted as it is
+    read, a zip is first copied to a temporary file, as its index is at
+    the end. Returns the written paths and the skipped members with the
+    reason.
+    """
+    written = []
+    skipped = []
+
+    def extract(name, is_dir, is_file, mode, opener):
+        if is_dir and not name.strip('./'):
+            return
+        target = archive_target(directory, name)
+        if target is None:
+            skipped.append({'name': name, 'reason': "Outside of the target directory"})
+        elif is_dir:
+            os.makedirs(target, exist_ok=True)
+        elif not is_file:
+            skipped.append({'name': name, 'reason': "Not a regular file"})
+        elif os.path.lexists(target) and not overwrite:
+            skipped.append({'name': name, 'reason': "Exists"})
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            write_atomic(target, read_chunks(opener))
+            if mode:
+                os.chmod(target, mode & 0o777 & ~UMASK)
+            written.append(target)
+
+    def read_chunks(opener):
+        with opener() as source:
+            while True:
+                data = source.read(CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+
+    if archive_format == 'zip':
+        with tempfile.TemporaryFile(dir=directory) as spool:
+            shutil.copyfileobj(fptr, spool, CHUNK_SIZE)
+            spool.seek(0)
+            with zipfile.ZipFile(spool) as archive:
+                for info in archive.infolist():
+                    mode = info.external_attr >> 16
+                    # Archivers not from unix leave the file type out.
+                    is_file = not info.is_dir() and (not stat.S_IFMT(mode) or stat.S_ISREG(mode))
+                    extract(info.filename, info.is_dir(), is_file,
+                            stat.S_IMODE(mode), lambda info=info: archive.open(info))
+    else:
+        with tarfile.open(fileobj=fptr, mode='r|gz') as archive:
+            for member in archive:
+                extract(member.name, member.isdir(), member.isfile(), member.mode,
+                        lambda member=member: archive.extractfile(member))
+    return written, skipped
+
+
+class InotifyWatcher(object):
+    """Watch directories with the inotify API of Linux, through ctypes."""
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+        IN_DELETE_SELF | IN_MOVE_SELF
+    HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError("inotify is not available")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}
+        self.paths = {}
+
+    def watch(self, directories):
+        """Watch exactly the given directories."""
+        for path in set(self.paths) - directories:
+            self._rm_watch(self.fd, self.paths.pop(path))
+        for path in directories - set(self.paths):
+            wd = self._add_watch(self.fd, os.fsencode(path), self.MASK)
+            if wd >= 0:
+                self.watches[wd] = path
+                self.paths[path] = wd
+
+    def read(self, timeout):
+        """Wait up to timeout seconds for changes, returns (kind, path, dest) tuples."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        moves = {}
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.HEADER.unpack_from(data, offset)
+            offset += self.HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.extend(('modify', path, None) for path in self.paths)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self.watches[wd]
+                self.paths.pop(directory, None)
+                continue
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                events.append(('delete', directory, None))
+                continue
+            path = os.path.join(directory, name)
+            if mask & self.IN_MOVED_FROM:
+                moves[cookie] = len(events)
+                events.append(('delete', path, None))
+            elif mask & self.IN_MOVED_TO:
+                if cookie in moves:
+                    index = moves.pop(cookie)
+                    events[index] = ('rename', events[index][1], path)
+                else:
+                    events.append(('create', path, None))
+            elif mask & self.IN_CREATE:
+                events.append(('create', path, None))
+            elif mask & self.IN_DELETE:
+                events.append(('delete', path, None))
+            else:
+                events.append(('modify', path, None))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Watch directories by comparing scandir snapshots, where inotify is missing."""
+
+    def __init__(self, interval=EVENT_POLL_INTERVAL):
+        self.interval = interval
+        self.snapshots = {}
+        self.last_poll = time.monotonic()
+
+    @staticmethod
+    def snapshot(path):
+        result = {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    stats = entry.stat(follow_symlinks=False)
+                    result[entry.name] = (stats.st_mtime_ns, stats.st_size)
+                except OSError:
+                    pass
+        return result
+
+    def watch(self, directories):
+        for path in set(self.snapshots) - directories:
+            del self.snapshots[path]
+        for path in directories - set(self.snapshots):
+            try:
+                self.snapshots[path] = self.snapshot(path)
+            except OSError:
+                pass
+
+    def read(self, timeout):
+        wait = self.last_poll + self.interval - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        self.last_poll = time.monotonic()
+        events = []
+        for path, old in list(self.snapshots.items()):
+            try:
+                new = self.snapshot(path)
+            except OSError:
+                del self.snapshots[path]
+                events.append(('delete', path, None))
+                continue
+            self.snapshots[path] = new
+            for name in new.keys() - old.keys():
+                events.append(('create', os.path.join(path, name), None))
+            for name in old.keys() - new.keys():
+                events.append(('delete', os.path.join(path, name), None))
+            for name in new.keys() & old.keys():
+                if new[name] != old[name]:
+                    events.append(('modify', os.path.join(path, name), None))
+        return events
+
+    def close(self):
+        pass
+
+
+class SocketEventStream(object):
+    """Event stream written to a socket by the ChangeNotifier, never blocking it."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setblocking(False)
+
+    def send(self, data):
+        # A client whose socket buffer is full is dropped, EventSource reconnects.
+        try:
+            return self.sock.send(data) == len(data)
+        except OSError:
+            return False
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class BridgeEventStream(object):
+    """Event stream written through the event loop of the AsyncServer."""
+
+    MAX_BUFFER = 1048576
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+
+    def send(self, data):
+        if self.writer.is_closing() or self.writer.transport.get_write_buffer_size() > self.MAX_BUFFER:
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+        except RuntimeError:
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.loop.call_soon_threadsafe(self.writer.close)
+        except RuntimeError:
+            pass
+
+
+class EventClient(object):
+    """A connected /api/events client and the paths it has open."""
+
+    def __init__(self, stream):
+        self.id = uuid.uuid4().hex
+        self.stream = stream
+        self.paths = set()
+
+    def wants(self, path):
+        return path in self.paths or os.path.dirname(path) in self.paths
+
+
+class ChangeNotifier(object):
+    """Push file system changes to the /api/events clients.
+
+    One thread watches the directories the clients have open (the
+    directory of a file for open files), with inotify or by polling.
+    Changes of a path are debounced until EVENT_DEBOUNCE seconds passed
+    without another one, or EVENT_MAX_DELAY seconds after the first, and
+    then sent to every client which has the path or its directory open.
+    """
+
+    def __init__(self, debounce=EVENT_DEBOUNCE, max_delay=EVENT_MAX_DELAY, watcher=None):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.watcher = watcher
+        self.clients = {}
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self.watcher is None:
+            try:
+                self.watcher = InotifyWatcher()
+            except (OSError, TypeError):
+                Utils.print_warning("[ Editor ] inotify is not available, polling for file changes")
+                self.watcher = PollingWatcher()
+        self._thread = threading.Thread(target=self._run, name="EditorNotifier")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self.lock:
+            clients, self.clients = list(self.clients.values()), {}
+        for client in clients:
+            client.stream.close()
+
+    def connect(self, stream):
+        """Register a client, it learns its id from a hello event."""
+        client = EventClient(stream)
+        with self.lock:
+            self.clients[client.id] = client
+        self.send(client, 'hello', {'id': client.id})
+        return client
+
+    def subscribe(self, client_id, paths):
+        """Replace the paths a client has open, returns False for unknown clients."""
+        with self.lock:
+            client = self.clients.get(client_id)
+            if client is None:
+                return False
+            client.paths = set(os.path.abspath(x) for x in paths)
+        self.changed.set()
+        return True
+
+    def send(self, client, event, data):
+        message = "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+        if not client.stream.send(message.encode('utf-8')):
+            self.disconnect(client)
+
+    def disconnect(self, client):
+        with self.lock:
+            self.clients.pop(client.id, None)
+        client.stream.close()
+
+    def _directories(self):
+        with self.lock:
+            paths = set().union(*[x.paths for x in self.clients.values()])
+        return set(x if os.path.isdir(x) else os.path.dirname(x) for x in paths)
+
+    def _run(self):
+        last_keepalive = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                if self.changed.is_set():
+                    self.changed.clear()
+                    self.watcher.watch(self._directories())
+                for kind, path, dest in self.watcher.read(self.debounce / 2):
+                    self._queue(kind, path, dest)
+                self._flush()
+                if time.monotonic() - last_keepalive > EVENT_KEEPALIVE:
+                    last_keepalive = time.monotonic()
+                    with self.lock:
+                        clients = list(self.clients.values())
+                    for client in clients:
+                        if not client.stream.send(b": keepalive\n\n"):
+                            self.disconnect(client)
+        finally:
+            self.watcher.close()
+
+    def _queue(self, kind, path, dest):
+        name = os.path.basename(path)
+        ignored = is_temp_file(name) or is_ignored(name)
+        if kind == 'rename':
+            # Files written through a temporary file, as write_atomic does
+            if ignored:
+                kind, path, dest = 'create', dest, None
+            elif is_temp_file(os.path.basename(dest)) or is_ignored(os.path.basename(dest)):
+                kind, dest = 'delete', None
+        elif ignored:
+            return
+        now = time.monotonic()
+        key = (path, dest) if kind == 'rename' else path
+        first, _, previous = self.pending.pop(key, (now, now, None))
+        if previous == 'create' and kind == 'modify':
+            kind = 'create'
+        elif previous == 'create' and kind == 'delete':
+            return
+        elif previous == 'delete' and kind == 'create':
+            kind = 'modify'
+        self.pending[key] = (first, now, kind)
+
+    def _flush(self):
+        now = time.monotonic()
+        ready = []
+        for key, (first, last, kind) in list(self.pending.items()):
+            if now - last >= self.debounce or now - first >= self.max_delay:
+                del self.pending[key]
+                if kind == 'rename':
+                    ready.append({'type': kind, 'path': key[0], 'dest': key[1]})
+                else:
+                    ready.append({'type': kind, 'path': key, 'dest': None})
+        if not ready:
+            return
+        with self.lock:
+            clients = list(self.clients.values())
+        for client in clients:
+            for event in ready:
+                if client.wants(event['path']) or (event['dest'] and client.wants(event['dest'])):
+                    self.send(client, 'change', event)
+
+class BrainError(Exception):
+    pass
+
+
+class BrainReloader(object):
+    """Apply the brain files on disk to the brain of the running Kalliope.
+
+    Brain files are parsed once per mtime, so re-applying after an edit
+    only parses the edited files. Only synapses whose definition changed
+    are built again, they go through the same checks as at startup and
+    the brain is only touched when all of them pass.
+    """
+
+    def __init__(self):
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def parse(self, path):
+        """The entries of a brain file, cached by mtime and size."""
+        stats = os.stat(path)
+        key = (stats.st_mtime_ns, stats.st_size)
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with open(path, 'r') as fptr:
+            try:
+                entries = yaml.safe_load(fptr) or []
+            except yaml.YAMLError as err:
+                raise BrainError("%s: %s" % (path, err))
+        if not isinstance(entries, list) or not all(isinstance(x, dict) for x in entries):
+            raise BrainError("%s: a brain file has to be a list of synapses and includes" % path)
+        self.cache[path] = (key, entries)
+        return entries
+
+    def definitions(self, brain_file, seen=None):
+        """The synapse definitions of brain_file and its includes, in order."""
+        seen = set() if seen is None else seen
+        path = os.path.realpath(brain_file)
+        if path in seen:
+            raise BrainError("%s is included more than once" % brain_file)
+        seen.add(path)
+        result = []
+        for entry in self.parse(path):
+            if 'includes' in entry:
+                for include in entry['includes'] or []:
+                    result.extend(self.definitions(os.path.join(os.path.dirname(brain_file), include), seen))
+            else:
+                result.append(entry)
+        return result
+
+    def apply(self, dry_run=False):
+        """Swap changed, added and removed synapses into the running brain."""
+        result = {'error': True, 'added': [], 'changed': [], 'removed': [], 'errors': [], 'warnings': []}
+        try:
+            from kalliope.core.ConfigurationManager import BrainLoader, SettingLoader
+            from kalliope.core.ConfigurationManager.ConfigurationChecker import ConfigurationChecker
+            from kalliope.core.Models import Synapse
+        except ImportError as err:
+            result['message'] = "Brain reload is not supported by this Kalliope: %s" % err
+            return result
+        with self.lock:
+            brain = BrainLoader().brain
+            try:
+                definitions = self.definitions(brain.brain_file)
+            except (OSError, BrainError) as err:
+                result['errors'].append(str(err))
+                result['message'] = "Could not read the brain"
+                return result
+            old = dict((x['name'], x) for x in brain.brain_yaml or [] if isinstance(x, dict) and 'name' in x)
+            live = dict((x.name, x) for x in brain.synapses)
+            settings = SettingLoader().settings
+            synapses = []
+            for definition in definitions:
+                name = definition.get('name')
+                if name in old and old[name] == definition and name in live:
+                    synapses.append(live[name])
+                    continue
+                try:
+                    ConfigurationChecker.check_synape_dict(definition)
+                    synapse = Synapse(name=name,
+                                      neurons=BrainLoader.get_neurons(definition['neurons'], settings),
+                                      signals=BrainLoader.get_signals(definition['signals']))
+                    if 'enabled' in definition:
+                        synapse.enabled = bool(definition['enabled'])
+                except Exception as err:
+                    # Kalliope reports invalid brains with many exception types
+                    result['errors'].append("Synapse %s: %s: %s" % (name, type(err).__name__, err))
+                    continue
+                result['changed' if name in live else 'added'].append(name)
+                signals = [key for signal in definition.get('signals') or [] for key in signal]
+                if any(x != 'order' for x in signals):
+                    result['warnings'].append("Synapse %s: signals other than order take effect "
+                                              "after a restart of Kalliope" % name)
+                synapses.append(synapse)
+            if not result['errors']:
+                try:
+                    ConfigurationChecker.check_synapes(synapses)
+                except Exception as err:
+                    result['errors'].append("%s: %s" % (type(err).__name__, err))
+            names = set(x.name for x in synapses)
+            result['removed'] = [x for x in live if x not in names]
+            if result['errors']:
+                result['message'] = "The brain has errors, the running brain was not changed"
+                return result
+            result['error'] = False
+            if dry_run:
+                result['message'] = "The brain is valid"
+            else:
+                brain.synapses = synapses
+                brain.brain_yaml = definitions
+                result['message'] = "Brain applied: %i added, %i changed, %i removed" % (
+                    len(result['added']), len(result['changed']), len(result['removed']))
+        return result
+
+def route_label(path):
+    """Metrics label of a request path, limited to the known routes."""
+    index = path.find('/api/')
+    if index >= 0:
+        route = path[index:]
+        return route if route in API_ROUTES else 'other'
+    if path.endswith('/') or path.endswith(ASSET_EXTENSIONS):
+        return 'static'
+    return 'other'
+
+
+class RouteMetrics(object):
+    __slots__ = ('codes', 'buckets', 'duration', 'count', 'bytes', 'errors', 'cpu', 'phases')
+
+    def __init__(self):
+        self.codes = {}
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.duration = 0.0
+        self.count = 0
+        self.bytes = 0
+        self.errors = 0
+        self.cpu = 0.0
+        self.phases = {}
+
+
+class Metrics(object):
+    """Request metrics of the editor, exported in the Prometheus text format.
+
+    Recording a request takes a lock and a few additions. Requests slower
+    than slow_threshold seconds are logged with their timing breakdown.
+    """
+
+    def __init__(self, slow_threshold=None):
+        self.slow_threshold = slow_threshold
+        self.routes = {}
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def observe(self, route, method, code, duration, size, cpu, phases, failed):
+        with self.lock:
+            self.in_flight -= 1
+            metrics = self.routes.get(route)
+            if metrics is None:
+                metrics = self.routes[route] = RouteMetrics()
+            key = (method, code)
+            metrics.codes[key] = metrics.codes.get(key, 0) + 1
+            metrics.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+            metrics.duration += duration
+            metrics.count += 1
+            metrics.bytes += size
+            metrics.cpu += cpu
+            if failed or code >= 500:
+                metrics.errors += 1
+            for phase, spent in phases.items():
+                metrics.phases[phase] = metrics.phases.get(phase, 0.0) + spent
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            Utils.print_warning("[ Editor ] Slow request: %s %s %i %.3fs (cpu %.3fs%s) %i bytes" % (
+                method, route, code, duration, cpu,
+                "".join(", %s %.3fs" % x for x in sorted(phases.items())), size))
+
+    def export(self, server):
+        """The metrics in the Prometheus text format."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            """Samples are (suffix, labels, value), the suffix is appended to name."""
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                label = ",".join('%s="%s"' % x for x in labels)
+                lines.append("%s%s%s %r" % (name, suffix, "{%s}" % label if label else "", value))
+
+        with self.lock:
+            routes = sorted(self.routes.items())
+            metric('editor_requests_total', 'counter', "Requests by route, method and status code.",
+                   [('', (('route', route), ('method', method), ('code', code)), count)
+                    for route, metrics in routes for (method, code), count in sorted(metrics.codes.items())])
+            samples = []
+            for route, metrics in routes:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), metrics.buckets):
+                    cumulative += count
+                    samples.append(('_bucket', (('route', route), ('le', str(bound))), cumulative))
+                samples.append(('_sum', (('route', route),), metrics.duration))
+                samples.append(('_count', (('route', route),), metrics.count))
+            metric('editor_request_duration_seconds', 'histogram', "Request latency.", samples)
+            metric('editor_response_bytes_total', 'counter', "Bytes of response bodies.",
+                   [('', (('route', route),), metrics.bytes) for route, metrics in routes])
+            metric('editor_request_errors_total', 'counter', "Requests failing with an exception or a 5xx status.",
+                   [('', (('route', route),), metrics.errors) for route, metrics in routes])
+            metric('editor_request_cpu_seconds_total', 'counter', "CPU time of the threads handling requests.",
+                   [('', (('route', route),), metrics.cpu) for route, metrics in routes])
+            metric('editor_request_phase_seconds_total', 'counter', "Time spent in disk I/O and serialization.",
+                   [('', (('route', route), ('phase', phase)), spent)
+                    for route, metrics in routes for phase, spent in sorted(metrics.phases.items())])
+            metric('editor_requests_in_flight', 'gauge', "Requests being handled.", [('', (), self.in_flight)])
+        metric('editor_workers', 'gauge', "Worker threads handling requests.", [('', (), server.workers)])
+        metric('editor_queued_connections', 'gauge', "Connections waiting for a worker.",
+               [('', (), server.backlog())])
+        metric('editor_threads', 'gauge', "Threads of the process.", [('', (), threading.active_count())])
+        metric('process_cpu_seconds_total', 'counter', "CPU time of the process, including Kalliope.",
+               [('', (), time.process_time())])
+        return "\n".join(lines) + "\n"
+
+def get_html():
+    """Load the HTML from file in dev-mode, otherwise embedded."""
+    with open(WORKING_DIR + "/index.html") as file:
+        return Template(file.read())
+
+def parse_accept_encoding(header):
+    """Return a dict of the content codings listed by the client and their quality."""
+    qualities = {}
+    if not header:
+        return qualities
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding] = quality
+    return qualities
+
+def encoding_quality(qualities, coding):
+    """Quality of a content coding, falling back to '*' and to identity being acceptable."""
+    if coding in qualities:
+        return qualities[coding]
+    if '*' in qualities:
+        return qualities['*']
+    return 1.0 if coding == 'identity' else 0.0
+
+def is_not_modified(headers, etags, mtime):
+    """Evaluate If-None-Match / If-Modified-Since against a resource.
+
+    Resources without a modification time (mtime None) only match by ETag.
+    """
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag in etags:
+                return True
+        return False
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since and mtime is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+        return int(mtime) <= since
+    return False
+
+def content_etag(data):
+    """Strong validator derived from the content of a response."""
+    return '"%s"' % hashlib.sha1(data).hexdigest()
+
+def file_etag(stats):
+    """Strong validator derived from inode, size and mtime."""
+    return '"%x-%x-%x"' % (stats.st_ino, stats.st_size, stats.st_mtime_ns)
+
+def parse_range(header, size):
+    """Parse a single byte range of a Range header.
+
+    Returns (start, end) with an inclusive end, None if the header should be
+    ignored (absent, malformed or multiple ranges) and False if the range
+    can not be satisfied.
+    """
+    if not header:
+        return None
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = ranges.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0 or size == 0:
+                return False
+            return max(size - suffix, 0), size - 1
+        start = int(first)
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if start < 0 or (end is not None and end < start):
+        return None
+    if start >= size:
+        return False
+    if end is None or end >= size:
+        end = size - 1
+    return start, end
+
+def if_range_matches(header, etag, mtime):
+    """Whether the validator of an If-Range header still matches the file."""
+    if header is None:
+        return True
+    header = header.strip()
+    if header.startswith('"'):
+        return header == etag
+    if header.startswith('W/'):
+        return False
+    try:
+        return parsedate_to_datetime(header).timestamp() == int(mtime)
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return False
+
+
+class Asset(object):
+    """A static file kept in memory together with its compressed variants."""
+    __slots__ = ('content_type', 'mtime', 'variants', 'etags', 'size')
+
+    def __init__(self, content, content_type, mtime, compress):
+        self.content_type = content_type
+        self.mtime = mtime
+        digest = hashlib.sha1(content).hexdigest()[:20]
+        self.variants = {'identity': content}
+        self.etags = {'identity': '"%s"' % digest}
+        if compress:
+            compressed = gzip.compress(content, 9)
+            if len(compressed) < len(content):
+                self.variants['gzip'] = compressed
+                self.etags['gzip'] = '"%s-gzip"' % digest
+            if brotli is not None:
+                compressed = brotli.compress(content, quality=9)
+                if len(compressed) < len(content):
+                    self.variants['br'] = compressed
+                    self.etags['br'] = '"%s-br"' % digest
+        self.size = sum(len(x) for x in self.variants.values())
+
+    @property
+    def version(self):
+        return self.etags['identity'].strip('"')[:8]
+
+    def select(self, accept_encoding):
+        """Return the best (encoding, body, etag) for the Accept-Encoding header.
+
+        None is returned if the client refuses every variant we have.
+        """
+        qualities = parse_accept_encoding(accept_encoding)
+        best = None
+        for encoding in ('br', 'gzip', 'identity'):
+            if encoding not in self.variants:
+                continue
+            quality = encoding_quality(qualities, encoding)
+            if quality > 0 and (best is None or quality > best[0]):
+                best = (quality, encoding)
+        if best is None:
+            return None
+        encoding = best[1]
+        return encoding, self.variants[encoding], self.etags[encoding]
+
+
+class AssetStore(object):
+    """Keep the rendered index.html and the files under extras/ in memory.
+
+    Files referenced by index.html are loaded first, the rest (mainly the ace
+    modes and themes) smallest first until max_size bytes are used. Anything
+    which does not fit is served from disk. index.html is always kept and
+    does not count against max_size.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.assets = {}
+
+    def get(self, key):
+        return self.assets.get(key)
+
+    @property
+    def loaded(self):
+        return bool(self.assets)
+
+    def render(self, page_title):
+        """Render index.html again with another page title."""
+        if not self.assets:
+            return
+        assets = dict(self.assets)
+        assets[INDEX_KEY] = self.render_index(page_title, assets)
+        self.assets = assets
+
+    def load(self, page_title):
+        start = time.time()
+        assets = {}
+        self.size = 0
+        html = get_html().template
+        referenced = re.findall(r'(?:href|src)="(%s/[^"?]+)"' % ASSET_DIR, html)
+        for key in referenced + self._candidates(referenced):
+            if key in assets:
+                continue
+            filepath = os.path.join(WORKING_DIR, key)
+            try:
+                if self.size + os.path.getsize(filepath) > self.max_size:
+                    continue
+                with open(filepath, 'rb') as fptr:
+                    content = fptr.read()
+                asset = Asset(content, mimetypes.guess_type(filepath)[0] or 'application/octet-stream',
+                              os.path.getmtime(filepath), key.endswith(COMPRESS_EXTENSIONS))
+            except OSError:
+                continue
+            if self.size + asset.size > self.max_size:
+                continue
+            assets[key] = asset
+            self.size += asset.size
+
+        assets[INDEX_KEY] = self.render_index(page_title, assets)
+        self.assets = assets
+        Utils.print_info("[ Editor ] Loaded %i assets (%.1f MB) in %.1fs" % (
+            len(assets), (self.size + assets[INDEX_KEY].size) / 1048576.0, time.time() - start))
+
+    @staticmethod
+    def render_index(page_title, assets=None):
+        """Render index.html, referencing cached assets with their version.
+
+        Only the versioned URLs are sent with an immutable Cache-Control.
+        """
+        html = get_html().template
+        if assets:
+            def versioned(match):
+                asset = assets.get(match.group(2))
+                if asset is None:
+                    return match.group(0)
+                return '%s="%s?v=%s"' % (match.group(1), match.group(2), asset.version)
+            html = re.sub(r'(href|src)="(%s/[^"?]+)"' % ASSET_DIR, versioned, html)
+        html = Template(html).safe_substitute(
+            separator="\%s" % os.sep if os.sep == "\\" else os.sep,
+            page_title=page_title)
+        return Asset(bytes(html, "utf8"), 'text/html; charset=utf-8', time.time(), bool(assets))
+
+    @staticmethod
+    def _candidates(referenced):
+        """All servable files below extras/, smallest first."""
+        files = []
+        for root, _, filenames in os.walk(os.path.join(WORKING_DIR, ASSET_DIR)):
+            for filename in filenames:
+                if filename.endswith(ASSET_EXTENSIONS):
+                    filepath = os.path.join(root, filename)
+                    key = os.path.relpath(filepath, WORKING_DIR).replace(os.sep, '/')
+                    try:
+                        files.append((os.path.getsize(filepath), key))
+                    except OSError:
+                        pass
+        return [key for _, key in sorted(files)]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Request handler."""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, with Nagle the body of small
+    # responses waits for the delayed ACK of the client.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # A request which started to arrive has to be complete within this time.
+        self.timeout = self.server.idle_timeout
+        self.kept_alive = False
+        rfile = self.server.resume(self.request)
+        BaseHTTPRequestHandler.setup(self)
+        if rfile is not None:
+            self.rfile.close()
+            self.rfile = rfile
+
+    def finish(self):
+        if not self.kept_alive:
+            BaseHTTPRequestHandler.finish(self)
+            return
+        self.wfile.flush()
+        self.wfile.close()
+
+    def log_message(self, format, *args):
+        return
+
+    def handle(self):
+        """Handle the requests of a connection as long as the next one is already there.
+
+        Otherwise a keep-alive connection goes back to the server, which
+        hands it to a worker again when its next request arrives.
+        """
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self.request_buffered():
+                self.kept_alive = True
+                self.server.keep_alive(self.connection, self.rfile)
+                return
+            self.handle_one_request()
+
+    def request_buffered(self):
+        """Whether the next request, or the end of the connection, can be read without waiting."""
+        timeout = self.connection.gettimeout()
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return True
+        finally:
+            self.connection.settimeout(timeout)
+
+    def parse_request(self):
+        self.request_start = time.perf_counter()
+        self.request_cpu = time.thread_time()
+        self.response_code = 0
+        self.response_bytes = 0
+        self.phases = {}
+        # The request is recorded where it started, even if the metrics are swapped meanwhile.
+        self.request_metrics = self.server.metrics
+        if self.request_metrics is not None:
+            self.request_metrics.start()
+        return BaseHTTPRequestHandler.parse_request(self)
+
+    def handle_one_request(self):
+        """Handle a request, recording it in the metrics of the server."""
+        self.request_start = None
+        self.must_close = False
+        failed = False
+        try:
+            BaseHTTPRequestHandler.handle_one_request(self)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if self.request_start is not None and self.request_metrics is not None:
+                self.request_metrics.observe(
+                    route_label(urlparse(self.path).path), self.command or '', self.response_code or 500,
+                    time.perf_counter() - self.request_start, self.response_bytes,
+                    time.thread_time() - self.request_cpu, self.phases, failed)
+
+    def send_response(self, code, message=None):
+        self.response_code = code
+        BaseHTTPRequestHandler.send_response(self, code, message)
+        if (self.server.draining or self.must_close) and not self.close_connection:
+            self.send_header('Connection', 'close')
+
+    def discard_body(self, length):
+        """Skip the body of a route which does not use it, so it is not read as the next request.
+
+        Bodies bigger than CHUNK_SIZE are not read, the connection is
+        closed after the response instead.
+        """
+        if length > CHUNK_SIZE:
+            self.must_close = True
+        elif length > 0:
+            self.rfile.read(length)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self.response_bytes += int(value)
+        BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+    @contextmanager
+    def timed(self, phase):
+        """Add the time spent in the block to phase of the request metrics."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = self.phases.get(phase, 0.0) + time.perf_counter() - start
+
+    def get_metrics(self):
+        """Send the metrics in the Prometheus text format."""
+        if self.server.metrics is None:
+            self.send_not_found()
+            return
+        self.send_text(self.server.metrics.export(self.server), content_type='text/plain; version=0.0.4')
+
+    def do_BLOCK(self, status=420, reason="Policy not fulfilled"):
+        """Customized do_BLOCK method."""
+        self.send_text(reason, status)
+
+    def file_changed(self, path):
+        """Update the listing cache and search index after path was changed."""
+        invalidate_listing(path)
+        if self.server.search_index is not None:
+            self.server.search_index.update(path)
+
+    def send_json(self, content, status=200, headers=None, revalidate=False):
+        """Send content as JSON.
+
+        With revalidate, the response gets an ETag of its body and the
+        client has to revalidate its copy, which is answered with 304
+        while the content stays the same.
+        """
+        with self.timed('serialize'):
+            body = bytes(json.dumps(content), "utf8")
+        if revalidate:
+            headers = dict(headers or {}, ETag=content_etag(body))
+            headers['Cache-Control'] = REVALIDATE_CACHE
+            if is_not_modified(self.headers, [headers['ETag']], None):
+                self.send_not_modified(headers)
+                return
+        self.send_response(status)
+        self.send_header('Content-type', 'text/json')
+        self.send_header('Content-Length', len(body))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_search(self, query):
+        """Search the files below BASEDIR, literally or with a regular expression."""
+        index = self.server.search_index
+        response = {'error': None, 'results': [], 'truncated': False}
+        term = query.get('q', [''])[0]
+        if index is None:
+            response['error'] = "Search is disabled"
+        elif not term:
+            response['error'] = "Missing search term"
+        else:
+            try:
+                response['results'], response['truncated'] = index.search(
+                    term,
+                    regex=query.get('regex', ['0'])[0] in ('1', 'true'),
+                    case_sensitive=query.get('case', ['0'])[0] in ('1', 'true'),
+                    path=query.get('path', [None])[0],
+                    limit=min(int(query.get('limit', ['200'])[0]), 1000))
+                response['indexing'] = not index.ready
+            except (re.error, ValueError) as err:
+                response['error'] = str(err)
+        self.send_json(response)
+
+    def send_not_found(self):
+        self.send_response(404)
+        self.send_header('Content-type', 'text/text')
+        self.send_header('Content-Length', 14)
+        self.end_headers()
+        self.wfile.write(bytes("File not found", "utf8"))
+
+    def send_asset(self, path, query):
+        """Send index.html or a file below extras/, from memory if possible."""
+        if path.endswith('/'):
+            key = INDEX_KEY
+        else:
+            key = posixpath.normpath('/' + unquote(path)).lstrip('/')
+        asset = self.server.assets.get(key)
+        if asset is None:
+            if key != INDEX_KEY:
+                self.send_static_file(key)
+                return
+            asset = AssetStore.render_index(PAGE_TITLE)
+
+        if key != INDEX_KEY and query.get('v', [None])[0] == asset.version:
+            cache_control = IMMUTABLE_CACHE
+        else:
+            cache_control = REVALIDATE_CACHE
+        selected = asset.select(self.headers.get('Accept-Encoding'))
+        if selected is None:
+            self.send_response(406)
+            self.send_header('Content-Length', 0)
+            self.end_headers()
+            return
+        encoding, body, etag = selected
+        not_modified = is_not_modified(self.headers, [etag], asset.mtime)
+        if not_modified:
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header('Content-type', asset.content_type)
+            if encoding != 'identity':
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Content-Length', len(body))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(asset.mtime, usegmt=True))
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(body)
+
+    def send_static_file(self, key):
+        """Send a file below extras/ which is not held by the asset store."""
+        root = os.path.realpath(os.path.join(WORKING_DIR, ASSET_DIR))
+        filepath = os.path.realpath(os.path.join(WORKING_DIR, key))
+        if not filepath.startswith(root + os.sep) or not os.path.isfile(filepath):
+            self.send_not_found()
+            return
+        self.send_file(filepath, mimetypes.guess_type(filepath)[0] or 'application/octet-stream',
+                       {'Cache-Control': REVALIDATE_CACHE})
+
+    def send_not_modified(self, headers):
+        self.send_response(304)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def send_text(self, content, status=200, content_type='text/text', headers=None):
+        body = bytes(content, "utf8")
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', len(body))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, filepath, content_type, headers=None):
+        """Stream a file without buffering it, honouring conditional and Range requests."""
+        with open(filepath, 'rb') as fptr:
+            stats = os.fstat(fptr.fileno())
+            size = stats.st_size
+            etag = file_etag(stats)
+            if is_not_modified(self.headers, [etag], stats.st_mtime):
+                self.send_not_modified(dict(headers or {}, ETag=etag))
+                return
+
+            byte_range = None
+            if if_range_matches(self.headers.get('If-Range'), etag, stats.st_mtime):
+                byte_range = parse_range(self.headers.get('Range'), size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%i' % size)
+                self.send_header('Content-Length', 0)
+                self.end_headers()
+                return
+            if byte_range is None:
+                start, length = 0, size
+                self.send_response(200)
+            else:
+                start, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %i-%i/%i' % (byte_range[0], byte_range[1], size))
+            self.send_header('Content-type', content_type)
+            self.send_header('Content-Length', length)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', formatdate(stats.st_mtime, usegmt=True))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.copy_file(fptr, start, length)
+
+    def copy_file(self, fptr, offset, count):
+        """Copy count bytes of fptr to the client, with sendfile where possible."""
+        if count <= 0:
+            return
+        if isinstance(self.connection, socket.socket):
+            # socket.sendfile falls back to send() if os.sendfile is unusable.
+            self.connection.sendfile(fptr, offset, count)
+            return
+        if isinstance(self.wfile, StreamBridge):
+            self.wfile.sendfile(fptr, offset, count)
+            return
+        fptr.seek(offset)
+        while count > 0:
+            chunk = fptr.read(min(65536, count))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            count -= len(chunk)
+
+    def get_file(self, query):
+        """Send the content of a file to the editor, images as raw data.
+
+        Text is sent with an ETag and answered with 304 while the file is
+        unchanged, without reading it. Files larger than max_size are
+        refused with 413, those are read in windows of lines (see
+        get_file_window) given start_line or lines.
+        """
+        content = ""
+        raw = None
+        not_modified = False
+        too_large = None
+        headers = {}
+        filename = query.get('filename', None)
+        if filename and ('start_line' in query or 'lines' in query):
+            self.get_file_window(unquote(filename[0]), query)
+            return
+        try:
+            if filename:
+                filename = unquote(filename[0]).encode('utf-8')
+                filepath = os.path.join(BASEDIR.encode('utf-8'), filename)
+                max_size = int(query['max_size'][0]) if 'max_size' in query else None
+                if os.path.isfile(filepath):
+                    mimetype = mimetypes.guess_type(filepath.decode('utf-8'))
+                    if mimetype[0] is not None and mimetype[0].split('/')[0] == 'image':
+                        raw = (filepath, mimetype[0])
+                    else:
+                        with open(filepath, 'rb') as fptr:
+                            stats = os.fstat(fptr.fileno())
+                            headers['ETag'] = file_etag(stats)
+                            headers['Cache-Control'] = REVALIDATE_CACHE
+                            if max_size is not None and stats.st_size > max_size:
+                                too_large = stats.st_size
+                            else:
+                                not_modified = is_not_modified(self.headers, [headers['ETag']], stats.st_mtime)
+                            if not not_modified and too_large is None:
+                                with self.timed('disk'):
+                                    data = fptr.read()
+                        if not not_modified and too_large is None:
+                            with self.timed('serialize'):
+                                content += data.decode('utf-8')
+                            headers['X-Content-Hash'] = content_hash(data)
+                else:
+                    content = "File not found"
+        except Exception as err:
+            content = str(err)
+            headers = {}
+            not_modified = False
+            too_large = None
+        if raw:
+            self.send_file(*raw)
+        elif too_large is not None:
+            self.send_json({'error': True, 'message': "File too large", 'size': too_large}, 413)
+        elif not_modified:
+            self.send_not_modified(headers)
+        else:
+            self.send_text(content, headers=headers)
+
+    def get_file_window(self, filename, query):
+        """Send lines of a file as JSON, without reading the rest of it.
+
+        start_line is 1-based, a negative one counts from the end; at most
+        FILE_WINDOW_MAX_LINES lines are sent. The line offsets are indexed
+        once per file (see LineIndex).
+        """
+        try:
+            start = int(query.get('start_line', ['1'])[0])
+            count = int(query.get('lines', [str(FILE_WINDOW_MAX_LINES)])[0])
+            if start == 0 or count < 0:
+                raise ValueError("start_line must not be 0, lines not negative")
+        except ValueError as err:
+            self.send_json({'error': True, 'message': str(err)}, 400)
+            return
+        filepath = os.path.join(BASEDIR, filename)
+        if not os.path.isfile(filepath):
+            self.send_json({'error': True, 'message': "File not found"}, 404)
+            return
+        try:
+            with open(filepath, 'rb') as fptr, self.timed('disk'):
+                lines, start, total = LINE_INDEXES.read(
+                    os.path.realpath(filepath), fptr, start - 1 if start > 0 else start,
+                    min(count, FILE_WINDOW_MAX_LINES))
+                size = os.fstat(fptr.fileno()).st_size
+        except OSError as err:
+            self.send_json({'error': True, 'message': str(err)}, 403 if isinstance(err, PermissionError) else 500)
+            return
+        self.send_json({
+            'error': False,
+            'filename': filename,
+            'start_line': start + 1,
+            'lines': len(lines),
+            'total_lines': total,
+            'size': size,
+            'content': b''.join(lines).decode('utf-8', 'replace'),
+        }, revalidate=True)
 
-def get_html():
-    """Load the HTML from file in dev-mode, otherwise embedded."""
-    with open(WORKING_DIR + "/index.html") as file:
-        return Template(file.read())
+    def get_download(self, query):
+        """Send a file as attachment."""
+        filename = query.get('filename', None)
+        if filename:
+            filename = unquote(filename[0]).encode('utf-8')
+            filepath = os.path.join(BASEDIR.encode('utf-8'), filename)
+            if os.path.isfile(filepath):
+                try:
+                    self.send_file(filepath, 'application/octet-stream', {
+                        'Content-Disposition': 'attachment; filename=%s' % filename.decode('utf-8').split(os.sep)[-1]})
+                except PermissionError as err:
+                    self.send_text(str(err), 403)
+                return
+        self.send_text("File not found", 404)
 
+    def archive_request(self, query):
+        """Directory and format of an /api/archive request, None after sending an error."""
+        path = unquote(query.get('path', [''])[0])
+        archive_format = query.get('format', ['zip'])[0]
+        directory = os.path.join(BASEDIR, path)
+        if archive_format not in ARCHIVE_FORMATS:
+            self.send_json({'error': True, 'message': "format must be one of: %s" % ", ".join(sorted(ARCHIVE_FORMATS))},
+                           400, {'Connection': 'close'} if self.close_connection else None)
+        elif not path or not os.path.isdir(directory):
+            self.send_json({'error': True, 'message': "Directory not found"},
+                           404, {'Connection': 'close'} if self.close_connection else None)
+        else:
+            return directory, archive_format
+        return None
 
-class RequestHandler(BaseHTTPRequestHandler):
-    """Request handler."""
-    
-    def log_message(self, format, *args):
-        return
+    def get_archive(self, query):
+        """Send a directory as zip or tar.gz, written while it is sent.
 
-    def do_BLOCK(self, status=420, reason="Policy not fulfilled"):
-        """Customized do_BLOCK method."""
-        self.send_response(status)
+        The archive is sent in the chunked transfer coding, a response
+        without the last chunk tells the client that it failed midway.
+        """
+        request = self.archive_request(query)
+        if request is None:
+            return
+        directory, archive_format = request
+        content_type, extension = ARCHIVE_FORMATS[archive_format]
+        chunked = self.request_version != 'HTTP/1.0'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Disposition', 'attachment; filename=%s%s' % (
+            os.path.basename(os.path.abspath(directory)) or 'archive', extension))
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+            self.send_header('Connection', 'close')
         self.end_headers()
-        self.wfile.write(bytes(reason, "utf8"))
+        writer = ChunkedWriter(self.wfile, chunked)
+        try:
+            with self.timed('disk'):
+                write_archive(directory, archive_format, writer)
+            writer.close()
+        except Exception as err:
+            self.close_connection = True
+            Utils.print_danger("[ Editor ] Sending the archive of %s failed: %s" % (directory, err))
+        self.response_bytes += writer.size
+
+    def post_archive(self, query, length):
+        """Extract the zip or tar.gz in the request body into the directory ?path=.
+
+        Existing files are only replaced with ?overwrite=1, members outside
+        of the directory, links and devices are skipped.
+        """
+        if self.reject_upload(length):
+            return
+        self.close_connection = True
+        request = self.archive_request(query)
+        if request is None:
+            return
+        directory, archive_format = request
+        overwrite = query.get('overwrite', ['0'])[0] in ('1', 'true')
+        body = BodyReader(self.rfile, length)
+        try:
+            with self.timed('disk'):
+                written, skipped = extract_archive(body, archive_format, directory, overwrite)
+        except (OSError, EOFError, tarfile.TarError, zipfile.BadZipFile, zlib.error) as err:
+            self.file_changed(directory)
+            self.send_json({'error': True, 'message': "Extracting the archive failed: %s" % err},
+                           400, {'Connection': 'close'})
+            return
+        for target in written:
+            self.file_changed(target)
+        # The rest of the body, after the end of a tar archive, is not needed.
+        self.close_connection = body.remaining > 0
+        self.send_json({
+            'error': False,
+            'message': "Extracted %i files" % len(written),
+            'path': os.path.abspath(directory),
+            'files': len(written),
+            'skipped': skipped,
+        }, headers={'Connection': 'close'} if self.close_connection else None)
 
     def do_GET(self):
         """Customized do_GET method."""
         req = urlparse(self.path)
         query = parse_qs(req.query)
-        self.send_response(200)
+        if req.path.endswith('/') or req.path.endswith(ASSET_EXTENSIONS):
+            self.send_asset(req.path, query)
+            return
         if req.path.endswith('/api/file'):
-            content = ""
-            filename = query.get('filename', None)
-            try:
-                if filename:
-                    is_raw = False
-                    filename = unquote(filename[0]).encode('utf-8')
-                    filepath = os.path.join(BASEDIR.encode('utf-8'), filename)
-                    if os.path.isfile(filepath):
-                        mimetype = mimetypes.guess_type(filepath.decode('utf-8'))
-                        if mimetype[0] is not None:
-                            if mimetype[0].split('/')[0] == 'image':
-                                is_raw = True
-                        if is_raw:
-                            with open(filepath, 'rb') as fptr:
-                                content = fptr.read()
-                            self.send_header('Content-type', mimetype[0])
-                        else:
-                            with open(filepath, 'rb') as fptr:
-                                content += fptr.read().decode('utf-8')
-                            self.send_header('Content-type', 'text/text')
-                    else:
-                        self.send_header('Content-type', 'text/text')
-                        content = "File not found"
-            except Exception as err:
-                self.send_header('Content-type', 'text/text')
-                content = str(err)
-            self.end_headers()
-            if is_raw:
-                self.wfile.write(content)
-            else:
-                self.wfile.write(bytes(content, "utf8"))
+            self.get_file(query)
             return
-        elif req.path.endswith('/api/download'):
-            content = ""
-            filename = query.get('filename', None)
-            try:
-                if filename:
-                    filename = unquote(filename[0]).encode('utf-8')
-                    if os.path.isfile(os.path.join(BASEDIR.encode('utf-8'), filename)):
-                        with open(os.path.join(BASEDIR.encode('utf-8'), filename), 'rb') as fptr:
-                            filecontent = fptr.read()
-                        self.send_header(
-                            'Content-Disposition',
-                            'attachment; filename=%s' % filename.decode('utf-8').split(os.sep)[-1])
-                        self.end_headers()
-                        self.wfile.write(filecontent)
-                        return
-                    content = "File not found"
-            except Exception as err:
-                content = str(err)
-            self.send_header('Content-type', 'text/text')
-            self.wfile.write(bytes(content, "utf8"))
+        if req.path.endswith('/api/download'):
+            self.get_download(query)
             return
-        elif req.path.endswith('/api/listdir'):
-            content = {'error': None}
-            self.send_header('Content-type', 'text/json')
-            self.end_headers()
-            dirpath = query.get('path', None)
-            try:
-                if dirpath:
-                    dirpath = unquote(dirpath[0]).encode('utf-8')
-                    if os.path.isdir(dirpath):
-                        activebranch = None
-                        dirty = False
-                        dircontent = get_dircontent(dirpath.decode('utf-8'))
-
-                        filedata = {
-                            'content': dircontent,
-                            'abspath': os.path.abspath(dirpath).decode('utf-8'),
-                            'parent': os.path.dirname(os.path.abspath(dirpath)).decode('utf-8'),
-                            'activebranch': activebranch,
-                            'dirty': dirty,
-                            'error': None
-                        }
-                        self.wfile.write(bytes(json.dumps(filedata), "utf8"))
-            except Exception as err:
-                content['error'] = str(err)
-                self.wfile.write(bytes(json.dumps(content), "utf8"))
+        if req.path.endswith('/api/archive'):
+            self.get_archive(query)
+            return
+        if req.path.endswith('/api/search'):
+            self.get_search(query)
+            return
+        if req.path.endswith('/api/upload/status'):
+            self.get_upload_status(query)
+            return
+        if req.path.endswith('/api/job/status'):
+            self.get_job_status(query)
             return
+        if req.path.endswith('/api/tree'):
+            self.get_tree(query)
+            return
+        if req.path.endswith('/api/events'):
+            self.get_events()
+            return
+        if req.path.endswith('/api/brain'):
+            self.get_brain()
+            return
+        if req.path.endswith('/api/metrics'):
+            self.get_metrics()
+            return
+        if req.path.endswith('/api/listdir'):
+            self.get_listdir(query)
         elif req.path.endswith('/api/abspath'):
             content = ""
-            self.send_header('Content-type', 'text/text')
-            self.end_headers()
             dirpath = query.get('path', None)
             if dirpath:
-                dirpath = unquote(dirpath[0]).encode('utf-8')
-                absp = os.path.abspath(dirpath)
+                dirpath = unquote(dirpath[0])
                 if os.path.isdir(dirpath):
-                    self.wfile.write(os.path.abspath(dirpath))
-            return
+                    content = os.path.abspath(dirpath)
+            self.send_text(content)
         elif req.path.endswith('/api/parent'):
             content = ""
-            self.send_header('Content-type', 'text/text')
-            self.end_headers()
             dirpath = query.get('path', None)
+            if dirpath:
+                dirpath = unquote(dirpath[0])
+                if os.path.isdir(dirpath):
+                    content = os.path.abspath(os.path.dirname(dirpath))
+            self.send_text(content)
+        else:
+            self.send_not_found()
+
+    def get_events(self):
+        """Start a Server-Sent Events stream of file changes.
+
+        The connection is handed over to the ChangeNotifier, the worker is
+        free again once the headers are sent.
+        """
+        notifier = self.server.notifier
+        if notifier is None:
+            self.send_not_found()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        if isinstance(self.wfile, StreamBridge):
+            stream = self.wfile.detach()
+        else:
+            stream = SocketEventStream(self.server.detach_request(self.connection))
+        notifier.connect(stream)
+
+    def post_events_subscribe(self, length):
+        """Set the paths an events client has open: {"id": ..., "paths": [...]}."""
+        notifier = self.server.notifier
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            client_id, paths = request['id'], request['paths']
+            if not isinstance(paths, list) or not all(isinstance(x, str) for x in paths):
+                raise ValueError("paths must be a list of strings")
+        except (ValueError, KeyError, TypeError) as err:
+            self.send_json({'error': True, 'message': "Invalid subscription: %s" % err}, 400)
+            return
+        if notifier is None or not notifier.subscribe(client_id, paths):
+            self.send_json({'error': True, 'message': "Unknown events client"}, 404)
+            return
+        self.send_json({'error': False, 'message': "Subscribed"})
+
+    def get_brain(self):
+        """Tell the editor whether brain changes can be applied without a restart."""
+        self.send_json({'enabled': self.server.brain_reloader is not None})
+
+    def post_brain_apply(self, query, length):
+        """Apply the brain on disk to the running Kalliope, ?dry_run=1 only checks it."""
+        self.discard_body(length)
+        reloader = self.server.brain_reloader
+        if reloader is None:
+            self.send_json({'error': True, 'message': "Brain reload is disabled"}, 404)
+            return
+        result = reloader.apply(query.get('dry_run', ['0'])[0] not in ('0', ''))
+        if result['error']:
+            self.send_json(result, 422)
+            return
+        Utils.print_info("[ Editor ] %s" % result['message'])
+        self.send_json(result)
+
+    def get_tree(self, query):
+        """Send the content of a directory and its subdirectories down to ?depth=.
+
+        The directory itself is paged with ?offset= and ?limit=, like /api/listdir.
+        """
+        dirpath = unquote(query.get('path', [''])[0])
+        if not dirpath or not os.path.isdir(dirpath):
+            self.send_json({'error': "Not a directory: %s" % dirpath}, 404)
+            return
+        try:
+            depth = min(max(int(query.get('depth', ['1'])[0]), 0), TREE_MAX_DEPTH)
+            limit = min(max(int(query.get('limit', [TREE_MAX_ENTRIES])[0]), 1), TREE_MAX_ENTRIES)
+            offset = max(int(query.get('offset', ['0'])[0]), 0)
+        except ValueError as err:
+            self.send_json({'error': str(err)}, 400)
+            return
+        with self.timed('disk'):
+            tree, truncated = get_tree(dirpath, depth, limit, offset=offset)
+        abspath = os.path.abspath(dirpath)
+        self.send_json({
+            'error': None,
+            'path': abspath,
+            'parent': os.path.dirname(abspath),
+            'tree': tree,
+            'offset': offset,
+            'total': tree.get('total', 0),
+            'truncated': truncated
+        }, revalidate=True)
+
+    def get_listdir(self, query):
+        """Send the (optionally paginated) content of a directory."""
+        content = {'error': None}
+        dirpath = query.get('path', None)
+        try:
             if dirpath:
                 dirpath = unquote(dirpath[0]).encode('utf-8')
-                absp = os.path.abspath(dirpath)
                 if os.path.isdir(dirpath):
-                    self.wfile.write(os.path.abspath(os.path.dirname(dirpath)))
+                    activebranch = None
+                    dirty = False
+                    with self.timed('disk'):
+                        dircontent = get_dircontent(dirpath.decode('utf-8'))
+                    total = len(dircontent)
+                    offset = max(int(query.get('offset', ['0'])[0]), 0)
+                    limit = query.get('limit', None)
+                    if limit:
+                        dircontent = dircontent[offset:offset + max(int(limit[0]), 0)]
+                    elif offset:
+                        dircontent = dircontent[offset:]
+
+                    content = {
+                        'content': dircontent,
+                        'total': total,
+                        'offset': offset,
+                        'abspath': os.path.abspath(dirpath).decode('utf-8'),
+                        'parent': os.path.dirname(os.path.abspath(dirpath)).decode('utf-8'),
+                        'activebranch': activebranch,
+                        'dirty': dirty,
+                        'error': None
+                    }
+        except Exception as err:
+            content = {'error': str(err)}
+        self.send_json(content, revalidate=content['error'] is None)
+
+    def post_save(self, length):
+        """Save a file from the editor.
+
+        Either the full text is sent, or the edits (see apply_edits) to the
+        version identified by base together with the crc32 of the result.
+        With base given, the save is refused with 409 when the file was
+        changed since.
+        """
+        response = {'error': True, 'message': "Generic failure"}
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=1)
+        except Exception as err:
+            response['message'] = "%s" % (str(err))
+            self.send_json(response)
+            return
+        filename = unquote(postvars.get('filename', [''])[0])
+        base = postvars.get('base', [None])[0]
+        if not filename or ('text' not in postvars and 'edits' not in postvars) or \
+                ('edits' in postvars and not base):
+            response['message'] = "Missing filename or text"
+            self.send_json(response)
+            return
+        response['file'] = filename
+        try:
+            with SAVE_LOCK, self.timed('disk'):
+                current = None
+                if base:
+                    try:
+                        with open(filename, 'rb') as fptr:
+                            current = fptr.read()
+                    except FileNotFoundError:
+                        current = b''
+                    if content_hash(current) != base:
+                        response['message'] = "File was changed since it was loaded"
+                        response['conflict'] = True
+                        response['hash'] = content_hash(current)
+                        self.send_json(response, 409)
+                        return
+                if 'edits' in postvars:
+                    text = apply_edits(current.decode('utf-8'), json.loads(postvars['edits'][0]))
+                    data = text.encode('utf-8')
+                    if zlib.crc32(data) != int(postvars.get('crc32', ['-1'])[0]):
+                        response['message'] = "Checksum mismatch after applying the edits"
+                        response['conflict'] = True
+                        response['hash'] = base
+                        self.send_json(response, 409)
+                        return
+                else:
+                    data = postvars['text'][0].encode('utf-8')
+                write_atomic(filename, [data])
+        except Exception as err:
+            response['message'] = "%s" % (str(err))
+            self.send_json(response)
             return
+        self.file_changed(filename)
+        response['error'] = False
+        response['message'] = "File saved successfully"
+        response['hash'] = content_hash(data)
+        self.send_json(response)
 
-        elif req.path.endswith('/'):
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            html = get_html().safe_substitute(
-                separator="\%s" % os.sep if os.sep == "\\" else os.sep,
-                page_title=PAGE_TITLE)
-            self.wfile.write(bytes(html, "utf8"))
-            return
-        elif req.path.endswith(('.css', '.eot', 'ttf', '.woff', 'woff2', '.js')):
-            path = WORKING_DIR + req.path
-            filepath = path.lstrip("/")
-            f = open(os.path.join('.', path), "rb")
-            mimetype, _ = mimetypes.guess_type(filepath)
-            self.send_header('Content-type', mimetype)
-            self.end_headers()
-            for s in f:
-                self.wfile.write(s)
+    def post_batch(self, length):
+        """Run a list of file operations, optionally all or nothing.
+
+        The body is a JSON object: {"operations": [{"op": "move", "src": ...,
+        "dst": ...}, ...], "atomic": false}. Every operation gets its own
+        result, with atomic set the first failure undoes all operations.
+        """
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            operations = request['operations']
+            atomic = bool(request.get('atomic', False))
+            if not isinstance(operations, list) or not all(isinstance(x, dict) for x in operations):
+                raise ValueError("operations must be a list of objects")
+        except (ValueError, KeyError, TypeError) as err:
+            self.send_json({'error': True, 'message': "Invalid batch: %s" % err}, 400)
             return
+        batch = Batch(atomic)
+        results = []
+        failed = False
+        for operation in operations:
+            result = {'op': operation.get('op'), 'error': False, 'message': "OK"}
+            if failed and atomic:
+                result.update(error=True, message="Skipped")
+            else:
+                try:
+                    batch.run(operation)
+                except (OSError, ValueError, shutil.Error) as err:
+                    failed = True
+                    result.update(error=True, message=str(err))
+            results.append(result)
+        response = {'error': failed, 'results': results, 'rolled_back': False}
+        if failed and atomic:
+            errors = batch.rollback()
+            response['rolled_back'] = True
+            response['message'] = "Batch failed and was rolled back"
+            if errors:
+                response['message'] = "Rollback incomplete: %s" % "; ".join(errors)
         else:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(bytes("File not found", "utf8"))
+            batch.commit()
+            response['message'] = "Some operations failed" if failed else "Batch successful"
+        for path in OrderedDict.fromkeys(batch.changed):
+            self.file_changed(path)
+        self.send_json(response)
+
+    def post_job(self, operation, length):
+        """Copy or move the path src to dst in a background job.
+
+        dst is the new path, or an existing directory to put src into. The
+        response is the status of the job once it finished, or 202 with its
+        status after JOB_WAIT seconds. /api/job/status?id= tells how it
+        goes on.
+        """
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=1)
+            src = unquote(postvars['src'][0])
+            dst = unquote(postvars['dst'][0])
+            if not src or not dst:
+                raise ValueError("src and dst must not be empty")
+            src = os.path.abspath(src)
+        except (ValueError, KeyError) as err:
+            self.send_json({'error': True, 'message': "Invalid request: %s" % err}, 400)
+            return
+        if not os.path.lexists(src):
+            self.send_json({'error': True, 'message': "No such file or directory: %s" % src}, 404)
+            return
+        try:
+            dst = os.path.abspath(Batch._destination(src, dst))
+        except FileExistsError as err:
+            self.send_json({'error': True, 'message': str(err)}, 409)
+            return
+        if not os.path.isdir(os.path.dirname(dst)):
+            self.send_json({'error': True, 'message': "No such directory: %s" % os.path.dirname(dst)}, 404)
+            return
+        if os.path.isdir(src) and not os.path.islink(src) and \
+                os.path.realpath(dst).startswith(os.path.join(os.path.realpath(src), '')):
+            self.send_json({'error': True, 'message': "Cannot %s a directory into itself" % operation}, 400)
+            return
+        job = self.server.jobs.start(operation, src, dst, self.job_done)
+        job.done.wait(JOB_WAIT)
+        self.send_json(job.status(), 200 if job.done.is_set() else 202)
+
+    def job_done(self, job):
+        """Update the listing cache and search index for a finished job."""
+        for path in job.changed:
+            self.file_changed(path)
+
+    def find_job(self, query):
+        """The job of ?id=, None after sending 404."""
+        job = self.server.jobs.get(query.get('id', [''])[0])
+        if job is None:
+            self.send_json({'error': True, 'message': "Unknown job"}, 404)
+        return job
+
+    def get_job_status(self, query):
+        """Send the state and progress of a copy or move job."""
+        job = self.find_job(query)
+        if job is not None:
+            self.send_json(job.status())
+
+    def post_job_cancel(self, query, length):
+        """Cancel a running copy or move job, what it copied so far is removed."""
+        self.discard_body(length)
+        job = self.find_job(query)
+        if job is not None:
+            job.cancel()
+            job.done.wait(JOB_WAIT)
+            self.send_json(job.status())
+
+    def reject_upload(self, length):
+        """Refuse a request body bigger than max_upload_size without reading it."""
+        if length <= self.server.uploads.max_size:
+            return False
+        self.close_connection = True
+        self.send_json({'error': True, 'message': "File too big: %i" % length}, 413,
+                       {'Connection': 'close'})
+        return True
+
+    def post_upload(self, length):
+        """Stream a multipart/form-data upload into its target directory.
+
+        The path field has to precede the file field, the file is written
+        to a temporary file and moved in place once complete.
+        """
+        response = {'error': True, 'message': "Generic failure"}
+        if self.reject_upload(length):
+            return
+        boundary = self.headers.get_param('boundary')
+        if not boundary:
+            self.close_connection = True
+            response['message'] = "Missing multipart boundary"
+            self.send_json(response, 400, {'Connection': 'close'})
+            return
+        try:
+            reader = MultipartReader(self.rfile, boundary.encode('latin-1'), length)
+            directory = None
+            while True:
+                headers = reader.next_part()
+                if headers is None:
+                    break
+                name = headers.get_param('name', header='content-disposition')
+                if name == 'path':
+                    directory = b''.join(reader.read_part()).decode('utf-8')
+                    continue
+                if name != 'file':
+                    for _chunk in reader.read_part():
+                        pass
+                    continue
+                target = upload_target(directory or '', headers.get_filename())
+                if target is None:
+                    raise MultipartError("Invalid upload path or filename")
+                with self.timed('disk'):
+                    size, checksum = write_atomic(target, reader.read_part())
+                self.file_changed(target)
+                response['error'] = False
+                response['message'] = "Upload successful"
+                response['path'] = target
+                response['size'] = size
+                response['sha256'] = checksum
+            reader.drain()
+            if response['error']:
+                response['message'] = "Missing file"
+        except (MultipartError, OSError) as err:
+            # The rest of the body is left unread, the connection can't be reused.
+            self.close_connection = True
+            response['message'] = str(err)
+            self.send_json(response, 400, {'Connection': 'close'})
+            return
+        self.send_json(response, 400 if response['error'] else 200)
+
+    def post_upload_start(self, length):
+        """Start a resumable upload of path/name with the given size."""
+        response = {'error': True, 'message': "Generic failure"}
+        try:
+            postvars = parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=1)
+            size = int(postvars['size'][0])
+            target = upload_target(postvars['path'][0], postvars['name'][0])
+        except (KeyError, ValueError) as err:
+            response['message'] = "Missing or invalid parameter: %s" % err
+            self.send_json(response, 400)
+            return
+        if target is None:
+            response['message'] = "Invalid upload path or filename"
+            self.send_json(response, 400)
+            return
+        if size > self.server.uploads.max_size:
+            response['message'] = "File too big: %i" % size
+            self.send_json(response, 413)
+            return
+        try:
+            session = self.server.uploads.start(target, size)
+        except OSError as err:
+            response['message'] = str(err)
+            self.send_json(response, 403)
+            return
+        response.update({'error': False, 'message': "Upload started",
+                         'id': session.id, 'offset': 0, 'size': size})
+        self.send_json(response)
+
+    def upload_session(self, query):
+        session = self.server.uploads.get(query.get('id', [''])[0])
+        if session is None:
+            self.send_json({'error': True, 'message': "Unknown upload"}, 404)
+        return session
+
+    def get_upload_status(self, query):
+        """Send the offset a resumable upload continues at."""
+        session = self.upload_session(query)
+        if session is not None:
+            self.send_json({'error': False, 'id': session.id,
+                            'offset': session.offset, 'size': session.size})
+
+    def post_upload_chunk(self, query, length):
+        """Append the request body to a resumable upload at ?offset=."""
+        if self.reject_upload(length):
+            return
+        session = self.server.uploads.get(query.get('id', [''])[0])
+        if session is None:
+            self.close_connection = True
+            self.send_json({'error': True, 'message': "Unknown upload"}, 404,
+                           {'Connection': 'close'})
+            return
+        try:
+            done = self.server.uploads.write(session, int(query.get('offset', ['0'])[0]),
+                                             self.rfile, length)
+        except (ValueError, OSError) as err:
+            self.close_connection = True
+            self.send_json({'error': True, 'message': str(err), 'offset': session.offset},
+                           409, {'Connection': 'close'})
+            return
+        response = {'error': False, 'id': session.id, 'offset': session.size if done else session.offset,
+                    'size': session.size, 'done': done}
+        if done:
+            self.file_changed(session.target)
+            response['message'] = "Upload successful"
+            response['path'] = session.target
+            response['sha256'] = session.checksum.hexdigest()
+        self.send_json(response)
+
+    def post_upload_cancel(self, query, length):
+        """Abort a resumable upload and remove its part file."""
+        self.discard_body(length)
+        session = self.upload_session(query)
+        if session is not None:
+            self.server.uploads.cancel(session)
+            self.send_json({'error': False, 'message': "Upload cancelled"})
 
     def do_POST(self):
         """Customized do_POST method."""
@@ -288,61 +3508,42 @@ class RequestHandler(BaseHTTPRequestHandler):
             "message": "Generic failure"
         }
 
-        length = int(self.headers['content-length'])
+        length = int(self.headers.get('Content-Length', 0))
         if req.path.endswith('/api/save'):
-            try:
-                postvars = parse_qs(self.rfile.read(length).decode('utf-8'),
-                                    keep_blank_values=1)
-            except Exception as err:
-                response['message'] = "%s" % (str(err))
-                postvars = {}
-            if 'filename' in postvars.keys() and 'text' in postvars.keys():
-                if postvars['filename'] and postvars['text']:
-                    try:
-                        filename = unquote(postvars['filename'][0])
-                        response['file'] = filename
-                        with open(filename, 'wb') as fptr:
-                            fptr.write(bytes(postvars['text'][0], "utf-8"))
-                        self.send_response(200)
-                        self.send_header('Content-type', 'text/json')
-                        self.end_headers()
-                        response['error'] = False
-                        response['message'] = "File saved successfully"
-                        self.wfile.write(bytes(json.dumps(response), "utf8"))
-                        return
-                    except Exception as err:
-                        response['message'] = "%s" % (str(err))
-            else:
-                response['message'] = "Missing filename or text"
+            self.post_save(length)
+            return
+        elif req.path.endswith('/api/brain/apply'):
+            self.post_brain_apply(parse_qs(req.query), length)
+            return
+        elif req.path.endswith('/api/events/subscribe'):
+            self.post_events_subscribe(length)
+            return
+        elif req.path.endswith('/api/batch'):
+            self.post_batch(length)
+            return
         elif req.path.endswith('/api/upload'):
-            if length > 104857600: #100 MB for now
-                read = 0
-                while read < length:
-                    read += len(self.rfile.read(min(66556, length - read)))
-                self.send_response(200)
-                self.send_header('Content-type', 'text/json')
-                self.end_headers()
-                response['error'] = True
-                response['message'] = "File too big: %i" % read
-                self.wfile.write(bytes(json.dumps(response), "utf8"))
-                return
-            form = cgi.FieldStorage(
-                fp=self.rfile,
-                headers=self.headers,
-                environ={
-                    'REQUEST_METHOD': 'POST',
-                    'CONTENT_TYPE': self.headers['Content-Type'],
-                })
-            filename = form['file'].filename
-            filepath = form['path'].file.read()
-            data = form['file'].file.read()
-            open("%s%s%s" % (filepath, os.sep, filename), "wb").write(data)
-            self.send_response(200)
-            self.send_header('Content-type', 'text/json')
-            self.end_headers()
-            response['error'] = False
-            response['message'] = "Upload successful"
-            self.wfile.write(bytes(json.dumps(response), "utf8"))
+            self.post_upload(length)
+            return
+        elif req.path.endswith('/api/archive'):
+            self.post_archive(parse_qs(req.query), length)
+            return
+        elif req.path.endswith('/api/copy'):
+            self.post_job('copy', length)
+            return
+        elif req.path.endswith('/api/move'):
+            self.post_job('move', length)
+            return
+        elif req.path.endswith('/api/job/cancel'):
+            self.post_job_cancel(parse_qs(req.query), length)
+            return
+        elif req.path.endswith('/api/upload/start'):
+            self.post_upload_start(length)
+            return
+        elif req.path.endswith('/api/upload/chunk'):
+            self.post_upload_chunk(parse_qs(req.query), length)
+            return
+        elif req.path.endswith('/api/upload/cancel'):
+            self.post_upload_cancel(parse_qs(req.query), length)
             return
         elif req.path.endswith('/api/rename'):
             try:
@@ -356,16 +3557,15 @@ class RequestHandler(BaseHTTPRequestHandler):
                     try:
                         src = unquote(postvars['src'][0])
                         dstfilename = unquote(postvars['dstfilename'][0])
-                        renamepath = src[:src.index(os.path.basename(src))] + dstfilename
+                        renamepath = os.path.join(os.path.dirname(src.rstrip(os.sep)), dstfilename)
                         response['path'] = renamepath
                         try:
                             os.rename(src, renamepath)
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
+                            self.file_changed(src)
+                            self.file_changed(renamepath)
                             response['error'] = False
                             response['message'] = "Rename successful"
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
+                            self.send_json(response)
                             return
                         except Exception as err:
                             response['error'] = True
@@ -392,12 +3592,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                                 os.rmdir(delpath)
                             else:
                                 os.unlink(delpath)
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
+                            self.file_changed(delpath)
                             response['error'] = False
                             response['message'] = "Deletion successful"
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
+                            self.send_json(response)
                             return
                         except Exception as err:
                             response['error'] = True
@@ -422,12 +3620,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                         response['path'] = os.path.join(basepath, name)
                         try:
                             os.makedirs(response['path'])
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
+                            self.file_changed(response['path'])
                             response['error'] = False
                             response['message'] = "Folder created"
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
+                            self.send_json(response)
                             return
                         except Exception as err:
                             response['error'] = True
@@ -450,12 +3646,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                         try:
                             with open(response['path'], 'w') as fptr:
                                 fptr.write("")
-                            self.send_response(200)
-                            self.send_header('Content-type', 'text/json')
-                            self.end_headers()
+                            self.file_changed(response['path'])
                             response['error'] = False
                             response['message'] = "File created"
-                            self.wfile.write(bytes(json.dumps(response), "utf8"))
+                            self.send_json(response)
                             return
                         except Exception as err:
                             response['error'] = True
@@ -466,15 +3660,514 @@ class RequestHandler(BaseHTTPRequestHandler):
                 response['message'] = "Missing filename or text"
         else:
             response['message'] = "Invalid method"
-        self.send_response(200)
-        self.send_header('Content-type', 'text/json')
-        self.end_headers()
-        self.wfile.write(bytes(json.dumps(response), "utf8"))
+            # The body was not read, the connection can't be reused.
+            self.send_json(response, headers={'Connection': 'close'})
+            return
+        self.send_json(response)
         return
         
-class SimpleServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+class WorkerPoolMixIn(object):
+    """Handle connections on a fixed number of worker threads.
+
+    A worker is only taken while a request is processed: new connections
+    and keep-alive connections between requests are watched by a single
+    selector thread for up to idle_timeout seconds. Connections with a
+    request to read wait in a queue of queue_size entries for a free
+    worker, connections beyond that are answered with 503 right away.
+    """
+    workers = 8
+    queue_size = 32
+    idle_timeout = 5
+    draining = False
+
+    def start_workers(self):
+        # queue_size is enforced by dispatch, the stop entries of workers do not count.
+        self._queue = queue.Queue()
+        self._retiring = 0
+        self._detached = set()
+        self._rfiles = {}
+        self._waiting = []
+        self._watching = {}
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._workers = []
+        self._started = 0
+        self._add_workers(self.workers)
+        self._selector = selectors.DefaultSelector()
+        self._wakeup, self._wakeup_sender = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        watcher = threading.Thread(target=self._watch, name="EditorIdle")
+        watcher.daemon = True
+        watcher.start()
+
+    def _add_workers(self, count):
+        for _ in range(count):
+            worker = threading.Thread(target=self._work, name="EditorWorker-%i" % self._started)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+            self._started += 1
+
+    def resize(self, workers, queue_size):
+        """Change the number of workers and the queue size of the running server."""
+        self.queue_size = queue_size
+        if workers > self.workers:
+            self._add_workers(workers - self.workers)
+        self._retire(self.workers - workers)
+        self.workers = workers
+
+    def _retire(self, count):
+        """Stop count workers once they are done with the queued connections."""
+        with self._lock:
+            self._retiring += max(count, 0)
+        for _ in range(count):
+            self._queue.put(None)
+
+    def process_request(self, request, client_address):
+        self.wait_for_request(request, client_address)
+
+    def dispatch(self, request, client_address):
+        """Queue a connection with a request to read for the next free worker."""
+        if self.backlog() < self.queue_size:
+            self._queue.put((request, client_address))
+        else:
+            try:
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n"
+                                b"Retry-After: 1\r\nConnection: close\r\n\r\n")
+            except OSError:
+                pass
+            self.drop_connection(request)
+
+    def keep_alive(self, request, rfile):
+        """Keep the connection of request open for its next request.
+
+        rfile may hold the start of the next request already, it is given
+        to the handler of that request.
+        """
+        self._rfiles[request] = rfile
+
+    def resume(self, request):
+        """The rfile kept for request, None for a new connection."""
+        return self._rfiles.pop(request, None)
+
+    def wait_for_request(self, request, client_address):
+        """Watch a connection until it can be read, without holding a worker."""
+        with self._lock:
+            if not self.draining and not self._stopped:
+                self._waiting.append((request, client_address))
+                self._wake()
+                return
+        self.drop_connection(request)
+
+    def drop_connection(self, request):
+        """Close a connection which is not in a worker."""
+        rfile = self._rfiles.pop(request, None)
+        if rfile is not None:
+            rfile.close()
+        self.shutdown_request(request)
+
+    def _wake(self):
+        try:
+            self._wakeup_sender.send(b'x')
+        except OSError:
+            # The buffer is full of wake ups already.
+            pass
+
+    def _watch(self):
+        """Selector loop handing readable connections to the workers and
+        closing those idle for longer than idle_timeout."""
+        selector = self._selector
+        deadlines = {}
+        while True:
+            with self._lock:
+                waiting, self._waiting = self._waiting, []
+                stopped = self._stopped
+                draining = self.draining
+            now = time.monotonic()
+            for request, client_address in waiting:
+                try:
+                    selector.register(request, selectors.EVENT_READ, client_address)
+                except (ValueError, OSError):
+                    self.drop_connection(request)
+                    continue
+                deadlines[request] = now + self.idle_timeout
+            if stopped or draining:
+                for request in list(deadlines):
+                    selector.unregister(request)
+                    del deadlines[request]
+                    self.drop_connection(request)
+            if stopped:
+                break
+            timeout = max(min(deadlines.values()) - now, 0) if deadlines else None
+            for key, _ in selector.select(timeout):
+                if key.fileobj is self._wakeup:
+                    try:
+                        while self._wakeup.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                selector.unregister(key.fileobj)
+                del deadlines[key.fileobj]
+                self.dispatch(key.fileobj, key.data)
+            now = time.monotonic()
+            for request in [x for x, deadline in deadlines.items() if deadline <= now]:
+                selector.unregister(request)
+                del deadlines[request]
+                self.drop_connection(request)
+        selector.close()
+        self._wakeup.close()
+        self._wakeup_sender.close()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                with self._lock:
+                    self._retiring -= 1
+                self._workers.remove(threading.current_thread())
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                rfile = self._rfiles.pop(request, None)
+                if rfile is not None:
+                    rfile.close()
+                self.handle_error(request, client_address)
+            finally:
+                if request in self._detached:
+                    self._detached.discard(request)
+                    self.close_request(request)
+                elif request in self._rfiles:
+                    self.wait_for_request(request, client_address)
+                else:
+                    self.shutdown_request(request)
+
+    def detach_request(self, request):
+        """Keep the connection of request open after its handler returned.
+
+        Returns a duplicate of the socket, owned by the caller.
+        """
+        self._detached.add(request)
+        return request.dup()
+
+    def backlog(self):
+        """Connections waiting for a free worker."""
+        with self._lock:
+            return self._queue.qsize() - self._retiring
+
+    def stop_listening(self):
+        """Stop accepting connections, the accepted ones are still served."""
+        self.shutdown()
+        self.socket.close()
+
+    def drain(self, timeout):
+        """Serve the queued connections and wait for the workers to finish.
+
+        Idle keep-alive connections are closed, the others after their
+        current request. Returns False if workers were still busy after
+        timeout seconds.
+        """
+        with self._lock:
+            self.draining = True
+            self._wake()
+        self.stop_listening()
+        deadline = time.time() + timeout
+        workers = list(self._workers)
+        self._retire(len(workers))
+        for worker in workers:
+            worker.join(max(deadline - time.time(), 0))
+        return not any(worker.is_alive() for worker in workers)
+
+    def stop_workers(self):
+        with self._lock:
+            self._stopped = True
+            self._wake()
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self.drop_connection(item[0])
+            else:
+                with self._lock:
+                    self._retiring -= 1
+        self._retire(len(self._workers))
+
+
+class SimpleServer(WorkerPoolMixIn, socketserver.TCPServer):
     """Server class."""
-    daemon_threads = True
     allow_reuse_address = True
-    def __init__(self, server_address, RequestHandlerClass):
+    assets = None
+    search_index = None
+    uploads = None
+    jobs = None
+    notifier = None
+    brain_reloader = None
+    metrics = None
+    def __init__(self, server_address, RequestHandlerClass, workers=8, queue_size=32, idle_timeout=5):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.idle_timeout = idle_timeout
+        # TCPServer calls server_close, which stops the workers, when binding fails.
+        self.start_workers()
         socketserver.TCPServer.__init__(self, server_address, RequestHandlerClass)
+
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        self.stop_workers()
+
+
+class StreamBridge(object):
+    """rfile/wfile for a RequestHandler running in an executor thread of the AsyncServer.
+
+    The request head has already been read by the event loop, everything
+    else is read from and written to the asyncio streams through the loop.
+    """
+
+    def __init__(self, loop, reader, writer, head):
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+        self.head = head
+        self.detached = False
+
+    def detach(self):
+        """Hand the connection over to an event stream, the AsyncServer leaves it open."""
+        self.detached = True
+        return BridgeEventStream(self.loop, self.writer)
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(coroutine, IO_TIMEOUT), self.loop).result()
+
+    def readline(self, limit=-1):
+        if self.head:
+            end = self.head.find(b'\n') + 1 or len(self.head)
+            if 0 <= limit < end:
+                end = limit
+            line, self.head = self.head[:end], self.head[end:]
+            return line
+        return self._call(self.reader.readline())
+
+    def read(self, size=-1):
+        data = b''
+        if self.head:
+            if size < 0:
+                data, self.head = self.head, b''
+            else:
+                data, self.head = self.head[:size], self.head[size:]
+                size -= len(data)
+        if size < 0:
+            return data + self._call(self.reader.read())
+        if size == 0:
+            return data
+        try:
+            return data + self._call(self.reader.readexactly(size))
+        except asyncio.IncompleteReadError as err:
+            return data + err.partial
+
+    def write(self, data):
+        self._call(self._write(bytes(data)))
+        return len(data)
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def sendfile(self, fptr, offset, count):
+        self._call(self.loop.sendfile(self.writer.transport, fptr, offset, count))
+
+    def flush(self):
+        pass
+
+
+class AsyncServer(object):
+    """Serve the RequestHandler routes from a single asyncio event loop.
+
+    Connections, keep-alive and reading request heads cost no thread, only
+    the handling of a request runs on one of the workers threads of an
+    executor, with its socket I/O done by the event loop. The interface
+    mirrors the parts of SimpleServer used by EditorThread.
+    """
+    allow_reuse_address = True
+    assets = None
+    search_index = None
+    uploads = None
+    jobs = None
+    notifier = None
+    brain_reloader = None
+    metrics = None
+    draining = False
+
+    def __init__(self, server_address, RequestHandlerClass, workers=8, queue_size=32, idle_timeout=5):
+        self.RequestHandlerClass = RequestHandlerClass
+        self.workers = workers
+        self.queue_size = queue_size
+        self.idle_timeout = idle_timeout
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if self.allow_reuse_address:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(server_address)
+            self.socket.listen(128)
+        except OSError:
+            self.socket.close()
+            raise
+        self.server_address = self.socket.getsockname()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.loop = None
+        self.pending = 0
+        self._server = None
+        self._writers = set()
+        self._idle = set()
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._shutdown_request = False
+        self._stopped = threading.Event()
+
+    def serve_forever(self):
+        with self._lock:
+            if self._shutdown_request:
+                self._stopped.set()
+                return
+            self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._server = self.loop.run_until_complete(asyncio.start_server(self._client, sock=self.socket))
+        try:
+            self.loop.run_forever()
+        finally:
+            self._server.close()
+            # Closing the transports lets the idle connections end by themselves,
+            # requests still running get a moment to finish.
+            for writer in self._writers:
+                writer.close()
+            tasks = asyncio.all_tasks(self.loop)
+            if tasks:
+                _, pending = self.loop.run_until_complete(asyncio.wait(tasks, timeout=1))
+                for task in pending:
+                    task.cancel()
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        with self._lock:
+            self._shutdown_request = True
+            if self.loop is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self._stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+        self.executor.shutdown(wait=False)
+
+    def resize(self, workers, queue_size):
+        """Change the number of executor threads and the queue size of the running server."""
+        if workers != self.workers:
+            executor, self.executor = self.executor, ThreadPoolExecutor(max_workers=workers)
+            executor.shutdown(wait=False)
+        self.workers = workers
+        self.queue_size = queue_size
+
+    def stop_listening(self):
+        """Stop accepting connections, the accepted ones are still served."""
+        with self._lock:
+            loop = self.loop
+        if loop is None:
+            self.socket.close()
+            return
+        asyncio.run_coroutine_threadsafe(self._stop_listening(), loop).result()
+
+    async def _stop_listening(self):
+        if self._server is not None:
+            self._server.close()
+
+    def drain(self, timeout):
+        """Close the idle connections and wait for the others to finish their request.
+
+        Returns False if connections were still busy after timeout seconds.
+        """
+        self.draining = True
+        self.stop_listening()
+        with self._lock:
+            loop = self.loop
+        if loop is None:
+            return True
+        return asyncio.run_coroutine_threadsafe(self._drain(timeout), loop).result()
+
+    async def _drain(self, timeout):
+        for writer in self._idle:
+            writer.close()
+        if not self._clients:
+            return True
+        _, pending = await asyncio.wait(list(self._clients), timeout=timeout)
+        return not pending
+
+    async def _client(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        # asyncio only disables Nagle for sockets created with IPPROTO_TCP,
+        # accepted sockets have proto 0.
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._writers.add(writer)
+        self._clients.add(asyncio.current_task())
+        try:
+            while not self.draining:
+                self._idle.add(writer)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError, ConnectionError):
+                    break
+                finally:
+                    self._idle.discard(writer)
+                if self.pending >= self.workers + self.queue_size:
+                    writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n"
+                                 b"Retry-After: 1\r\nConnection: close\r\n\r\n")
+                    await writer.drain()
+                    break
+                self.pending += 1
+                try:
+                    bridge = StreamBridge(self.loop, reader, writer, head)
+                    close = await self.loop.run_in_executor(self.executor, self._handle, bridge, client_address)
+                finally:
+                    self.pending -= 1
+                if bridge.detached:
+                    # Event stream clients send nothing more, wait for them to go away.
+                    self._idle.add(writer)
+                    while await reader.read(CHUNK_SIZE):
+                        pass
+                    break
+                if close:
+                    break
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            self._idle.discard(writer)
+            self._clients.discard(asyncio.current_task())
+            writer.close()
+
+    def backlog(self):
+        """Requests waiting for a free executor thread."""
+        return max(self.pending - self.workers, 0)
+
+    def _handle(self, bridge, client_address):
+        """Run one request through the RequestHandler, return whether to close the connection."""
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.server = self
+        handler.client_address = client_address
+        handler.request = handler.connection = None
+        handler.rfile = handler.wfile = bridge
+        handler.close_connection = True
+        try:
+            handler.handle_one_request()
+        except Exception:
+            Utils.print_danger("[ Editor ] Error handling request from %s:%s" % client_address[:2])
+            return True
+        return handler.close_connection
@@ -0,0 +1,66 @@
+import http.client
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(params=['threading', 'asyncio'])
+def engine(request):
+    """Every test using a server runs against both server engines."""
+    return request.param
+
+
+@pytest.fixture
+def make_server(engine):
+    """Factory for running editor servers on free loopback ports."""
+    editor = pytest.importorskip("editor")
+    server_class = editor.AsyncServer if engine == 'asyncio' else editor.SimpleServer
+    servers = []
+
+    def make_server(**kwargs):
+        httpd = server_class(('127.0.0.1', 0), editor.RequestHandler, **kwargs)
+        httpd.assets = editor.AssetStore(1024 * 1024)
+        httpd.assets.load("Kalliope Editor")
+        httpd.uploads = editor.UploadManager(1024 * 1024)
+        httpd.jobs = editor.JobManager()
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(httpd)
+        return httpd
+
+    yield make_server
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture
+def server(make_server):
+    """A running editor server with the default settings."""
+    return make_server()
+
+
+@pytest.fixture
+def fetch_from():
+    """Send one request to a server and return (response, body)."""
+    def fetch_from(server, path, method='GET', body=None, headers=None):
+        conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        return response, data
+    return fetch_from
+
+
+@pytest.fixture
+def fetch(server, fetch_from):
+    """Send one request to the default server and return (response, body)."""
+    def fetch(path, method='GET', body=None, headers=None):
+        return fetch_from(server, path, method, body, headers)
+    return fetch
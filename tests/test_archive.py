@@ -0,0 +1,205 @@
+import io
+import json
+import os
+import tarfile
+import zipfile
+from urllib.parse import quote
+
+import pytest
+
+pytest.importorskip("kalliope")
+editor = pytest.importorskip("editor")
+
+
+@pytest.fixture
+def brains(tmp_path):
+    root = tmp_path / 'brains'
+    (root / 'sub' / 'deeper').mkdir(parents=True)
+    (root / 'empty').mkdir()
+    (root / 'brain.yml').write_bytes(b'- name: hello\n')
+    (root / 'sub' / 'neuron.py').write_bytes(b'x' * 100000)
+    (root / 'sub' / 'neuron.pyc').write_bytes(b'compiled')
+    (root / 'sub' / 'deeper' / 'order.txt').write_bytes(b'order')
+    return root
+
+
+@pytest.fixture
+def ignore_pyc(monkeypatch):
+    monkeypatch.setattr(editor, 'IGNORE_PATTERN', ['*.pyc'])
+    monkeypatch.setattr(editor, 'IGNORE_MATCHER', editor.compile_ignore_pattern(['*.pyc']))
+
+
+def tar_gz(members):
+    """A tar.gz with (name, data) files, data None for a directory."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as archive:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                archive.addfile(info)
+            else:
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def zip_file(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return buf.getvalue()
+
+
+def extract(fetch, directory, body, archive_format='tar.gz', overwrite=False):
+    path = '/api/archive?path=%s&format=%s' % (quote(str(directory)), archive_format)
+    if overwrite:
+        path += '&overwrite=1'
+    response, data = fetch(path, 'POST', body, {'Content-Type': 'application/octet-stream'})
+    return response, json.loads(data)
+
+
+class TestExport(object):
+
+    def test_zip(self, fetch, brains, ignore_pyc):
+        response, body = fetch('/api/archive?path=%s&format=zip' % quote(str(brains)))
+        assert response.status == 200
+        assert response.getheader('Content-Type') == 'application/zip'
+        assert response.getheader('Transfer-Encoding') == 'chunked'
+        assert response.getheader('Content-Disposition') == 'attachment; filename=brains.zip'
+        archive = zipfile.ZipFile(io.BytesIO(body))
+        assert sorted(archive.namelist()) == [
+            'brains/', 'brains/brain.yml', 'brains/empty/', 'brains/sub/', 'brains/sub/deeper/',
+            'brains/sub/deeper/order.txt', 'brains/sub/neuron.py']
+        assert archive.read('brains/sub/neuron.py') == b'x' * 100000
+
+    def test_tar_gz(self, fetch, brains, ignore_pyc):
+        response, body = fetch('/api/archive?path=%s&format=tar.gz' % quote(str(brains)))
+        assert response.status == 200
+        assert response.getheader('Content-Disposition') == 'attachment; filename=brains.tar.gz'
+        archive = tarfile.open(fileobj=io.BytesIO(body), mode='r:gz')
+        assert 'brains/sub/neuron.pyc' not in archive.getnames()
+        assert archive.extractfile('brains/sub/deeper/order.txt').read() == b'order'
+        assert archive.getmember('brains/empty').isdir()
+
+    def test_bad_requests(self, fetch, brains):
+        response, body = fetch('/api/archive?path=%s&format=rar' % quote(str(brains)))
+        assert response.status == 400
+        assert json.loads(body)['error'] is True
+        response, _ = fetch('/api/archive?path=%s&format=zip' % quote(str(brains / 'brain.yml')))
+        assert response.status == 404
+
+    def test_round_trip(self, fetch, brains, tmp_path):
+        for archive_format in editor.ARCHIVE_FORMATS:
+            target = tmp_path / archive_format
+            target.mkdir()
+            _, body = fetch('/api/archive?path=%s&format=%s' % (quote(str(brains)), archive_format))
+            response, data = extract(fetch, target, body, archive_format)
+            assert response.status == 200
+            assert data['files'] == 4
+            assert (target / 'brains' / 'sub' / 'neuron.py').read_bytes() == b'x' * 100000
+            assert (target / 'brains' / 'empty').is_dir()
+
+    def test_unreadable_file_left_out(self, brains, ignore_pyc, monkeypatch):
+        def failing_open(path, mode='r'):
+            if path.endswith('brain.yml'):
+                raise PermissionError("denied: %s" % path)
+            return open(path, mode)
+        monkeypatch.setattr(editor, 'open', failing_open, raising=False)
+        for archive_format in editor.ARCHIVE_FORMATS:
+            buf = io.BytesIO()
+            editor.write_archive(str(brains), archive_format, buf)
+            buf.seek(0)
+            if archive_format == 'zip':
+                names = zipfile.ZipFile(buf).namelist()
+            else:
+                names = tarfile.open(fileobj=buf, mode='r:gz').getnames()
+            assert 'brains/sub/deeper/order.txt' in names
+            assert not [x for x in names if x.endswith('brain.yml')]
+
+    def test_error_inside_a_file_stops_the_archive(self, brains, monkeypatch):
+        class FailingFile(io.BytesIO):
+            def read(self, size=-1):
+                if self.tell():
+                    raise OSError("read error")
+                return super().read(1000)
+
+        def failing_open(path, mode='r'):
+            if path.endswith('neuron.py'):
+                return FailingFile(b'x' * 100000)
+            return open(path, mode)
+        monkeypatch.setattr(editor, 'open', failing_open, raising=False)
+        buf = io.BytesIO()
+        with pytest.raises(OSError):
+            editor.write_archive(str(brains), 'zip', buf)
+        with pytest.raises(zipfile.BadZipFile):
+            zipfile.ZipFile(io.BytesIO(buf.getvalue()))
+        buf = io.BytesIO()
+        with pytest.raises(OSError):
+            editor.write_archive(str(brains), 'tar.gz', buf)
+        with pytest.raises((tarfile.TarError, EOFError)):
+            tarfile.open(fileobj=io.BytesIO(buf.getvalue()), mode='r:gz').getnames()
+
+
+class TestImport(object):
+
+    def test_tar_gz(self, fetch, tmp_path):
+        response, data = extract(fetch, tmp_path, tar_gz([('./', None), ('a', None), ('a/b.yml', b'b')]))
+        assert response.status == 200
+        assert data == {'error': False, 'message': "Extracted 1 files", 'path': str(tmp_path),
+                        'files': 1, 'skipped': []}
+        assert (tmp_path / 'a' / 'b.yml').read_bytes() == b'b'
+
+    def test_zip(self, fetch, tmp_path):
+        response, data = extract(fetch, tmp_path, zip_file([('a/b.yml', b'b'), ('c/', b'')]), 'zip')
+        assert data['files'] == 1
+        assert (tmp_path / 'a' / 'b.yml').read_bytes() == b'b'
+        assert (tmp_path / 'c').is_dir()
+        assert sorted(os.listdir(str(tmp_path))) == ['a', 'c']
+
+    def test_names_outside_are_skipped(self, fetch, tmp_path):
+        target = tmp_path / 'target'
+        target.mkdir()
+        body = tar_gz([('../escaped', b'x'), ('/tmp/absolute', b'x'), ('a/../../escaped', b'x'), ('ok', b'ok')])
+        response, data = extract(fetch, target, body)
+        assert data['files'] == 1
+        assert [entry['name'] for entry in data['skipped']] == ['../escaped', '/tmp/absolute', 'a/../../escaped']
+        assert not (tmp_path / 'escaped').exists()
+        assert (target / 'ok').read_bytes() == b'ok'
+
+    def test_links_are_skipped(self, fetch, tmp_path):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as archive:
+            info = tarfile.TarInfo('link')
+            info.type = tarfile.SYMTYPE
+            info.linkname = '/etc/passwd'
+            archive.addfile(info)
+        response, data = extract(fetch, tmp_path, buf.getvalue())
+        assert data['skipped'] == [{'name': 'link', 'reason': "Not a regular file"}]
+        assert not os.path.lexists(str(tmp_path / 'link'))
+
+    def test_existing_files(self, fetch, tmp_path):
+        (tmp_path / 'brain.yml').write_bytes(b'old')
+        body = tar_gz([('brain.yml', b'new')])
+        _, data = extract(fetch, tmp_path, body)
+        assert data['skipped'] == [{'name': 'brain.yml', 'reason': "Exists"}]
+        assert (tmp_path / 'brain.yml').read_bytes() == b'old'
+        _, data = extract(fetch, tmp_path, body, overwrite=True)
+        assert data['files'] == 1
+        assert (tmp_path / 'brain.yml').read_bytes() == b'new'
+
+    def test_broken_archive(self, fetch, tmp_path):
+        response, data = extract(fetch, tmp_path, b'not an archive', 'zip')
+        assert response.status == 400
+        response, data = extract(fetch, tmp_path, tar_gz([('a', b'a' * 1000)])[:-20])
+        assert response.status == 400
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_size_limit(self, make_server, fetch_from, tmp_path):
+        server = make_server()
+        server.uploads.max_size = 10
+        response, body = fetch_from(server, '/api/archive?path=%s&format=tar.gz' % quote(str(tmp_path)),
+                                    'POST', tar_gz([('a', b'a')]))
+        assert response.status == 413
+        assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,156 @@
+import gzip
+import time
+from email.utils import formatdate
+
+import pytest
+
+pytest.importorskip("kalliope")
+
+import editor
+from editor import Asset, AssetStore, encoding_quality, is_not_modified, parse_accept_encoding
+
+
+COMPRESSIBLE = b"synapse: " * 1000
+
+
+class TestAcceptEncoding(object):
+
+    def test_parse_qualities(self):
+        qualities = parse_accept_encoding("gzip, br;q=0.5, identity;q=0, deflate;q=bad")
+        assert qualities == {'gzip': 1.0, 'br': 0.5, 'identity': 0.0, 'deflate': 0.0}
+
+    def test_parse_empty(self):
+        assert parse_accept_encoding(None) == {}
+        assert parse_accept_encoding("") == {}
+
+    def test_wildcard(self):
+        qualities = parse_accept_encoding("*;q=0.3")
+        assert encoding_quality(qualities, 'gzip') == 0.3
+        assert encoding_quality(qualities, 'identity') == 0.3
+
+    def test_identity_acceptable_by_default(self):
+        qualities = parse_accept_encoding("gzip")
+        assert encoding_quality(qualities, 'identity') == 1.0
+        assert encoding_quality(qualities, 'br') == 0.0
+
+
+class TestIsNotModified(object):
+
+    def test_etag_match(self):
+        assert is_not_modified({'If-None-Match': '"abc"'}, ['"abc"'], 0)
+        assert is_not_modified({'If-None-Match': 'W/"abc"'}, ['"abc"'], 0)
+        assert is_not_modified({'If-None-Match': '"x", "abc"'}, ['"abc"'], 0)
+        assert is_not_modified({'If-None-Match': '*'}, ['"abc"'], 0)
+
+    def test_etag_mismatch(self):
+        assert not is_not_modified({'If-None-Match': '"abc-gzip"'}, ['"abc"'], 0)
+
+    def test_if_modified_since(self):
+        mtime = 1500000000
+        assert is_not_modified({'If-Modified-Since': formatdate(mtime, usegmt=True)}, [], mtime + 0.5)
+        assert not is_not_modified({'If-Modified-Since': formatdate(mtime - 10, usegmt=True)}, [], mtime)
+        assert not is_not_modified({'If-Modified-Since': 'garbage'}, [], mtime)
+
+    def test_if_modified_since_without_mtime(self):
+        assert not is_not_modified({'If-Modified-Since': formatdate(usegmt=True)}, [], None)
+
+    def test_if_none_match_takes_precedence(self):
+        headers = {'If-None-Match': '"other"', 'If-Modified-Since': formatdate(time.time(), usegmt=True)}
+        assert not is_not_modified(headers, ['"abc"'], 0)
+
+    def test_no_conditional_headers(self):
+        assert not is_not_modified({}, ['"abc"'], 0)
+
+
+class TestAssetSelect(object):
+
+    def test_gzip_variant(self):
+        asset = Asset(COMPRESSIBLE, 'text/css', 0, True)
+        encoding, body, etag = asset.select("gzip, deflate")
+        assert encoding == 'gzip'
+        assert gzip.decompress(body) == COMPRESSIBLE
+        assert etag == asset.etags['gzip'] != asset.etags['identity']
+
+    def test_identity_without_header(self):
+        asset = Asset(COMPRESSIBLE, 'text/css', 0, True)
+        assert asset.select(None)[0] == 'identity'
+
+    def test_wildcard_gets_compressed_variant(self):
+        asset = Asset(COMPRESSIBLE, 'text/css', 0, True)
+        assert asset.select("*")[0] != 'identity'
+
+    def test_identity_refused(self):
+        asset = Asset(COMPRESSIBLE, 'text/css', 0, True)
+        assert asset.select("identity;q=0, gzip")[0] == 'gzip'
+        assert asset.select("identity;q=0") is None
+        assert asset.select("*;q=0") is None
+
+    def test_uncompressed_asset(self):
+        asset = Asset(b"x", 'font/woff2', 0, False)
+        assert list(asset.variants) == ['identity']
+        assert asset.select("gzip")[0] == 'identity'
+
+
+class TestAssetStore(object):
+
+    def test_cap_limits_cached_files(self):
+        store = AssetStore(200 * 1024)
+        store.load("Kalliope Editor")
+        assert store.size <= store.max_size
+        assert editor.INDEX_KEY in store.assets
+        assert len(store.assets) > 1
+
+    def test_zero_cap_keeps_only_index(self):
+        store = AssetStore(0)
+        store.load("Kalliope Editor")
+        assert list(store.assets) == [editor.INDEX_KEY]
+        assert store.size == 0
+        html = store.get(editor.INDEX_KEY).variants['identity']
+        assert b"?v=" not in html
+
+    def test_index_references_versions(self):
+        store = AssetStore(16 * 1024 * 1024)
+        store.load("My Title")
+        html = store.get(editor.INDEX_KEY).variants['identity'].decode('utf-8')
+        asset = store.get("extras/javascript/jquery-3.4.1.min.js")
+        assert "<title>My Title</title>" in html
+        assert "extras/javascript/jquery-3.4.1.min.js?v=%s" % asset.version in html
+
+
+class TestSendAsset(object):
+
+    def test_variant_revalidation(self, server, fetch):
+        path = "/extras/javascript/jquery-3.4.1.min.js"
+        response, body = fetch(path, headers={'Accept-Encoding': 'gzip'})
+        assert response.status == 200
+        assert response.getheader('Content-Encoding') == 'gzip'
+        assert response.getheader('Cache-Control') == editor.REVALIDATE_CACHE
+        etag = response.getheader('ETag')
+
+        response, body = fetch(path, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        assert response.status == 304
+        assert response.getheader('ETag') == etag
+        assert body == b""
+
+    def test_versioned_url_is_immutable(self, server, fetch):
+        asset = server.assets.get("extras/javascript/jquery-3.4.1.min.js")
+        response, _ = fetch("/extras/javascript/jquery-3.4.1.min.js?v=%s" % asset.version)
+        assert response.getheader('Cache-Control') == editor.IMMUTABLE_CACHE
+        response, _ = fetch("/extras/javascript/jquery-3.4.1.min.js?v=stale")
+        assert response.getheader('Cache-Control') == editor.REVALIDATE_CACHE
+
+    def test_disk_fallback_revalidation(self, server, fetch):
+        path = "/extras/javascript/ace/ace.js"
+        assert server.assets.get(path.lstrip('/')) is None
+        response, body = fetch(path)
+        assert response.status == 200
+        assert len(body) == int(response.getheader('Content-Length'))
+        etag = response.getheader('ETag')
+        response, body = fetch(path, headers={'If-None-Match': etag})
+        assert response.status == 304
+
+    def test_disk_fallback_stays_below_extras(self, server, fetch):
+        response, _ = fetch("/extras/../tests/conftest.js")
+        assert response.status == 404
+        response, _ = fetch("/../../etc/x.js")
+        assert response.status == 404
@@ -0,0 +1,111 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("kalliope")
+editor = pytest.importorskip("editor")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    (tmp_path / 'a.txt').write_text('a')
+    (tmp_path / 'b.txt').write_text('b')
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'c.txt').write_text('c')
+    (tmp_path / 'empty').mkdir()
+    return tmp_path
+
+
+def snapshot(path):
+    result = {}
+    for root, dirs, files in os.walk(str(path)):
+        for name in dirs + files:
+            full = os.path.join(root, name)
+            rel = os.path.relpath(full, str(path))
+            result[rel] = None if os.path.isdir(full) else open(full).read()
+    return result
+
+
+def batch(fetch, operations, atomic=False):
+    response, body = fetch('/api/batch', 'POST', json.dumps({'operations': operations, 'atomic': atomic}))
+    return response, json.loads(body)
+
+
+def test_batch_operations(fetch, tree):
+    response, result = batch(fetch, [
+        {'op': 'rename', 'src': str(tree / 'a.txt'), 'name': 'renamed.txt'},
+        {'op': 'move', 'src': str(tree / 'b.txt'), 'dst': str(tree / 'empty')},
+        {'op': 'copy', 'src': str(tree / 'dir'), 'dst': str(tree / 'copy')},
+        {'op': 'rmtree', 'path': str(tree / 'dir')},
+        {'op': 'mkdir', 'path': str(tree / 'new' / 'sub')},
+        {'op': 'delete', 'path': str(tree / 'copy' / 'c.txt')},
+    ])
+    assert response.status == 200
+    assert not result['error'], result
+    assert [x['error'] for x in result['results']] == [False] * 6
+    assert snapshot(tree) == {'renamed.txt': 'a', 'empty': None, 'empty/b.txt': 'b', 'copy': None,
+                              'new': None, 'new/sub': None}
+
+
+def test_batch_continues_after_failure(fetch, tree):
+    response, result = batch(fetch, [
+        {'op': 'delete', 'path': str(tree / 'dir')},
+        {'op': 'delete', 'path': str(tree / 'a.txt')},
+        {'op': 'frobnicate'},
+        {'op': 'rename', 'src': str(tree / 'b.txt')},
+    ])
+    assert result['error'] and not result['rolled_back']
+    assert [x['error'] for x in result['results']] == [True, False, True, True]
+    assert result['results'][3]['message'] == "Missing parameter: name"
+    assert not (tree / 'a.txt').exists()
+    assert (tree / 'dir' / 'c.txt').exists()
+
+
+def test_batch_atomic_rollback(fetch, tree):
+    before = snapshot(tree)
+    response, result = batch(fetch, [
+        {'op': 'rename', 'src': str(tree / 'a.txt'), 'name': 'renamed.txt'},
+        {'op': 'rmtree', 'path': str(tree / 'dir')},
+        {'op': 'delete', 'path': str(tree / 'b.txt')},
+        {'op': 'copy', 'src': str(tree / 'renamed.txt'), 'dst': str(tree / 'empty')},
+        {'op': 'mkdir', 'path': str(tree / 'x' / 'y')},
+        {'op': 'move', 'src': str(tree / 'missing'), 'dst': str(tree / 'empty')},
+        {'op': 'delete', 'path': str(tree / 'renamed.txt')},
+    ], atomic=True)
+    assert result['error'] and result['rolled_back']
+    assert [x['message'] for x in result['results']][5:] == [
+        "No such file or directory: %s" % (tree / 'missing'), "Skipped"]
+    assert snapshot(tree) == before
+
+
+def test_batch_atomic_commit(fetch, tree):
+    response, result = batch(fetch, [
+        {'op': 'rmtree', 'path': str(tree / 'dir')},
+        {'op': 'delete', 'path': str(tree / 'a.txt')},
+    ], atomic=True)
+    assert not result['error']
+    assert snapshot(tree) == {'b.txt': 'b', 'empty': None}
+
+
+def test_batch_refuses_overwrite(fetch, tree):
+    response, result = batch(fetch, [
+        {'op': 'rename', 'src': str(tree / 'a.txt'), 'name': 'b.txt'},
+        {'op': 'rename', 'src': str(tree / 'a.txt'), 'name': '../a.txt'},
+        {'op': 'copy', 'src': str(tree / 'a.txt'), 'dst': str(tree / 'b.txt')},
+    ])
+    assert [x['error'] for x in result['results']] == [True, True, True]
+    assert (tree / 'b.txt').read_text() == 'b'
+
+
+def test_batch_updates_listing(fetch, tree):
+    listing = editor.get_dircontent(str(tree))
+    assert 'a.txt' in [x['name'] for x in listing]
+    batch(fetch, [{'op': 'delete', 'path': str(tree / 'a.txt')}])
+    assert 'a.txt' not in [x['name'] for x in editor.get_dircontent(str(tree))]
+
+
+@pytest.mark.parametrize('body', ['not json', '{}', '{"operations": [1]}'])
+def test_batch_invalid(fetch, body):
+    response, result = fetch('/api/batch', 'POST', body)
+    assert response.status == 400
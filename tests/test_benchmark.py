@@ -0,0 +1,64 @@
+import importlib.util
+import json
+import os
+
+import pytest
+
+pytest.importorskip("kalliope")
+
+BENCH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'run.py')
+
+
+@pytest.fixture(scope='module')
+def bench():
+    spec = importlib.util.spec_from_file_location('bench', BENCH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def result(**scenario):
+    stats = {'requests': 100, 'errors': 0, 'rps': 100.0, 'p50_ms': 5.0, 'p99_ms': 10.0}
+    stats.update(scenario)
+    return {'rss_peak_mb': 100.0, 'threads_peak': 10, 'scenarios': {'file': stats}}
+
+
+class TestCheck(object):
+
+    def test_within_thresholds(self, bench):
+        thresholds = {'rss_peak_mb': 200, 'threads_peak': 16, 'scenarios': {'file': {'p99_ms': 20, 'rps': 50}}}
+        assert bench.check(result(), thresholds) == []
+
+    def test_exceeded_thresholds(self, bench):
+        thresholds = {'rss_peak_mb': 50, 'threads_peak': 8, 'scenarios': {'file': {'p99_ms': 5, 'rps': 500}}}
+        assert len(bench.check(result(), thresholds)) == 4
+
+    def test_failed_requests(self, bench):
+        assert bench.check(result(errors=1)) == ["file: 1 failed requests"]
+        assert bench.check(result(errors=1), {'scenarios': {'file': {'errors': 1}}}) == []
+
+    def test_baseline_regression(self, bench):
+        baseline = result()
+        assert bench.check(result(p99_ms=11.0, rps=90.0), baseline=baseline, tolerance=0.2) == []
+        failures = bench.check(result(p99_ms=13.0, rps=70.0), baseline=baseline, tolerance=0.2)
+        assert failures == ["file: p99_ms 13.000 regressed from 10.000", "file: rps 70.00 regressed from 100.00"]
+
+
+class TestRun(object):
+
+    def test_small_run(self, bench, tmpdir, engine):
+        output = tmpdir.join("result.json")
+        thresholds = tmpdir.join("thresholds.json")
+        thresholds.write(json.dumps({'scenarios': {'index': {'rps': 1000000}}}))
+        code = bench.main(['--engine', engine, '--duration', '0.2', '--concurrency', '2', '--files', '50',
+                           '--binary-size', '1', '--depth', '4', '--no-events',
+                           '--thresholds', str(thresholds), '--output', str(output)])
+        data = json.loads(output.read())
+        assert set(data['scenarios']) == set(bench.SCENARIOS)
+        for stats in data['scenarios'].values():
+            assert stats['requests'] > 0
+            assert stats['errors'] == 0
+            assert stats['p50_ms'] <= stats['p99_ms']
+        assert data['threads_peak'] > 0 and data['rss_peak_mb'] > 0
+        assert code == 1
+        assert data['failures'] == ["index: rps %.2f below 1000000.00" % data['scenarios']['index']['rps']]
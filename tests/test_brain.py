@@ -0,0 +1,197 @@
+import http.client
+import json
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("kalliope")
+editor = pytest.importorskip("editor")
+
+
+class Brain(object):
+    synapses = []
+    brain_yaml = []
+    brain_file = None
+
+
+class Synapse(object):
+
+    def __init__(self, name=None, neurons=None, signals=None):
+        self.name = name
+        self.neurons = neurons
+        self.signals = signals
+
+
+class ConfigurationChecker(object):
+
+    @staticmethod
+    def check_synape_dict(definition):
+        if 'name' not in definition:
+            raise KeyError("NoSynapeName")
+        if not definition.get('neurons'):
+            raise ValueError("The synapse has no neurons")
+        return True
+
+    @staticmethod
+    def check_synapes(synapses):
+        names = [x.name for x in synapses]
+        if len(names) != len(set(names)):
+            raise ValueError("Duplicate synapse name")
+        return True
+
+
+class BrainLoader(object):
+    brain = Brain()
+
+    @staticmethod
+    def get_neurons(neurons, settings):
+        return list(neurons)
+
+    @staticmethod
+    def get_signals(signals):
+        return list(signals)
+
+
+class SettingLoader(object):
+    settings = None
+
+
+@pytest.fixture
+def kalliope(monkeypatch, tmp_path):
+    configuration = types.ModuleType('kalliope.core.ConfigurationManager')
+    configuration.BrainLoader = BrainLoader
+    configuration.SettingLoader = SettingLoader
+    checker = types.ModuleType('kalliope.core.ConfigurationManager.ConfigurationChecker')
+    checker.ConfigurationChecker = ConfigurationChecker
+    models = types.ModuleType('kalliope.core.Models')
+    models.Synapse = Synapse
+    monkeypatch.setitem(sys.modules, 'kalliope.core.ConfigurationManager', configuration)
+    monkeypatch.setitem(sys.modules, 'kalliope.core.ConfigurationManager.ConfigurationChecker', checker)
+    monkeypatch.setitem(sys.modules, 'kalliope.core.Models', models)
+
+    brain = Brain()
+    brain.brain_file = str(tmp_path / 'brain.yml')
+    monkeypatch.setattr(BrainLoader, 'brain', brain)
+    write(tmp_path / 'brain.yml', [{'includes': ['brains/say.yml']}, synapse('hello')])
+    (tmp_path / 'brains').mkdir()
+    write(tmp_path / 'brains' / 'say.yml', [synapse('say')])
+    definitions = editor.BrainReloader().definitions(brain.brain_file)
+    brain.brain_yaml = definitions
+    brain.synapses = [Synapse(x['name'], x['neurons'], x['signals']) for x in definitions]
+    return brain
+
+
+def synapse(name, text="hi", signal='order'):
+    return {'name': name, 'signals': [{signal: name}], 'neurons': [{'say': {'message': text}}]}
+
+
+def write(path, entries):
+    import yaml
+    path.write_text(yaml.safe_dump(entries))
+    # Make every write visible to the mtime cache
+    stats = os.stat(str(path))
+    os.utime(str(path), ns=(stats.st_atime_ns, stats.st_mtime_ns + 10 ** 9))
+
+
+def test_definitions_follow_includes(kalliope, tmp_path):
+    reloader = editor.BrainReloader()
+    assert [x['name'] for x in reloader.definitions(kalliope.brain_file)] == ['say', 'hello']
+
+
+def test_parse_cached_by_mtime(kalliope, tmp_path):
+    reloader = editor.BrainReloader()
+    first = reloader.parse(str(tmp_path / 'brain.yml'))
+    assert reloader.parse(str(tmp_path / 'brain.yml')) is first
+    write(tmp_path / 'brain.yml', [synapse('hello')])
+    assert reloader.parse(str(tmp_path / 'brain.yml')) is not first
+
+
+def test_include_loop(kalliope, tmp_path):
+    write(tmp_path / 'brains' / 'say.yml', [{'includes': ['../brain.yml']}])
+    with pytest.raises(editor.BrainError):
+        editor.BrainReloader().definitions(kalliope.brain_file)
+
+
+def test_apply(kalliope, tmp_path):
+    unchanged = kalliope.synapses[1]
+    write(tmp_path / 'brain.yml', [{'includes': ['brains/say.yml']}, synapse('hello'), synapse('new', signal='event')])
+    write(tmp_path / 'brains' / 'say.yml', [synapse('say', "changed")])
+    result = editor.BrainReloader().apply()
+    assert not result['error'], result
+    assert (result['added'], result['changed'], result['removed']) == (['new'], ['say'], [])
+    assert len(result['warnings']) == 1
+    assert [x.name for x in kalliope.synapses] == ['say', 'hello', 'new']
+    assert kalliope.synapses[1] is unchanged
+    assert kalliope.synapses[0].neurons == [{'say': {'message': "changed"}}]
+
+
+def test_apply_removed(kalliope, tmp_path):
+    write(tmp_path / 'brain.yml', [synapse('hello')])
+    result = editor.BrainReloader().apply()
+    assert result['removed'] == ['say']
+    assert [x.name for x in kalliope.synapses] == ['hello']
+
+
+@pytest.mark.parametrize('entries', [
+    [synapse('hello'), {'name': 'broken', 'signals': [{'order': 'x'}], 'neurons': []}],
+    [synapse('hello'), synapse('hello', "again")],
+])
+def test_apply_invalid_keeps_brain(kalliope, tmp_path, entries):
+    synapses = kalliope.synapses
+    write(tmp_path / 'brain.yml', entries)
+    result = editor.BrainReloader().apply()
+    assert result['error'] and result['errors']
+    assert kalliope.synapses is synapses
+
+
+def test_apply_yaml_error(kalliope, tmp_path):
+    (tmp_path / 'brain.yml').write_text("- name: [unclosed\n")
+    result = editor.BrainReloader().apply()
+    assert result['error']
+    assert 'brain.yml' in result['errors'][0]
+
+
+def test_dry_run(kalliope, tmp_path):
+    synapses = kalliope.synapses
+    write(tmp_path / 'brain.yml', [synapse('hello', "changed")])
+    result = editor.BrainReloader().apply(dry_run=True)
+    assert not result['error'] and result['changed'] == ['hello']
+    assert kalliope.synapses is synapses
+
+
+def test_endpoint(kalliope, make_server, fetch_from, tmp_path):
+    server = make_server()
+    response, body = fetch_from(server, '/api/brain')
+    assert json.loads(body) == {'enabled': False}
+    response, body = fetch_from(server, '/api/brain/apply', 'POST')
+    assert response.status == 404
+
+    server.brain_reloader = editor.BrainReloader()
+    write(tmp_path / 'brain.yml', [synapse('hello', "changed")])
+    response, body = fetch_from(server, '/api/brain/apply', 'POST')
+    assert response.status == 200
+    assert json.loads(body)['changed'] == ['hello']
+
+    write(tmp_path / 'brain.yml', [{'name': 'broken'}])
+    response, body = fetch_from(server, '/api/brain/apply', 'POST')
+    assert response.status == 422
+    assert json.loads(body)['errors']
+
+
+def test_apply_body_is_not_a_request(kalliope, make_server, tmp_path):
+    server = make_server()
+    server.brain_reloader = editor.BrainReloader()
+    write(tmp_path / 'brain.yml', [synapse('hello', "changed")])
+    conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+    conn.request('POST', '/api/brain/apply?dry_run=1',
+                 body=b"GET /api/abspath?path=. HTTP/1.1\r\nHost: editor\r\n\r\n")
+    response = conn.getresponse()
+    assert response.status == 200
+    response.read()
+    conn.request('GET', '/api/missing')
+    response = conn.getresponse()
+    response.read()
+    assert response.status == 404
+    conn.close()
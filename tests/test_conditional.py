@@ -0,0 +1,69 @@
+import os
+from urllib.parse import quote
+
+import pytest
+
+pytest.importorskip("kalliope")
+editor = pytest.importorskip("editor")
+
+
+@pytest.fixture
+def brain(tmp_path):
+    path = tmp_path / 'brain.yml'
+    path.write_text('- name: test\n')
+    return path
+
+
+def test_file_etag(fetch, brain):
+    response, body = fetch('/api/file?filename=' + quote(str(brain)))
+    etag = response.getheader('ETag')
+    assert etag == editor.file_etag(os.stat(str(brain)))
+    assert response.getheader('Cache-Control') == 'no-cache'
+    assert body == b'- name: test\n'
+
+    response, body = fetch('/api/file?filename=' + quote(str(brain)), headers={'If-None-Match': etag})
+    assert response.status == 304
+    assert response.getheader('ETag') == etag
+    assert body == b''
+
+
+def test_file_changed(fetch, brain):
+    response, body = fetch('/api/file?filename=' + quote(str(brain)))
+    etag = response.getheader('ETag')
+    brain.write_text('- name: changed\n')
+    os.utime(str(brain), ns=(0, os.stat(str(brain)).st_mtime_ns + 1000))
+    response, body = fetch('/api/file?filename=' + quote(str(brain)), headers={'If-None-Match': etag})
+    assert response.status == 200
+    assert body == b'- name: changed\n'
+    assert response.getheader('X-Content-Hash') == editor.content_hash(b'- name: changed\n')
+
+
+def test_file_not_modified_skips_reading(fetch, brain, monkeypatch):
+    response, body = fetch('/api/file?filename=' + quote(str(brain)))
+    reads = []
+    monkeypatch.setattr(editor, 'content_hash', lambda data: reads.append(data) or '')
+    response, body = fetch('/api/file?filename=' + quote(str(brain)),
+                           headers={'If-None-Match': response.getheader('ETag')})
+    assert response.status == 304
+    assert reads == []
+
+
+def test_missing_file_has_no_etag(fetch, tmp_path):
+    response, body = fetch('/api/file?filename=' + quote(str(tmp_path / 'missing')))
+    assert response.getheader('ETag') is None
+
+
+@pytest.mark.parametrize('endpoint', ['listdir', 'tree'])
+def test_listing_etag(fetch, brain, endpoint):
+    url = '/api/%s?path=%s' % (endpoint, quote(str(brain.parent)))
+    response, body = fetch(url)
+    etag = response.getheader('ETag')
+    assert etag == editor.content_etag(body)
+    response, body = fetch(url, headers={'If-None-Match': etag})
+    assert response.status == 304
+
+    (brain.parent / 'new.yml').write_text('')
+    os.utime(str(brain.parent), ns=(0, os.stat(str(brain.parent)).st_mtime_ns + 1000))
+    response, body = fetch(url, headers={'If-None-Match': etag})
+    assert response.status == 200
+    assert b'new.yml' in body
@@ -0,0 +1,209 @@
+import errno
+import http.client
+import json
+import os
+import stat
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+pytest.importorskip("kalliope")
+editor = pytest.importorskip("editor")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    (tmp_path / 'brains' / 'sub').mkdir(parents=True)
+    (tmp_path / 'brains' / 'brain.yml').write_bytes(b'- name: hello\n')
+    (tmp_path / 'brains' / 'sub' / 'big.bin').write_bytes(os.urandom(300000))
+    (tmp_path / 'brains' / 'sub' / 'run.sh').write_bytes(b'#!/bin/sh\n')
+    os.chmod(str(tmp_path / 'brains' / 'sub' / 'run.sh'), 0o755)
+    os.symlink('brain.yml', str(tmp_path / 'brains' / 'link.yml'))
+    (tmp_path / 'target').mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def no_kernel_copy(monkeypatch):
+    """File systems without reflinks and copy_file_range across them."""
+    def refuse(*args):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(editor, 'fcntl', None)
+    monkeypatch.setattr(os, 'copy_file_range', refuse, raising=False)
+
+
+def snapshot(path):
+    result = {}
+    for root, dirs, files in os.walk(str(path)):
+        for name in dirs + files:
+            full = os.path.join(root, name)
+            rel = os.path.relpath(full, str(path))
+            if os.path.islink(full):
+                result[rel] = ('link', os.readlink(full))
+            elif os.path.isdir(full):
+                result[rel] = None
+            else:
+                result[rel] = (stat.S_IMODE(os.stat(full).st_mode), open(full, 'rb').read())
+    return result
+
+
+def post(fetch, path, **fields):
+    response, body = fetch(path, 'POST', urlencode(fields),
+                           {'Content-Type': 'application/x-www-form-urlencoded'})
+    return response, json.loads(body)
+
+
+class TestCopyFile(object):
+
+    def test_chunks_and_progress(self, tree, monkeypatch):
+        monkeypatch.setattr(editor, 'COPY_CHUNK_SIZE', 65536)
+        src = tree / 'brains' / 'sub' / 'big.bin'
+        steps = []
+        method = editor.copy_file(str(src), str(tree / 'copy.bin'), steps.append)
+        assert method in ('reflink', 'copy_file_range', 'sendfile')
+        assert (tree / 'copy.bin').read_bytes() == src.read_bytes()
+        assert sum(steps) == 300000
+
+    def test_fallbacks(self, tree, monkeypatch, no_kernel_copy):
+        src = str(tree / 'brains' / 'sub' / 'big.bin')
+        assert editor.copy_file(src, str(tree / 'sendfile.bin')) == 'sendfile'
+        monkeypatch.delattr(os, 'sendfile')
+        assert editor.copy_file(src, str(tree / 'read.bin')) == 'read'
+        assert (tree / 'read.bin').read_bytes() == (tree / 'sendfile.bin').read_bytes() == open(src, 'rb').read()
+
+    def test_existing_file_is_kept(self, tree):
+        with pytest.raises(FileExistsError):
+            editor.copy_file(str(tree / 'brains' / 'brain.yml'), str(tree / 'brains' / 'sub' / 'run.sh'))
+        assert (tree / 'brains' / 'sub' / 'run.sh').read_bytes() == b'#!/bin/sh\n'
+
+    def test_copy_path(self, tree):
+        editor.copy_path(str(tree / 'brains'), str(tree / 'copy'))
+        assert snapshot(tree / 'copy') == snapshot(tree / 'brains')
+        assert os.path.islink(str(tree / 'copy' / 'link.yml'))
+
+
+class TestFileJob(object):
+
+    def run(self, operation, src, dst):
+        job = editor.FileJob(operation, str(src), str(dst))
+        job.run()
+        return job
+
+    def test_copy(self, tree):
+        job = self.run('copy', tree / 'brains', tree / 'target' / 'brains')
+        assert job.state == 'done'
+        assert snapshot(tree / 'target' / 'brains') == snapshot(tree / 'brains')
+        assert (job.files, job.total_bytes, job.copied_bytes) == (3, 300024, 300024)
+        assert os.listdir(str(tree / 'target')) == ['brains']
+
+    def test_move_on_same_file_system_renames(self, tree):
+        before = snapshot(tree / 'brains')
+        job = self.run('move', tree / 'brains', tree / 'target' / 'moved')
+        assert (job.state, job.methods) == ('done', {'rename'})
+        assert not (tree / 'brains').exists()
+        assert snapshot(tree / 'target' / 'moved') == before
+
+    def test_move_to_other_file_system_copies(self, tree, monkeypatch):
+        rename = os.rename
+
+        def cross_device(src, dst):
+            if src == str(tree / 'brains'):
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            rename(src, dst)
+        monkeypatch.setattr(os, 'rename', cross_device)
+        before = snapshot(tree / 'brains')
+        job = self.run('move', tree / 'brains', tree / 'target' / 'moved')
+        assert job.state == 'done'
+        assert 'rename' not in job.methods
+        assert not (tree / 'brains').exists()
+        assert snapshot(tree / 'target' / 'moved') == before
+
+    def test_failure_leaves_nothing_behind(self, tree):
+        os.mkfifo(str(tree / 'brains' / 'sub' / 'pipe'))
+        job = self.run('copy', tree / 'brains', tree / 'target' / 'brains')
+        assert job.state == 'failed'
+        assert 'Not a regular file' in job.status()['message']
+        assert os.listdir(str(tree / 'target')) == []
+
+    def test_cancel(self, tree):
+        job = editor.FileJob('move', str(tree / 'brains' / 'sub' / 'big.bin'), str(tree / 'target' / 'big.bin'))
+        job.cancel()
+        job._rename = lambda: False
+        job.run()
+        assert job.state == 'cancelled'
+        assert os.listdir(str(tree / 'target')) == []
+        assert (tree / 'brains' / 'sub' / 'big.bin').exists()
+
+
+class TestApi(object):
+
+    def test_copy(self, fetch, tree):
+        response, data = post(fetch, '/api/copy', src=str(tree / 'brains'), dst=str(tree / 'target'))
+        assert response.status == 200
+        assert data['error'] is False
+        assert (data['state'], data['dst']) == ('done', str(tree / 'target' / 'brains'))
+        assert data['bytes'] == data['total_bytes'] == 300024
+        assert snapshot(tree / 'target' / 'brains') == snapshot(tree / 'brains')
+        response, body = fetch('/api/listdir?path=%s' % str(tree / 'target'))
+        assert [x['name'] for x in json.loads(body)['content']] == ['brains']
+
+    def test_move(self, fetch, tree):
+        response, data = post(fetch, '/api/move', src=str(tree / 'brains' / 'brain.yml'),
+                              dst=str(tree / 'target' / 'renamed.yml'))
+        assert (data['state'], data['methods'], data['message']) == ('done', ['rename'], "Move done")
+        assert (tree / 'target' / 'renamed.yml').read_bytes() == b'- name: hello\n'
+        assert not (tree / 'brains' / 'brain.yml').exists()
+
+    def test_running_job(self, fetch, tree, monkeypatch):
+        monkeypatch.setattr(editor, 'JOB_WAIT', 0)
+        response, data = post(fetch, '/api/copy', src=str(tree / 'brains'), dst=str(tree / 'copy'))
+        deadline = time.time() + 10
+        while data['state'] == 'running' and time.time() < deadline:
+            assert response.status in (200, 202)
+            time.sleep(0.01)
+            response, body = fetch('/api/job/status?id=%s' % data['id'])
+            data = json.loads(body)
+        assert data['state'] == 'done'
+        assert snapshot(tree / 'copy') == snapshot(tree / 'brains')
+
+    def test_cancel_finished_job(self, fetch, tree):
+        _, data = post(fetch, '/api/copy', src=str(tree / 'brains' / 'brain.yml'), dst=str(tree / 'target'))
+        response, body = fetch('/api/job/cancel?id=%s' % data['id'], 'POST')
+        assert json.loads(body)['state'] == 'done'
+
+    def test_cancel_body_is_not_a_request(self, server, fetch, tree):
+        _, data = post(fetch, '/api/copy', src=str(tree / 'brains' / 'brain.yml'), dst=str(tree / 'target'))
+        conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+        conn.request('POST', '/api/job/cancel?id=%s' % data['id'],
+                     body=b"GET /api/abspath?path=. HTTP/1.1\r\nHost: editor\r\n\r\n")
+        response = conn.getresponse()
+        assert json.loads(response.read())['state'] == 'done'
+        conn.request('GET', '/api/missing')
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 404
+        conn.close()
+
+    def test_errors(self, fetch, tree):
+        cases = [
+            ({'src': str(tree / 'missing'), 'dst': str(tree / 'target')}, 404),
+            ({'src': str(tree / 'brains'), 'dst': str(tree / 'missing' / 'brains')}, 404),
+            ({'src': str(tree / 'brains' / 'brain.yml'), 'dst': str(tree / 'brains' / 'link.yml')}, 409),
+            ({'src': str(tree / 'brains'), 'dst': str(tree / 'brains' / 'sub')}, 400),
+            ({'src': str(tree / 'brains'), 'dst': ''}, 400),
+            ({'src': str(tree / 'brains')}, 400),
+        ]
+        for fields, status in cases:
+            response, data = post(fetch, '/api/copy', **fields)
+            assert (response.status, data['error']) == (status, True), fields
+        response, _ = fetch('/api/job/status?id=unknown')
+        assert response.status == 404
+
+
+def test_rename_keeps_directory(fetch, tmp_path):
+    (tmp_path / 'brain').mkdir()
+    (tmp_path / 'brain' / 'brain').write_text('x')
+    response, data = post(fetch, '/api/rename', src=str(tmp_path / 'brain' / 'brain'), dstfilename='other')
+    assert data['path'] == str(tmp_path / 'brain' / 'other')
+    assert (tmp_path / 'brain' / 'other').read_text() == 'x'
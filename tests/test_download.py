@@ -0,0 +1,99 @@
+import os
+from urllib.parse import quote
+
+import pytest
+
+pytest.importorskip("kalliope")
+
+from editor import if_range_matches, parse_range
+
+
+CONTENT = bytes(range(256)) * 64
+
+
+@pytest.fixture
+def datafile(tmpdir):
+    path = tmpdir.join("recording.wav")
+    path.write_binary(CONTENT)
+    return str(path)
+
+
+def download_url(path):
+    return "/api/download?filename=" + quote(path)
+
+
+class TestParseRange(object):
+
+    def test_ranges(self):
+        assert parse_range("bytes=0-9", 100) == (0, 9)
+        assert parse_range("bytes=90-", 100) == (90, 99)
+        assert parse_range("bytes=-10", 100) == (90, 99)
+        assert parse_range("bytes=-500", 100) == (0, 99)
+        assert parse_range("bytes=50-500", 100) == (50, 99)
+
+    def test_ignored(self):
+        assert parse_range(None, 100) is None
+        assert parse_range("items=0-9", 100) is None
+        assert parse_range("bytes=0-1,5-6", 100) is None
+        assert parse_range("bytes=9-0", 100) is None
+        assert parse_range("bytes=a-b", 100) is None
+
+    def test_unsatisfiable(self):
+        assert parse_range("bytes=100-", 100) is False
+        assert parse_range("bytes=-0", 100) is False
+        assert parse_range("bytes=-5", 0) is False
+
+    def test_if_range(self):
+        assert if_range_matches(None, '"a"', 0)
+        assert if_range_matches('"a"', '"a"', 0)
+        assert not if_range_matches('"b"', '"a"', 0)
+        assert not if_range_matches('W/"a"', '"a"', 0)
+
+
+class TestDownload(object):
+
+    def test_full(self, fetch, datafile):
+        response, body = fetch(download_url(datafile))
+        assert response.status == 200
+        assert body == CONTENT
+        assert int(response.getheader('Content-Length')) == len(CONTENT)
+        assert response.getheader('Accept-Ranges') == 'bytes'
+        assert 'recording.wav' in response.getheader('Content-Disposition')
+
+    def test_range(self, fetch, datafile):
+        response, body = fetch(download_url(datafile), headers={'Range': 'bytes=100-199'})
+        assert response.status == 206
+        assert body == CONTENT[100:200]
+        assert response.getheader('Content-Range') == 'bytes 100-199/%i' % len(CONTENT)
+
+    def test_suffix_range(self, fetch, datafile):
+        response, body = fetch(download_url(datafile), headers={'Range': 'bytes=-10'})
+        assert response.status == 206
+        assert body == CONTENT[-10:]
+
+    def test_unsatisfiable(self, fetch, datafile):
+        response, body = fetch(download_url(datafile), headers={'Range': 'bytes=999999-'})
+        assert response.status == 416
+        assert response.getheader('Content-Range') == 'bytes */%i' % len(CONTENT)
+
+    def test_if_range(self, fetch, datafile):
+        response, _ = fetch(download_url(datafile))
+        etag = response.getheader('ETag')
+        response, body = fetch(download_url(datafile), headers={'Range': 'bytes=0-9', 'If-Range': etag})
+        assert response.status == 206
+        assert body == CONTENT[:10]
+        response, body = fetch(download_url(datafile), headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+        assert response.status == 200
+        assert body == CONTENT
+
+    def test_not_found(self, fetch, tmpdir):
+        response, _ = fetch(download_url(os.path.join(str(tmpdir), "missing")))
+        assert response.status == 404
+
+    def test_image_preview_range(self, fetch, tmpdir):
+        path = tmpdir.join("picture.png")
+        path.write_binary(CONTENT)
+        response, body = fetch("/api/file?filename=" + quote(str(path)), headers={'Range': 'bytes=10-19'})
+        assert response.status == 206
+        assert response.getheader('Content-type') == 'image/png'
+        assert body == CONTENT[10:20]
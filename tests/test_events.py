@@ -0,0 +1,200 @@
+import json
+import os
+import socket
+import time
+
+import pytest
+
+pytest.importorskip("kalliope")
+editor = pytest.importorskip("editor")
+
+
+class FakeStream(object):
+
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.sent = []
+        self.closed = False
+
+    def send(self, data):
+        self.sent.append(data.decode('utf-8'))
+        return self.alive
+
+    def close(self):
+        self.closed = True
+
+    def events(self, name='change'):
+        result = []
+        for message in self.sent:
+            lines = message.strip().split('\n')
+            if lines[0] == 'event: ' + name:
+                result.append(json.loads(lines[1][len('data: '):]))
+        return result
+
+
+@pytest.fixture
+def notifier(monkeypatch):
+    monkeypatch.setattr(editor, 'IGNORE_MATCHER', None)
+    monkeypatch.setattr(editor, 'HIDEHIDDEN', False)
+    return editor.ChangeNotifier(debounce=0, max_delay=0)
+
+
+def test_hello_and_subscribe(notifier, tmp_path):
+    stream = FakeStream()
+    client = notifier.connect(stream)
+    assert stream.events('hello') == [{'id': client.id}]
+    assert notifier.subscribe(client.id, [str(tmp_path)])
+    assert not notifier.subscribe('unknown', [])
+    assert notifier._directories() == {str(tmp_path)}
+
+
+def test_events_for_open_paths_only(notifier, tmp_path):
+    (tmp_path / 'open.yml').write_text('')
+    stream = FakeStream()
+    client = notifier.connect(stream)
+    notifier.subscribe(client.id, [str(tmp_path / 'sub'), str(tmp_path / 'open.yml')])
+    notifier._queue('modify', str(tmp_path / 'open.yml'), None)
+    notifier._queue('modify', str(tmp_path / 'other.yml'), None)
+    notifier._queue('create', str(tmp_path / 'sub' / 'new.yml'), None)
+    notifier._flush()
+    assert stream.events() == [
+        {'type': 'modify', 'path': str(tmp_path / 'open.yml'), 'dest': None},
+        {'type': 'create', 'path': str(tmp_path / 'sub' / 'new.yml'), 'dest': None},
+    ]
+
+
+def test_debounce(notifier, tmp_path):
+    path = str(tmp_path / 'a')
+    stream = FakeStream()
+    notifier.subscribe(notifier.connect(stream).id, [str(tmp_path)])
+    notifier.debounce = notifier.max_delay = 60
+    notifier._queue('create', path, None)
+    notifier._queue('modify', path, None)
+    notifier._queue('modify', str(tmp_path / 'b'), None)
+    notifier._queue('delete', str(tmp_path / 'b'), None)
+    notifier._queue('create', str(tmp_path / 'b'), None)
+    notifier._queue('create', str(tmp_path / 'c'), None)
+    notifier._queue('delete', str(tmp_path / 'c'), None)
+    notifier._flush()
+    assert stream.events() == []
+    notifier.debounce = notifier.max_delay = 0
+    notifier._flush()
+    assert [(x['type'], x['path']) for x in stream.events()] == [('create', path), ('modify', str(tmp_path / 'b'))]
+
+
+def test_atomic_write_reported_as_change(notifier, tmp_path):
+    stream = FakeStream()
+    notifier.subscribe(notifier.connect(stream).id, [str(tmp_path)])
+    notifier._queue('create', str(tmp_path / '.editor-x.tmp'), None)
+    notifier._queue('rename', str(tmp_path / '.editor-x.tmp'), str(tmp_path / 'brain.yml'))
+    notifier._queue('rename', str(tmp_path / 'a.yml'), str(tmp_path / 'b.yml'))
+    notifier._flush()
+    assert stream.events() == [
+        {'type': 'create', 'path': str(tmp_path / 'brain.yml'), 'dest': None},
+        {'type': 'rename', 'path': str(tmp_path / 'a.yml'), 'dest': str(tmp_path / 'b.yml')},
+    ]
+
+
+def test_hidden_files_reported_unless_hidden(notifier, tmp_path, monkeypatch):
+    stream = FakeStream()
+    notifier.subscribe(notifier.connect(stream).id, [str(tmp_path)])
+    notifier._queue('create', str(tmp_path / '.hidden'), None)
+    notifier._queue('create', str(tmp_path / '.upload-x.part'), None)
+    notifier._queue('rename', str(tmp_path / '.editor-x.part'), str(tmp_path / 'copy.yml'))
+    monkeypatch.setattr(editor, 'HIDEHIDDEN', True)
+    notifier._queue('create', str(tmp_path / '.other'), None)
+    notifier._flush()
+    assert [(x['type'], x['path']) for x in stream.events()] == [
+        ('create', str(tmp_path / '.hidden')), ('create', str(tmp_path / 'copy.yml'))]
+
+
+def test_dead_client_dropped(notifier, tmp_path):
+    stream = FakeStream(alive=False)
+    client = notifier.connect(stream)
+    assert stream.closed
+    assert client.id not in notifier.clients
+
+
+def test_polling_watcher(tmp_path):
+    (tmp_path / 'a').write_text('a')
+    (tmp_path / 'b').write_text('b')
+    watcher = editor.PollingWatcher(interval=0)
+    watcher.watch({str(tmp_path)})
+    (tmp_path / 'a').write_text('changed')
+    (tmp_path / 'b').unlink()
+    (tmp_path / 'c').write_text('c')
+    events = sorted(watcher.read(0))
+    assert events == [('create', str(tmp_path / 'c'), None), ('delete', str(tmp_path / 'b'), None),
+                      ('modify', str(tmp_path / 'a'), None)]
+    assert watcher.read(0) == []
+
+
+def read_events(watcher, count, timeout=5):
+    events = []
+    deadline = time.time() + timeout
+    while len(events) < count and time.time() < deadline:
+        events.extend(watcher.read(0.1))
+    return events
+
+
+def test_inotify_watcher(tmp_path):
+    try:
+        watcher = editor.InotifyWatcher()
+    except OSError:
+        pytest.skip("inotify is not available")
+    try:
+        watcher.watch({str(tmp_path)})
+        (tmp_path / 'a').write_text('a')
+        os.rename(str(tmp_path / 'a'), str(tmp_path / 'b'))
+        os.unlink(str(tmp_path / 'b'))
+        events = read_events(watcher, 4)
+        assert events[0] == ('create', str(tmp_path / 'a'), None)
+        assert ('rename', str(tmp_path / 'a'), str(tmp_path / 'b')) in events
+        assert events[-1] == ('delete', str(tmp_path / 'b'), None)
+        watcher.watch(set())
+        assert watcher.paths == {}
+    finally:
+        watcher.close()
+
+
+def open_events(server):
+    sock = socket.create_connection(server.server_address, timeout=5)
+    sock.sendall(b"GET /api/events HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    buffer = b''
+    while b'event: hello' not in buffer or not buffer.endswith(b'\n\n'):
+        buffer += sock.recv(4096)
+    head, _, body = buffer.partition(b'\r\n\r\n')
+    assert b'text/event-stream' in head
+    client_id = json.loads(body.split(b'data: ')[1].split(b'\n')[0])['id']
+    return sock, client_id
+
+
+def test_events_endpoint(make_server, fetch_from, tmp_path):
+    server = make_server(workers=1)
+    server.notifier = editor.ChangeNotifier(debounce=0.05)
+    server.notifier.start()
+    try:
+        sock, client_id = open_events(server)
+        # The event stream doesn't hold on to the only worker
+        response, body = fetch_from(server, '/api/events/subscribe', 'POST',
+                                    json.dumps({'id': client_id, 'paths': [str(tmp_path)]}))
+        assert response.status == 200
+        time.sleep(0.3)
+        (tmp_path / 'new.yml').write_text('')
+        buffer = b''
+        deadline = time.time() + 10
+        while b'new.yml' not in buffer and time.time() < deadline:
+            buffer += sock.recv(4096)
+        assert b'event: change' in buffer
+        assert json.loads(buffer.split(b'data: ')[1].split(b'\n')[0]) == {
+            'type': 'create', 'path': str(tmp_path / 'new.yml'), 'dest': None}
+        sock.close()
+    finally:
+        server.notifier.stop()
+
+
+def test_events_disabled(fetch):
+    response, body = fetch('/api/events')
+    assert response.status == 404
+    response, body = fetch('/api/events/subscribe', 'POST', json.dumps({'id': 'x', 'paths': []}))
+    assert response.status == 404
@@ -0,0 +1,131 @@
+import json
+import os
+from urllib.parse import quote
+
+import pytest
+
+pytest.importorskip("kalliope")
+editor = pytest.importorskip("editor")
+
+
+@pytest.fixture
+def small_step(monkeypatch):
+    """Checkpoints every few bytes, so windows start between them."""
+    monkeypatch.setattr(editor, 'LINE_INDEX_STEP', 64)
+    monkeypatch.setattr(editor, 'CHUNK_SIZE', 50)
+
+
+@pytest.fixture
+def log(tmp_path):
+    path = tmp_path / 'kalliope.log'
+    path.write_bytes(b''.join(b'line %d %s\n' % (number, b'x' * (number % 37)) for number in range(1, 1001)))
+    return path
+
+
+def read(cache, path, start, count):
+    with open(str(path), 'rb') as fptr:
+        return cache.read(str(path), fptr, start, count)
+
+
+class TestLineIndex(object):
+
+    def test_windows(self, small_step, log):
+        cache = editor.LineIndexCache()
+        expected = log.read_bytes().splitlines(True)
+        for start in (0, 1, 5, 63, 64, 499, 998, 999):
+            lines, first, total = read(cache, log, start, 7)
+            assert lines == expected[start:start + 7]
+            assert (first, total) == (start, 1000)
+        assert len(cache.entries[str(log)].offsets) > 10
+        assert read(cache, log, 1000, 5) == ([], 1000, 1000)
+        assert read(cache, log, -3, 5) == (expected[-3:], 997, 1000)
+        assert read(cache, log, -5000, 1) == (expected[:1], 0, 1000)
+
+    def test_last_line_without_newline(self, small_step, tmp_path):
+        path = tmp_path / 'brain.yml'
+        path.write_bytes(b'a\nb')
+        cache = editor.LineIndexCache()
+        assert read(cache, path, 0, 5) == ([b'a\n', b'b'], 0, 2)
+        path.write_bytes(b'')
+        assert read(cache, path, 0, 5) == ([], 0, 0)
+
+    def test_appended_file_is_extended(self, small_step, log):
+        cache = editor.LineIndexCache()
+        read(cache, log, 0, 1)
+        index = cache.entries[str(log)]
+        offsets = list(index.offsets)
+        with open(str(log), 'ab') as fptr:
+            fptr.write(b'appended 1\nappended')
+        assert read(cache, log, -2, 5) == ([b'appended 1\n', b'appended'], 1000, 1002)
+        assert cache.entries[str(log)] is index
+        assert index.offsets[:len(offsets)] == offsets
+
+    def test_rewritten_file_is_indexed_again(self, small_step, log):
+        cache = editor.LineIndexCache()
+        read(cache, log, 0, 1)
+        content = b'first\n' * 10 + log.read_bytes()[60:] + b'more\n'
+        log.write_bytes(content)
+        lines, _, total = read(cache, log, 0, 2000)
+        assert lines == content.splitlines(True)
+        assert total == len(lines)
+
+    def test_replaced_file_is_indexed_again(self, small_step, log, tmp_path):
+        cache = editor.LineIndexCache()
+        read(cache, log, 0, 1)
+        other = tmp_path / 'other.log'
+        other.write_bytes(log.read_bytes() + b'x\n')
+        os.replace(str(other), str(log))
+        assert read(cache, log, -1, 1) == ([b'x\n'], 1000, 1001)
+
+    def test_cache_size(self, tmp_path):
+        cache = editor.LineIndexCache(max_files=2)
+        for name in ('a', 'b', 'c'):
+            path = tmp_path / name
+            path.write_bytes(b'x\n')
+            read(cache, path, 0, 1)
+        assert list(cache.entries) == [str(tmp_path / 'b'), str(tmp_path / 'c')]
+
+
+class TestFileWindow(object):
+
+    def test_window(self, fetch, log):
+        response, body = fetch('/api/file?filename=%s&start_line=10&lines=3' % quote(str(log)))
+        assert response.status == 200
+        data = json.loads(body)
+        assert data['content'] == ''.join('line %d %s\n' % (number, 'x' * (number % 37)) for number in (10, 11, 12))
+        assert (data['start_line'], data['lines'], data['total_lines']) == (10, 3, 1000)
+        assert data['size'] == os.path.getsize(str(log))
+        response, body = fetch('/api/file?filename=%s&start_line=10&lines=3' % quote(str(log)),
+                               headers={'If-None-Match': response.getheader('ETag')})
+        assert response.status == 304
+
+    def test_tail(self, fetch, log):
+        response, body = fetch('/api/file?filename=%s&start_line=-2' % quote(str(log)))
+        data = json.loads(body)
+        assert (data['start_line'], data['lines']) == (999, 2)
+        assert data['content'].startswith('line 999 ')
+
+    def test_invalid_utf8_is_replaced(self, fetch, tmp_path):
+        path = tmp_path / 'binary.log'
+        path.write_bytes(b'ok\n\xff\xfe\n')
+        response, body = fetch('/api/file?filename=%s&lines=5' % quote(str(path)))
+        assert json.loads(body)['content'] == 'ok\n��\n'
+
+    def test_bad_parameters(self, fetch, log):
+        for query in ('start_line=0', 'start_line=x', 'lines=-1'):
+            response, body = fetch('/api/file?filename=%s&%s' % (quote(str(log)), query))
+            assert response.status == 400
+            assert json.loads(body)['error'] is True
+
+    def test_missing_file(self, fetch, tmp_path):
+        response, body = fetch('/api/file?filename=%s&lines=5' % quote(str(tmp_path / 'missing.log')))
+        assert response.status == 404
+
+    def test_max_size(self, fetch, log):
+        size = os.path.getsize(str(log))
+        response, body = fetch('/api/file?filename=%s&max_size=%d' % (quote(str(log)), size - 1))
+        assert response.status == 413
+        assert json.loads(body) == {'error': True, 'message': "File too large", 'size': size}
+        response, body = fetch('/api/file?filename=%s&max_size=%d' % (quote(str(log)), size))
+        assert response.status == 200
+        assert body == log.read_bytes()
@@ -0,0 +1,160 @@
+import json
+import os
+from urllib.parse import quote
+
+import pytest
+
+pytest.importorskip("kalliope")
+
+import editor
+from editor import LISTING_CACHE, compile_ignore_pattern, get_dircontent
+
+
+@pytest.fixture
+def tree(tmpdir, monkeypatch):
+    monkeypatch.setattr(editor, 'IGNORE_MATCHER', None)
+    monkeypatch.setattr(editor, 'HIDEHIDDEN', False)
+    monkeypatch.setattr(editor, 'DIRSFIRST', False)
+    LISTING_CACHE.invalidate()
+    tmpdir.mkdir("brains")
+    tmpdir.mkdir("Cache")
+    tmpdir.join("brain.yml").write("---\n")
+    tmpdir.join(".hidden").write("")
+    tmpdir.join("neuron.py").write("")
+    tmpdir.join("settings.yml").write("x" * 10)
+    yield str(tmpdir)
+    LISTING_CACHE.invalidate()
+
+
+def names(listing):
+    return [x['name'] for x in listing]
+
+
+class TestGetDircontent(object):
+
+    def test_entries(self, tree):
+        listing = get_dircontent(tree)
+        assert names(listing) == ['.hidden', 'brain.yml', 'brains', 'Cache', 'neuron.py', 'settings.yml']
+        settings = listing[-1]
+        assert settings['type'] == 'file'
+        assert settings['size'] == 10
+        assert settings['fullpath'] == os.path.join(tree, 'settings.yml')
+        assert listing[2]['type'] == 'dir'
+
+    def test_dir_first_and_hidden(self, tree, monkeypatch):
+        monkeypatch.setattr(editor, 'DIRSFIRST', True)
+        monkeypatch.setattr(editor, 'HIDEHIDDEN', True)
+        assert names(get_dircontent(tree)) == ['brains', 'Cache', 'brain.yml', 'neuron.py', 'settings.yml']
+
+    def test_ignore_pattern(self, tree, monkeypatch):
+        monkeypatch.setattr(editor, 'IGNORE_MATCHER', compile_ignore_pattern(["*.py", "Cache"]))
+        assert names(get_dircontent(tree)) == ['.hidden', 'brain.yml', 'brains', 'settings.yml']
+
+    def test_cached_until_directory_changes(self, tree):
+        listing = get_dircontent(tree)
+        assert get_dircontent(tree) is listing
+        with open(os.path.join(tree, "new.yml"), "w"):
+            pass
+        os.utime(tree, ns=(0, os.stat(tree).st_mtime_ns + 1000))
+        assert 'new.yml' in names(get_dircontent(tree))
+
+    def test_invalidate_listing(self, tree):
+        listing = get_dircontent(tree)
+        editor.invalidate_listing(os.path.join(tree, "brain.yml"))
+        assert get_dircontent(tree) is not listing
+
+
+class TestListdir(object):
+
+    def test_pagination(self, fetch, tree):
+        response, body = fetch("/api/listdir?path=%s&offset=1&limit=2" % quote(tree))
+        data = json.loads(body.decode('utf-8'))
+        assert data['total'] == 6
+        assert data['offset'] == 1
+        assert names(data['content']) == ['brain.yml', 'brains']
+
+    def test_without_pagination(self, fetch, tree):
+        response, body = fetch("/api/listdir?path=%s" % quote(tree))
+        data = json.loads(body.decode('utf-8'))
+        assert len(data['content']) == data['total'] == 6
+
+
+class TestTree(object):
+
+    @pytest.fixture
+    def deep(self, tree):
+        os.makedirs(os.path.join(tree, "brains", "sub", "deeper"))
+        open(os.path.join(tree, "brains", "sub", "a.yml"), "w").close()
+        return tree
+
+    def test_depth(self, deep):
+        root, truncated = editor.get_tree(deep, 2)
+        assert not truncated
+        assert names(root['children']) == ['.hidden', 'brain.yml', 'brains', 'Cache', 'neuron.py', 'settings.yml']
+        brains = root['children'][2]
+        assert names(brains['children']) == ['sub']
+        # Below the requested depth directories are stubs
+        assert brains['children'][0]['children'] is None
+        assert root['children'][5] == {'name': 'settings.yml', 'size': 10,
+                                       'modified': int(os.stat(os.path.join(deep, 'settings.yml')).st_mtime)}
+
+    def test_depth_zero(self, deep):
+        root, truncated = editor.get_tree(deep, 0)
+        assert root == {'name': os.path.basename(deep), 'children': None}
+
+    def test_honors_listing_settings(self, deep, monkeypatch):
+        monkeypatch.setattr(editor, 'DIRSFIRST', True)
+        monkeypatch.setattr(editor, 'HIDEHIDDEN', True)
+        monkeypatch.setattr(editor, 'IGNORE_MATCHER', compile_ignore_pattern(["Cache"]))
+        root, truncated = editor.get_tree(deep, 1)
+        assert names(root['children']) == ['brains', 'brain.yml', 'neuron.py', 'settings.yml']
+
+    def test_entry_budget(self, deep):
+        root, truncated = editor.get_tree(deep, 5, max_entries=3)
+        assert truncated
+        assert root['total'] == 6
+        assert names(root['children']) == ['.hidden', 'brain.yml', 'brains']
+        assert all(x.get('children') is None for x in root['children'])
+
+    def test_root_is_paged(self, deep):
+        root, truncated = editor.get_tree(deep, 2, max_entries=4, offset=2)
+        assert truncated
+        assert names(root['children']) == ['brains', 'Cache', 'neuron.py', 'settings.yml']
+        # The page used up the entries, subdirectories stay stubs
+        assert root['children'][0]['children'] is None
+        root, truncated = editor.get_tree(deep, 2, max_entries=4, offset=4)
+        assert not truncated
+        assert names(root['children']) == ['neuron.py', 'settings.yml']
+
+    def test_big_subdirectory_is_a_stub(self, deep):
+        for number in range(10):
+            open(os.path.join(deep, "brains", "sub", "%i.yml" % number), "w").close()
+        root, truncated = editor.get_tree(deep, 3, max_entries=10)
+        assert truncated
+        sub = root['children'][2]['children'][0]
+        assert sub['name'] == 'sub' and sub['children'] is None
+
+    def test_time_budget(self, deep):
+        root, truncated = editor.get_tree(deep, 5, budget=-1)
+        assert truncated and root['children'] is None
+
+    def test_endpoint(self, fetch, deep):
+        response, body = fetch("/api/tree?path=%s&depth=3" % quote(deep))
+        data = json.loads(body.decode('utf-8'))
+        assert data['path'] == os.path.abspath(deep)
+        assert data['parent'] == os.path.dirname(os.path.abspath(deep))
+        assert not data['truncated']
+        assert (data['offset'], data['total']) == (0, 6)
+        sub = data['tree']['children'][2]['children'][0]
+        assert names(sub['children']) == ['a.yml', 'deeper']
+        assert sub['children'][1]['children'] is None
+
+    def test_endpoint_paging(self, fetch, deep):
+        response, body = fetch("/api/tree?path=%s&depth=1&offset=5&limit=2" % quote(deep))
+        data = json.loads(body.decode('utf-8'))
+        assert (data['offset'], data['total'], data['truncated']) == (5, 6, False)
+        assert names(data['tree']['children']) == ['settings.yml']
+
+    def test_endpoint_missing(self, fetch, tree):
+        response, body = fetch("/api/tree?path=%s" % quote(os.path.join(tree, "missing")))
+        assert response.status == 404
@@ -0,0 +1,96 @@
+import re
+import time
+from urllib.parse import quote
+
+import pytest
+
+pytest.importorskip("kalliope")
+editor = pytest.importorskip("editor")
+
+
+def samples(text):
+    result = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            result[name] = float(value)
+    return result
+
+
+def test_route_label():
+    assert editor.route_label('/api/file') == '/api/file'
+    assert editor.route_label('/editor/api/upload/chunk') == '/api/upload/chunk'
+    assert editor.route_label('/api/unknown/route') == 'other'
+    assert editor.route_label('/') == 'static'
+    assert editor.route_label('/extras/javascript/ace.js') == 'static'
+    assert editor.route_label('/favicon.ico') == 'other'
+
+
+def test_observe_and_export():
+    metrics = editor.Metrics()
+    for duration in (0.001, 0.02, 3):
+        metrics.start()
+        metrics.observe('/api/file', 'GET', 200, duration, 100, 0.001, {'disk': 0.5}, False)
+    metrics.start()
+    metrics.observe('/api/save', 'POST', 500, 0.01, 10, 0.0, {}, False)
+
+    class Server(object):
+        workers = 4
+
+        def backlog(self):
+            return 2
+
+    text = metrics.export(Server())
+    values = samples(text)
+    assert values['editor_requests_total{route="/api/file",method="GET",code="200"}'] == 3
+    assert values['editor_request_duration_seconds_bucket{route="/api/file",le="0.005"}'] == 1
+    assert values['editor_request_duration_seconds_bucket{route="/api/file",le="0.025"}'] == 2
+    assert values['editor_request_duration_seconds_bucket{route="/api/file",le="+Inf"}'] == 3
+    assert values['editor_request_duration_seconds_count{route="/api/file"}'] == 3
+    assert values['editor_request_duration_seconds_sum{route="/api/file"}'] == pytest.approx(3.021)
+    assert values['editor_response_bytes_total{route="/api/file"}'] == 300
+    assert values['editor_request_phase_seconds_total{route="/api/file",phase="disk"}'] == 1.5
+    assert values['editor_request_errors_total{route="/api/file"}'] == 0
+    assert values['editor_request_errors_total{route="/api/save"}'] == 1
+    assert values['editor_requests_in_flight'] == 0
+    assert values['editor_workers'] == 4
+    assert values['editor_queued_connections'] == 2
+    assert text.count('# TYPE editor_request_duration_seconds histogram') == 1
+
+
+def test_slow_request_log(capsys):
+    metrics = editor.Metrics(slow_threshold=0.5)
+    metrics.start()
+    metrics.observe('/api/file', 'GET', 200, 0.1, 0, 0, {}, False)
+    metrics.start()
+    metrics.observe('/api/file', 'GET', 200, 0.6, 5, 0.2, {'disk': 0.4}, False)
+    out = capsys.readouterr().out
+    assert out.count("Slow request") == 1
+    assert "GET /api/file 200 0.600s (cpu 0.200s, disk 0.400s) 5 bytes" in out
+
+
+def test_metrics_endpoint(make_server, fetch_from, tmp_path):
+    server = make_server()
+    response, body = fetch_from(server, '/api/metrics')
+    assert response.status == 404
+
+    server.metrics = editor.Metrics()
+    (tmp_path / 'a.yml').write_text('x' * 10)
+    fetch_from(server, '/api/file?filename=' + quote(str(tmp_path / 'a.yml')))
+    fetch_from(server, '/api/nothing')
+    # A request is recorded once its response is sent, the client may be faster.
+    deadline = time.time() + 5
+    while True:
+        response, body = fetch_from(server, '/api/metrics')
+        values = samples(body.decode('utf-8'))
+        if 'editor_requests_total{route="other",method="GET",code="404"}' in values or time.time() > deadline:
+            break
+        time.sleep(0.01)
+    assert response.getheader('Content-type').startswith('text/plain')
+    assert values['editor_requests_total{route="/api/file",method="GET",code="200"}'] == 1
+    assert values['editor_requests_total{route="other",method="GET",code="404"}'] == 1
+    assert values['editor_response_bytes_total{route="/api/file"}'] == 10
+    assert values['editor_request_phase_seconds_total{route="/api/file",phase="disk"}'] > 0
+    # The metrics request itself is still in flight
+    assert values['editor_requests_in_flight'] == 1
+    assert values['editor_threads'] >= 1
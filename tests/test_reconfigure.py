@@ -0,0 +1,183 @@
+import http.client
+import socket
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("kalliope")
+editor = pytest.importorskip("editor")
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    for name in ('IGNORE_PATTERN', 'IGNORE_MATCHER', 'DIRSFIRST', 'HIDEHIDDEN', 'PAGE_TITLE'):
+        monkeypatch.setattr(editor, name, getattr(editor, name))
+    editor.LISTING_CACHE.invalidate()
+    yield
+    editor.LISTING_CACHE.invalidate()
+
+
+@pytest.fixture
+def start_thread(engine):
+    """Factory for running EditorThreads of the engine on free loopback ports."""
+    thread_class = editor.AsyncEditorThread if engine == 'asyncio' else editor.EditorThread
+    threads = []
+
+    def start_thread(port=0, **kwargs):
+        kwargs.setdefault('asset_cache_size', 1)
+        kwargs.setdefault('search_refresh', None)
+        kwargs.setdefault('events', False)
+        thread = thread_class('127.0.0.1', port, **kwargs)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+        return thread
+
+    yield start_thread
+    for thread in threads:
+        if not thread.is_down:
+            thread.shutdown_server(1)
+
+
+def request(conn, path, method='GET', body=None, headers=None):
+    conn.request(method, path, body=body, headers=headers or {})
+    response = conn.getresponse()
+    return response, response.read()
+
+
+def connect(thread):
+    return http.client.HTTPConnection(*thread.httpd.server_address[:2], timeout=10)
+
+
+class TestUpdateSettings(object):
+
+    def test_changed_names(self, settings):
+        editor.update_settings(None, False, False, "Kalliope Editor")
+        assert editor.update_settings(None, False, False, "Kalliope Editor") == set()
+        assert editor.update_settings(["*.py"], True, False, "Kalliope Editor") == {'IGNORE_PATTERN', 'DIRSFIRST'}
+        assert editor.IGNORE_MATCHER.match("neuron.py")
+        assert editor.DIRSFIRST is True
+
+    def test_listings_are_dropped(self, settings, tmpdir):
+        tmpdir.join("neuron.py").write("")
+        editor.update_settings(None, False, False, "Kalliope Editor")
+        assert [x['name'] for x in editor.get_dircontent(str(tmpdir))] == ['neuron.py']
+        editor.update_settings(["*.py"], False, False, "Kalliope Editor")
+        assert editor.get_dircontent(str(tmpdir)) == []
+
+    def test_listing_made_with_old_settings_is_not_cached(self, settings):
+        cache = editor.ListingCache()
+        generation = cache.generation
+        cache.invalidate()
+        cache.put('/brains', 1, [], generation)
+        assert cache.get('/brains', 1) is None
+        cache.put('/brains', 1, [], cache.generation)
+        assert cache.get('/brains', 1) == []
+
+
+class TestReconfigure(object):
+
+    def test_options_apply_to_running_server(self, start_thread, settings, engine):
+        thread = start_thread()
+        conn = connect(thread)
+        response, _ = request(conn, "/api/metrics")
+        assert response.status == 200
+        uploads = thread.httpd.uploads
+        thread.reconfigure(asset_cache_size=1, search_refresh=None, workers=2, queue_size=4, idle_timeout=2,
+                           max_upload_size=5, events=False, metrics=False)
+        sock = conn.sock
+        response, _ = request(conn, "/api/metrics")
+        assert response.status == 404
+        assert conn.sock is sock
+        assert thread.httpd.uploads is uploads
+        assert uploads.max_size == 5 * 1024 * 1024
+        assert (thread.httpd.workers, thread.httpd.queue_size, thread.httpd.idle_timeout) == (2, 4, 2)
+        if engine == 'threading':
+            deadline = time.time() + 5
+            while len(thread.httpd._workers) > 2 and time.time() < deadline:
+                time.sleep(0.01)
+            assert len(thread.httpd._workers) == 2
+        conn.close()
+
+    def test_page_title(self, start_thread, settings):
+        editor.update_settings(None, False, False, "Kalliope Editor")
+        thread = start_thread()
+        conn = connect(thread)
+        _, body = request(conn, "/")
+        assert b"<title>Kalliope Editor" in body
+        thread.settings_changed(editor.update_settings(None, False, False, "Living Room"))
+        _, body = request(conn, "/")
+        assert b"<title>Living Room" in body
+        conn.close()
+
+
+class TestDrain(object):
+
+    def test_request_in_progress_finishes(self, start_thread, tmpdir):
+        thread = start_thread()
+        # The server accepts connections once its assets are loaded.
+        conn = connect(thread)
+        request(conn, "/api/abspath?path=.")
+        conn.close()
+        body = ("filename=%s&text=%s" % (tmpdir.join("brain.yml"), "x" * 1000)).encode('utf-8')
+        sock = socket.create_connection(thread.httpd.server_address[:2], timeout=10)
+        sock.sendall(b"POST /api/save HTTP/1.1\r\nHost: editor\r\nContent-Length: %d\r\n"
+                     b"Content-Type: application/x-www-form-urlencoded\r\n\r\n" % len(body) + body[:100])
+        time.sleep(0.2)
+        stopper = threading.Thread(target=thread.shutdown_server, args=(5,))
+        stopper.start()
+        time.sleep(0.2)
+        assert not thread.is_down
+        sock.sendall(body[100:])
+        response = http.client.HTTPResponse(sock)
+        response.begin()
+        assert response.status == 200
+        assert response.getheader('Connection') == 'close'
+        response.read()
+        stopper.join(5)
+        assert thread.is_down
+        assert tmpdir.join("brain.yml").read() == "x" * 1000
+        sock.close()
+
+    def test_idle_connection_does_not_delay_stop(self, start_thread):
+        thread = start_thread(idle_timeout=10)
+        conn = connect(thread)
+        request(conn, "/api/abspath?path=.")
+        started = time.time()
+        thread.shutdown_server(5)
+        assert time.time() - started < 2
+        conn.close()
+
+
+class TestHandOver(object):
+
+    def test_new_port(self, start_thread):
+        old = start_thread()
+        conn = connect(old)
+        request(conn, "/api/abspath?path=.")
+        new = start_thread(previous=old)
+        assert new.httpd.server_address != old.httpd.server_address
+        assert new.httpd.uploads is old.httpd.uploads
+        assert new.httpd.metrics is old.httpd.metrics
+        old.shutdown_server(5)
+        new_conn = connect(new)
+        response, _ = request(new_conn, "/api/abspath?path=.")
+        assert response.status == 200
+        response, body = request(new_conn, "/api/metrics")
+        assert b'route="/api/abspath"' in body
+        conn.close()
+        new_conn.close()
+
+    def test_same_port_after_stop_listening(self, start_thread):
+        old = start_thread()
+        port = old.httpd.server_address[1]
+        with pytest.raises(OSError):
+            start_thread(port=port, previous=old)
+        old.stop_listening()
+        new = start_thread(port=port, previous=old)
+        old.shutdown_server(5)
+        conn = connect(new)
+        response, _ = request(conn, "/api/abspath?path=.")
+        assert response.status == 200
+        conn.close()
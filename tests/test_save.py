@@ -0,0 +1,127 @@
+import json
+import os
+import stat
+import zlib
+from urllib.parse import urlencode, quote
+
+import pytest
+
+pytest.importorskip("kalliope")
+editor = pytest.importorskip("editor")
+
+FORM = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+def test_apply_edits():
+    text = "a\nb\nc\nd"
+    assert editor.apply_edits(text, []) == text
+    assert editor.apply_edits(text, [{'start': 1, 'end': 3, 'lines': ['x']}]) == "a\nx\nd"
+    assert editor.apply_edits(text, [{'start': 4, 'end': 4, 'lines': ['e']}]) == "a\nb\nc\nd\ne"
+    # Positions refer to the original text, whatever the order of the edits.
+    assert editor.apply_edits(text, [{'start': 3, 'end': 4, 'lines': []},
+                                     {'start': 0, 'end': 1, 'lines': ['y', 'z']}]) == "y\nz\nb\nc"
+
+
+@pytest.mark.parametrize('edits', [
+    [{'start': 2, 'end': 5, 'lines': []}],
+    [{'start': 2, 'end': 1, 'lines': []}],
+    [{'start': 0, 'end': 2, 'lines': []}, {'start': 1, 'end': 3, 'lines': []}],
+    [{'start': 0, 'end': 0, 'lines': [1]}],
+])
+def test_apply_edits_invalid(edits):
+    with pytest.raises(ValueError):
+        editor.apply_edits("a\nb\nc\nd", edits)
+
+
+def save(fetch, **fields):
+    response, body = fetch('/api/save', 'POST', urlencode(fields), FORM)
+    return response, json.loads(body)
+
+
+def test_file_sends_hash(fetch, tmp_path):
+    path = tmp_path / 'brain.yml'
+    path.write_bytes(b'- name: test\n')
+    response, body = fetch('/api/file?filename=' + quote(str(path)))
+    assert response.getheader('X-Content-Hash') == editor.content_hash(b'- name: test\n')
+
+
+def test_full_save(fetch, tmp_path):
+    path = tmp_path / 'brain.yml'
+    path.write_text('old')
+    os.chmod(str(path), 0o640)
+    response, result = save(fetch, filename=str(path), text='new\n')
+    assert not result['error']
+    assert path.read_text() == 'new\n'
+    assert result['hash'] == editor.content_hash(b'new\n')
+    assert stat.S_IMODE(os.stat(str(path)).st_mode) == 0o640
+    assert os.listdir(str(tmp_path)) == ['brain.yml']
+
+
+def test_delta_save(fetch, tmp_path):
+    path = tmp_path / 'brain.yml'
+    path.write_text('one\ntwo\nthree\n')
+    new = 'one\n2\nthree\n'
+    response, result = save(fetch, filename=str(path), base=editor.content_hash(b'one\ntwo\nthree\n'),
+                            edits=json.dumps([{'start': 1, 'end': 2, 'lines': ['2']}]),
+                            crc32=zlib.crc32(new.encode()))
+    assert response.status == 200 and not result['error']
+    assert path.read_text() == new
+    assert result['hash'] == editor.content_hash(new.encode())
+
+
+def test_delta_save_conflict(fetch, tmp_path):
+    path = tmp_path / 'brain.yml'
+    path.write_text('changed by someone else\n')
+    response, result = save(fetch, filename=str(path), base=editor.content_hash(b'original\n'),
+                            edits='[]', crc32=zlib.crc32(b'original\n'))
+    assert response.status == 409 and result['conflict']
+    assert result['hash'] == editor.content_hash(b'changed by someone else\n')
+    assert path.read_text() == 'changed by someone else\n'
+
+    # A full save with a stale base is refused as well, without base it overwrites.
+    response, result = save(fetch, filename=str(path), base=editor.content_hash(b'original\n'), text='x')
+    assert response.status == 409
+    response, result = save(fetch, filename=str(path), text='x')
+    assert path.read_text() == 'x'
+
+
+def test_delta_save_checksum_mismatch(fetch, tmp_path):
+    path = tmp_path / 'brain.yml'
+    path.write_text('a\nb\n')
+    response, result = save(fetch, filename=str(path), base=editor.content_hash(b'a\nb\n'),
+                            edits=json.dumps([{'start': 0, 'end': 1, 'lines': ['c']}]),
+                            crc32=zlib.crc32(b'something else'))
+    assert response.status == 409
+    assert path.read_text() == 'a\nb\n'
+
+
+def test_save_follows_symlink(fetch, tmp_path):
+    (tmp_path / 'real.yml').write_text('a')
+    os.symlink('real.yml', str(tmp_path / 'link.yml'))
+    save(fetch, filename=str(tmp_path / 'link.yml'), text='b')
+    assert os.path.islink(str(tmp_path / 'link.yml'))
+    assert (tmp_path / 'real.yml').read_text() == 'b'
+
+
+def test_save_missing_fields(fetch, tmp_path):
+    response, result = save(fetch, filename=str(tmp_path / 'a'), edits='[]')
+    assert result['error'] and result['message'] == "Missing filename or text"
+
+
+def test_umask_is_read_without_changing_it(monkeypatch):
+    def umask(mask):
+        raise AssertionError("umask changed")
+    mask = os.umask(0o027)
+    try:
+        monkeypatch.setattr(os, 'umask', umask)
+        assert editor.read_umask() == 0o027
+    finally:
+        monkeypatch.undo()
+        os.umask(mask)
+
+
+def test_new_file_mode(fetch, tmp_path, monkeypatch):
+    monkeypatch.setattr(editor, 'UMASK', 0o027)
+    response, body = fetch('/api/save', 'POST',
+                           urlencode({'filename': str(tmp_path / 'new.yml'), 'text': 'x'}), FORM)
+    assert stat.S_IMODE(os.stat(str(tmp_path / 'new.yml')).st_mode) == 0o640
@@ -0,0 +1,132 @@
+import json
+import os
+from urllib.parse import quote
+
+import pytest
+
+pytest.importorskip("kalliope")
+
+import editor
+from editor import SearchIndex, required_literals, trigrams
+
+
+@pytest.fixture
+def tree(tmpdir, monkeypatch):
+    monkeypatch.setattr(editor, 'IGNORE_MATCHER', editor.compile_ignore_pattern(["*.pyc"]))
+    monkeypatch.setattr(editor, 'HIDEHIDDEN', True)
+    brains = tmpdir.mkdir("brains")
+    brains.join("default.yml").write("- name: say-hello\n  signals:\n    - order: Hello Kalliope\n")
+    brains.join("music.yml").write("- name: play-music\n  neurons:\n    - shell:\n        cmd: mpc play\n")
+    tmpdir.join("settings.yml").write("default_trigger: snowboy\n")
+    tmpdir.join("logo.png").write_binary(b"say-hello")
+    tmpdir.join("cache.pyc").write("say-hello")
+    tmpdir.mkdir(".git").join("config").write("say-hello")
+    return tmpdir
+
+
+@pytest.fixture
+def index(tree):
+    index = SearchIndex(str(tree), str(tree.join("index.json")))
+    index.scan()
+    return index
+
+
+def paths(results):
+    return sorted(set(os.path.basename(x['path']) for x in results))
+
+
+class TestHelpers(object):
+
+    def test_trigrams(self):
+        assert trigrams("abcd") == {"abc", "bcd"}
+        assert trigrams("ab") == set()
+
+    def test_required_literals(self):
+        assert required_literals("say-hello") == ["say-hello"]
+        assert required_literals(r"name: \w+-music") == ["name: ", "-music"]
+        assert required_literals("hello|music") == []
+        assert required_literals("(") == []
+
+
+class TestSearchIndex(object):
+
+    def test_literal(self, index):
+        results, truncated = index.search("say-hello")
+        assert not truncated
+        assert paths(results) == ["default.yml"]
+        assert results[0]['line'] == 1
+
+    def test_case(self, index):
+        assert paths(index.search("hello kalliope")[0]) == ["default.yml"]
+        assert index.search("hello kalliope", case_sensitive=True)[0] == []
+
+    def test_regex(self, index):
+        assert paths(index.search(r"cmd: \w+ play", regex=True)[0]) == ["music.yml"]
+        assert paths(index.search(r"snowboy|mpc", regex=True)[0]) == ["music.yml", "settings.yml"]
+
+    def test_short_term_scans_text_files(self, index):
+        assert paths(index.search("mp")[0]) == ["music.yml"]
+
+    def test_path_filter(self, index, tree):
+        assert index.search("name", path=str(tree.join("brains")))[0]
+        assert index.search("default_trigger", path=str(tree.join("brains")))[0] == []
+
+    def test_limit(self, index):
+        results, truncated = index.search("-", limit=1)
+        assert len(results) == 1
+        assert truncated
+
+    def test_update_and_remove(self, index, tree):
+        tree.join("brains", "new.yml").write("- name: goodbye\n")
+        index.update(str(tree.join("brains", "new.yml")))
+        assert paths(index.search("goodbye")[0]) == ["new.yml"]
+        tree.join("brains", "new.yml").remove()
+        index.update(str(tree.join("brains", "new.yml")))
+        assert index.search("goodbye")[0] == []
+        index.remove(str(tree.join("brains")))
+        assert index.search("say-hello")[0] == []
+
+    def test_persisted(self, index, tree):
+        index.save()
+        loaded = SearchIndex(str(tree), str(tree.join("index.json")))
+        loaded.load()
+        assert loaded.files == index.files
+        assert paths(loaded.search("play-music")[0]) == ["music.yml"]
+        assert json.loads(tree.join("index.json").read())['version'] == editor.SEARCH_INDEX_VERSION
+
+    def test_unusable_file_is_rebuilt(self, tree):
+        index_file = tree.join("index.json")
+        marker = tree.join("unpickled")
+        contents = [
+            # A pickle running code when loaded with pickle.
+            b"cos\nsystem\n(S'touch %s'\ntR." % str(marker).encode('utf-8'),
+            b'{"version": 2, "basedir": "%s", "files": {"x": [1, 2, [3]]}}' % str(tree).encode('utf-8'),
+            b'{"version": 2',
+        ]
+        for content in contents:
+            index_file.write_binary(content)
+            index = SearchIndex(str(tree), str(index_file))
+            index.load()
+            assert index.files == {}
+            index.scan()
+            assert paths(index.search("play-music")[0]) == ["music.yml"]
+        assert not marker.exists()
+
+
+class TestSearchEndpoint(object):
+
+    def test_search(self, server, fetch, index):
+        server.search_index = index
+        response, body = fetch("/api/search?q=%s" % quote("mpc play"))
+        data = json.loads(body.decode('utf-8'))
+        assert data['error'] is None
+        assert paths(data['results']) == ["music.yml"]
+
+    def test_invalid_regex(self, server, fetch, index):
+        server.search_index = index
+        response, body = fetch("/api/search?regex=1&q=%s" % quote("("))
+        assert json.loads(body.decode('utf-8'))['error']
+
+    def test_disabled(self, fetch):
+        response, body = fetch("/api/search?q=x")
+        assert json.loads(body.decode('utf-8'))['error'] == "Search is disabled"
@@ -0,0 +1,128 @@
+import http.client
+import socket
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+import pytest
+
+pytest.importorskip("kalliope")
+
+
+def request(conn, path, method='GET', body=None, headers=None):
+    conn.request(method, path, body=body, headers=headers or {})
+    response = conn.getresponse()
+    return response, response.read()
+
+
+class TestKeepAlive(object):
+
+    def test_requests_share_one_connection(self, server, tmpdir):
+        tmpdir.join("brain.yml").write("---\n")
+        conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+        paths = ["/", "/extras/css/materialize.min.css", "/api/listdir?path=%s" % quote(str(tmpdir)),
+                 "/api/file?filename=%s" % quote(str(tmpdir.join("brain.yml"))),
+                 "/api/abspath?path=%s" % quote(str(tmpdir)), "/api/missing"]
+        for path in paths:
+            response, body = request(conn, path)
+            assert response.version == 11
+            assert int(response.getheader('Content-Length')) == len(body)
+            assert not response.will_close
+        form = urlencode({'path': str(tmpdir), 'name': 'new.yml'})
+        response, body = request(conn, "/api/newfile", 'POST', form,
+                                 {'Content-Type': 'application/x-www-form-urlencoded'})
+        assert int(response.getheader('Content-Length')) == len(body)
+        assert tmpdir.join("new.yml").check()
+        sock = conn.sock
+        request(conn, "/")
+        assert conn.sock is sock
+        conn.close()
+
+    def test_small_responses_are_not_delayed(self, server, tmpdir):
+        # Body written after the headers must not wait for a delayed ACK (~40ms).
+        tmpdir.join("brain.yml").write("---\n")
+        conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+        path = "/api/file?filename=%s" % quote(str(tmpdir.join("brain.yml")))
+        request(conn, path)
+        started = time.time()
+        for _ in range(10):
+            request(conn, path)
+        assert time.time() - started < 0.3
+        conn.close()
+
+    def test_unknown_post_closes_connection(self, server):
+        conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+        response, body = request(conn, "/api/unknown", 'POST', b"x" * 100)
+        assert response.will_close
+        conn.close()
+
+
+class TestWorkerPool(object):
+
+    def test_thread_count_is_bounded(self, make_server):
+        before = threading.active_count()
+        server = make_server(workers=4)
+        conns = [http.client.HTTPConnection(*server.server_address, timeout=10) for _ in range(4)]
+        for _ in range(5):
+            for conn in conns:
+                request(conn, "/api/missing")
+            # the serving and selector threads plus the workers, whatever the load
+            assert threading.active_count() <= before + 2 + 4
+        for conn in conns:
+            conn.close()
+
+    def test_full_queue_is_refused(self, make_server, tmpdir):
+        server = make_server(workers=1, queue_size=1, idle_timeout=10)
+        # A request whose body is still arriving keeps the only worker busy.
+        busy = socket.create_connection(server.server_address)
+        busy.sendall(b"POST /api/save HTTP/1.1\r\nHost: editor\r\nContent-Length: 100\r\n\r\nfilename=")
+        time.sleep(0.2)
+        waiting = socket.create_connection(server.server_address)
+        waiting.sendall(b"GET /api/missing HTTP/1.1\r\nHost: editor\r\n\r\n")
+        time.sleep(0.2)
+        refused = http.client.HTTPConnection(*server.server_address, timeout=10)
+        response, _ = request(refused, "/api/missing")
+        assert response.status == 503
+        busy.close()
+        waiting.close()
+
+    def test_idle_connections_hold_no_worker(self, make_server):
+        server = make_server(workers=2, idle_timeout=10)
+        idle = [http.client.HTTPConnection(*server.server_address, timeout=10) for _ in range(4)]
+        for conn in idle:
+            request(conn, "/api/missing")
+        silent = [socket.create_connection(server.server_address) for _ in range(4)]
+        other = http.client.HTTPConnection(*server.server_address, timeout=10)
+        start = time.time()
+        response, _ = request(other, "/api/missing")
+        assert response.status == 404
+        assert time.time() - start < 1
+        for conn in idle:
+            response, _ = request(conn, "/api/missing")
+            assert response.status == 404
+            conn.close()
+        for sock in silent:
+            sock.close()
+        other.close()
+
+    def test_pipelined_requests(self, server):
+        sock = socket.create_connection(server.server_address, timeout=10)
+        sock.sendall(b"GET /api/missing HTTP/1.1\r\nHost: editor\r\n\r\n" * 3)
+        received = b""
+        while received.count(b"HTTP/1.1 404") < 3:
+            data = sock.recv(65536)
+            assert data
+            received += data
+        sock.close()
+
+    def test_idle_connection_releases_worker(self, make_server):
+        server = make_server(workers=1, idle_timeout=0.3)
+        idle = http.client.HTTPConnection(*server.server_address, timeout=10)
+        request(idle, "/api/missing")
+        other = http.client.HTTPConnection(*server.server_address, timeout=10)
+        start = time.time()
+        response, _ = request(other, "/api/missing")
+        assert response.status == 404
+        assert time.time() - start < 5
+        idle.close()
+        other.close()
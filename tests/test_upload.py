@@ -0,0 +1,161 @@
+import hashlib
+import http.client
+import io
+import json
+import os
+from urllib.parse import urlencode
+
+import pytest
+
+pytest.importorskip("kalliope")
+editor = pytest.importorskip("editor")
+
+BOUNDARY = "----editorboundary"
+
+
+def multipart(fields):
+    body = b''
+    for name, filename, data in fields:
+        disposition = 'form-data; name="%s"' % name
+        if filename is not None:
+            disposition += '; filename="%s"' % filename
+        body += b'--' + BOUNDARY.encode() + b'\r\n'
+        body += b'Content-Disposition: ' + disposition.encode() + b'\r\n\r\n'
+        body += data + b'\r\n'
+    return body + b'--' + BOUNDARY.encode() + b'--\r\n'
+
+
+def parts(body, boundary=BOUNDARY):
+    reader = editor.MultipartReader(io.BytesIO(body), boundary.encode(), len(body))
+    result = []
+    while True:
+        headers = reader.next_part()
+        if headers is None:
+            return result
+        result.append((headers.get_param('name', header='content-disposition'),
+                       headers.get_filename(), b''.join(reader.read_part())))
+
+
+def test_multipart_reader_parts():
+    data = os.urandom(200000) + b'\r\n--' + BOUNDARY[:-1].encode()
+    body = multipart([('path', None, b'/tmp'), ('file', 'a.bin', data), ('empty', None, b'')])
+    assert parts(body) == [('path', None, b'/tmp'), ('file', 'a.bin', data), ('empty', None, b'')]
+
+
+def test_multipart_reader_preamble():
+    body = b'preamble\r\n' + multipart([('path', None, b'x')])
+    assert parts(body) == [('path', None, b'x')]
+
+
+@pytest.mark.parametrize('body', [b'', b'--' + BOUNDARY.encode() + b'\r\nno headers end',
+                                  multipart([('file', 'a', b'data')])[:-30]])
+def test_multipart_reader_malformed(body):
+    with pytest.raises(editor.MultipartError):
+        parts(body)
+
+
+def test_upload_target(tmp_path):
+    assert editor.upload_target(str(tmp_path), '..\\evil/name.txt') == str(tmp_path / 'name.txt')
+    assert editor.upload_target(str(tmp_path), '..') is None
+    assert editor.upload_target(str(tmp_path / 'missing'), 'a') is None
+
+
+def test_upload(fetch, tmp_path):
+    data = os.urandom(300000)
+    body = multipart([('path', None, str(tmp_path).encode()), ('file', 'up.bin', data)])
+    response, result = fetch('/api/upload', 'POST', body,
+                             {'Content-Type': 'multipart/form-data; boundary=' + BOUNDARY})
+    result = json.loads(result)
+    assert response.status == 200 and not result['error']
+    assert result['sha256'] == hashlib.sha256(data).hexdigest()
+    assert (tmp_path / 'up.bin').read_bytes() == data
+    assert os.listdir(str(tmp_path)) == ['up.bin']
+
+
+def test_upload_path_after_file(fetch, tmp_path):
+    body = multipart([('file', 'up.bin', b'data'), ('path', None, str(tmp_path).encode())])
+    response, result = fetch('/api/upload', 'POST', body,
+                             {'Content-Type': 'multipart/form-data; boundary=' + BOUNDARY})
+    assert response.status == 400
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_upload_too_big(server, tmp_path):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+    conn.putrequest('POST', '/api/upload')
+    conn.putheader('Content-Type', 'multipart/form-data; boundary=' + BOUNDARY)
+    conn.putheader('Content-Length', str(2 * 1024 * 1024))
+    conn.endheaders()
+    response = conn.getresponse()
+    assert response.status == 413
+    assert response.getheader('Connection') == 'close'
+    conn.close()
+
+
+def test_chunked_upload(server, fetch, tmp_path):
+    data = os.urandom(250000)
+    response, result = fetch('/api/upload/start', 'POST',
+                             urlencode({'path': str(tmp_path), 'name': 'big.bin', 'size': len(data)}),
+                             {'Content-Type': 'application/x-www-form-urlencoded'})
+    upload_id = json.loads(result)['id']
+
+    response, result = fetch('/api/upload/chunk?id=%s&offset=0' % upload_id, 'POST', data[:100000])
+    assert json.loads(result)['offset'] == 100000
+
+    # A chunk sent again after a lost response is refused with the current offset.
+    response, result = fetch('/api/upload/chunk?id=%s&offset=0' % upload_id, 'POST', data[:100000])
+    assert response.status == 409
+    assert json.loads(result)['offset'] == 100000
+
+    response, result = fetch('/api/upload/status?id=%s' % upload_id)
+    assert json.loads(result)['offset'] == 100000
+    assert not (tmp_path / 'big.bin').exists()
+
+    response, result = fetch('/api/upload/chunk?id=%s&offset=100000' % upload_id, 'POST', data[100000:])
+    result = json.loads(result)
+    assert result['done']
+    assert result['sha256'] == hashlib.sha256(data).hexdigest()
+    assert (tmp_path / 'big.bin').read_bytes() == data
+    assert os.listdir(str(tmp_path)) == ['big.bin']
+
+    response, result = fetch('/api/upload/status?id=%s' % upload_id)
+    assert response.status == 404
+
+
+def test_chunked_upload_limits(fetch, tmp_path):
+    response, result = fetch('/api/upload/start', 'POST',
+                             urlencode({'path': str(tmp_path), 'name': 'big.bin', 'size': 4 * 1024 * 1024}),
+                             {'Content-Type': 'application/x-www-form-urlencoded'})
+    assert response.status == 413
+
+    response, result = fetch('/api/upload/start', 'POST',
+                             urlencode({'path': str(tmp_path), 'name': 'big.bin', 'size': 10}),
+                             {'Content-Type': 'application/x-www-form-urlencoded'})
+    upload_id = json.loads(result)['id']
+    response, result = fetch('/api/upload/chunk?id=%s&offset=0' % upload_id, 'POST', b'x' * 11)
+    assert response.status == 409
+
+    response, result = fetch('/api/upload/cancel?id=%s' % upload_id, 'POST', b'')
+    assert not json.loads(result)['error']
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_cancel_body_is_not_a_request(server, fetch, tmp_path):
+    response, result = fetch('/api/upload/start', 'POST',
+                             urlencode({'path': str(tmp_path), 'name': 'a.bin', 'size': 10}),
+                             {'Content-Type': 'application/x-www-form-urlencoded'})
+    upload_id = json.loads(result)['id']
+    conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+    conn.request('POST', '/api/upload/cancel?id=%s' % upload_id,
+                 body=b"GET /api/abspath?path=. HTTP/1.1\r\nHost: editor\r\n\r\n")
+    response = conn.getresponse()
+    assert not json.loads(response.read())['error']
+    conn.request('GET', '/api/missing')
+    response = conn.getresponse()
+    response.read()
+    assert response.status == 404
+    conn.close()
+
+    response, result = fetch('/api/upload/cancel?id=unknown', 'POST', b'x' * (editor.CHUNK_SIZE + 1))
+    assert response.status == 404
+    assert response.will_close